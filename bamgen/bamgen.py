@@ -43,6 +43,7 @@ class MockReferenceFile(object):
 
 
 def create_unpaired_read(
+        query_name,
         sequence,
         qualities,
         reference_id,
@@ -53,9 +54,7 @@ def create_unpaired_read(
         is_duplicate
 ):
     read = pysam.AlignedRead()
-    read.query_name = "simulated_read_{}".format(
-        str(uuid.uuid4())
-    )
+    read.query_name = query_name
 
     read.query_sequence = sequence
     read.query_qualities = qualities
@@ -72,6 +71,7 @@ def create_unpaired_read(
 
 
 def create_perfect_unpaired_read(
+        query_name,
         reference_file,
         reference_id,
         chromosome,
@@ -84,6 +84,7 @@ def create_perfect_unpaired_read(
     cigar = ((0, read_length),)  # Perfect match
 
     return create_unpaired_read(
+        query_name,
         sequence,
         qualities,
         reference_id,
@@ -96,6 +97,7 @@ def create_perfect_unpaired_read(
 
 
 def create_unmapped_unpaired_read(
+        query_name,
         read_length
 ):
     sequence = "G"*read_length
@@ -103,6 +105,7 @@ def create_unmapped_unpaired_read(
     cigar = ((0, read_length),)
 
     return create_unpaired_read(
+        query_name,
         sequence,
         qualities,
         0,
@@ -117,7 +120,9 @@ def create_unmapped_unpaired_read(
 def generate_bam_file(bam_file_name, reference_file, regions):
     """
     Create a new BAM file and write reads to that file. The number and details
-    of the reads are specified in the 'regions' parameter.
+    of the reads are specified in the 'regions' parameter. Read names are UUIDs made
+    from the order the reads are written in, so they look random but the same regions
+    always give the same read names.
     """
     references = sorted(set(x[0] for x in regions if x[0] is not None))
     lengths = [max(2 * (x[1] + x[2]) for x in regions if x[0] is not None)] * len(references)
@@ -128,17 +133,24 @@ def generate_bam_file(bam_file_name, reference_file, regions):
         reference_names=references,
         reference_lengths=lengths
     ) as bam_file:
+        num_reads_written = 0
 
         for chromosome, start_position, read_length, num_reads in regions:
             for read_index in range(num_reads):
+                query_name = "simulated_read_{}".format(
+                    str(uuid.uuid5(uuid.NAMESPACE_OID, str(num_reads_written)))
+                )
+
                 if chromosome is None and start_position is None:
                     new_read = create_unmapped_unpaired_read(
+                        query_name,
                         read_length
                     )
                 else:
                     reference_id = bam_file.get_tid(chromosome)
 
                     new_read = create_perfect_unpaired_read(
+                        query_name,
                         reference_file,
                         reference_id,
                         chromosome,
@@ -147,5 +159,6 @@ def generate_bam_file(bam_file_name, reference_file, regions):
                     )
 
                 bam_file.write(new_read)
+                num_reads_written += 1
 
     pysam.index(bam_file_name)
@@ -4,230 +4,465 @@ Utilities for calculating coverage summaries from a BAM file
 
 from __future__ import division
 
+import collections
+import sys
+import threading
 import tgmi.bamutils
+import tgmi.interval
 import logging
 import output
 from . import transcript
 
 from cpython cimport array
-from libc.stdint cimport uint32_t, uint64_t, uint8_t
+from libc.stdint cimport int16_t, uint32_t, uint64_t, uint8_t
+from posix.time cimport clock_gettime, timespec, CLOCK_MONOTONIC
 
 from pysam.libcalignmentfile cimport IteratorRowRegion
 
 from pysam.libcalignmentfile cimport AlignmentFile, AlignedSegment, bam1_t, BAM_CIGAR_MASK,\
-    BAM_CIGAR_SHIFT, BAM_CINS, BAM_CSOFT_CLIP, BAM_CREF_SKIP, BAM_CMATCH, BAM_CDEL, BAM_FDUP,\
+    BAM_CIGAR_SHIFT, BAM_CINS, BAM_CSOFT_CLIP, BAM_CREF_SKIP, BAM_CMATCH, BAM_CDEL,\
     BAM_FREVERSE, bam_endpos
 
 from pysam.libchtslib cimport BGZF, hts_get_bgzfp, hts_itr_t, hts_idx_t, htsFile, hts_itr_next, bam_get_qual,\
-    bam_get_qname
+    bam_get_qname, bam_get_cigar, bam_init1, bam_destroy1, sam_read1
 
-from .reads cimport ReadArray
+from .fetch cimport MultiRegionIterator, ReadCounter
+from .fetch import load_index_stats
+from .reads cimport ReadArray, ReadArrayPool, ReadFilter, DepthCap, ReadWindow, CompactRead, get_compact_read_cigar, get_compact_read_qual
 from .statistics cimport QualityHistogramArray
 
+cdef extern from "stdlib.h" nogil:
+    void qsort(void*, size_t, size_t, int(*)(const void*, const void*))
+
+cdef extern from "string.h" nogil:
+    int memcmp(const void*, const void*, size_t)
+
 _logger = logging.getLogger("coverview_")
 
 
+cdef int compare_alignments(const void* a, const void* b) nogil:
+    """
+    Order pointers to CompactReads by their alignment: start, end, strand, mapping
+    quality, sample level and CIGAR. Reads which compare equal differ only in their base
+    qualities.
+    """
+    cdef CompactRead* x = (<CompactRead**>a)[0]
+    cdef CompactRead* y = (<CompactRead**>b)[0]
+
+    if x.pos != y.pos:
+        return -1 if x.pos < y.pos else 1
+
+    if x.end != y.end:
+        return -1 if x.end < y.end else 1
+
+    if x.flag & BAM_FREVERSE != y.flag & BAM_FREVERSE:
+        return -1 if x.flag & BAM_FREVERSE == 0 else 1
+
+    if x.mapq != y.mapq:
+        return -1 if x.mapq < y.mapq else 1
+
+    if x.sample_level != y.sample_level:
+        return -1 if x.sample_level < y.sample_level else 1
+
+    if x.n_cigar != y.n_cigar:
+        return -1 if x.n_cigar < y.n_cigar else 1
+
+    return memcmp(get_compact_read_cigar(x), get_compact_read_cigar(y), x.n_cigar * sizeof(uint32_t))
+
+
 cdef class RegionCoverageCalculator(object):
     """
     Utility class for computing coverage summaries for a specified genomic
-    region
+    region. The quality histograms are only kept for one tile of at most
+    tile_size bases at a time, so large regions can be processed tile by tile
+    with bounded memory.
+
+    Only the per-strand counters and histograms are updated as reads are added.
+    The histograms are strand-indexed, with the forward strand histogram for a
+    base at index hist_offset and the reverse strand one at tile_size + hist_offset,
+    and the combined metrics are derived from the two strands when the summary
+    statistics for a tile are computed.
+
+    Coverage from aligned, deleted and skipped runs of bases, and the mapping quality
+    histograms, are recorded as the differences between consecutive bases, so each CIGAR
+    operation only updates the start and end of its run. The differences are summed into
+    the per-base arrays when the summary statistics for a tile are computed. Reference
+    skips (N operations) are left out of the coverage if count_ref_skips is False.
+
+    When directional is False the forward and reverse strand data are never
+    allocated or computed. The counters and histograms are then kept for both
+    strands together, and the per-strand fields of the coverage summary are None.
+
+    If extrapolate_coverage is True, each read kept by a DepthCap at sample level k adds
+    2^k to the total coverage, so COV estimates the depth before capping. All the other
+    metrics are computed from the reads which were kept.
     """
     cdef int begin
     cdef int end
+    cdef int tile_begin
+    cdef int tile_end
+    cdef int tile_size
+    cdef int directional
+    cdef int count_ref_skips
+    cdef int extrapolate_coverage
     cdef int bq_cutoff
     cdef int mq_cutoff
-    cdef int n_reads_in_region, n_reads_in_region_f, n_reads_in_region_r
-    cdef int count_duplicates
+    cdef int n_reads_in_region_f, n_reads_in_region_r
     cdef array.array COV, QCOV, MEDBQ, FLBQ, MEDMQ, FLMQ
     cdef array.array COV_f, QCOV_f, MEDBQ_f, FLBQ_f, MEDMQ_f, FLMQ_f
     cdef array.array COV_r, QCOV_r, MEDBQ_r, FLBQ_r, MEDMQ_r, FLMQ_r
-    cdef QualityHistogramArray bq_hists, bq_hists_f, bq_hists_r
-    cdef QualityHistogramArray mq_hists, mq_hists_f, mq_hists_r
+    cdef QualityHistogramArray bq_hists
+    cdef QualityHistogramArray mq_hists
+    cdef array.array cov_runs
+    cdef array.array qcov_runs
 
-    def __init__(self, chrom, begin, end, bq_cutoff, mq_cutoff, count_duplicates):
+    def __init__(self, chrom, begin, end, bq_cutoff, mq_cutoff, tile_size=0, directional=True, count_ref_skips=True,
+                 extrapolate_coverage=False):
         cdef int bases_in_region = end - begin
+        cdef int num_strands = 2 if directional else 1
+
+        if tile_size <= 0 or tile_size > bases_in_region:
+            tile_size = bases_in_region
+
         self.begin = begin
         self.end = end
+        self.tile_size = tile_size
+        self.directional = directional
+        self.count_ref_skips = count_ref_skips
+        self.extrapolate_coverage = extrapolate_coverage
+        self.tile_begin = begin
+        self.tile_end = begin + tile_size
         self.bq_cutoff = bq_cutoff
         self.mq_cutoff = mq_cutoff
-        self.n_reads_in_region = 0
         self.n_reads_in_region_f = 0
         self.n_reads_in_region_r = 0
 
         self.COV = array.array('l', [0] * bases_in_region)
-        self.COV_f = array.array('l', [0] * bases_in_region)
-        self.COV_r = array.array('l', [0] * bases_in_region)
-
         self.QCOV = array.array('l', [0] * bases_in_region)
-        self.QCOV_f = array.array('l', [0] * bases_in_region)
-        self.QCOV_r = array.array('l', [0] * bases_in_region)
-
         self.MEDBQ = array.array('f', [float('NaN')] * bases_in_region)
-        self.MEDBQ_f = array.array('f', [float('NaN')] * bases_in_region)
-        self.MEDBQ_r = array.array('f', [float('NaN')] * bases_in_region)
-
         self.FLBQ = array.array('f', [float('NaN')] * bases_in_region)
-        self.FLBQ_f = array.array('f', [float('NaN')] * bases_in_region)
-        self.FLBQ_r = array.array('f', [float('NaN')] * bases_in_region)
-
         self.MEDMQ = array.array('f', [float('NaN')] * bases_in_region)
-        self.MEDMQ_f = array.array('f', [float('NaN')] * bases_in_region)
-        self.MEDMQ_r = array.array('f', [float('NaN')] * bases_in_region)
-
         self.FLMQ = array.array('f', [float('NaN')] * bases_in_region)
-        self.FLMQ_f = array.array('f', [float('NaN')] * bases_in_region)
-        self.FLMQ_r = array.array('f', [float('NaN')] * bases_in_region)
-
-        self.bq_hists = QualityHistogramArray(bases_in_region)
-        self.bq_hists_f = QualityHistogramArray(bases_in_region)
-        self.bq_hists_r = QualityHistogramArray(bases_in_region)
-        self.mq_hists = QualityHistogramArray(bases_in_region)
-        self.mq_hists_f = QualityHistogramArray(bases_in_region)
-        self.mq_hists_r = QualityHistogramArray(bases_in_region)
-
-        if count_duplicates is True:
-            self.count_duplicates = 1
-        else:
-            self.count_duplicates = 0
 
-    cdef void add_reads(self, bam1_t** reads_start, bam1_t** reads_end):
+        if directional:
+            self.COV_f = array.array('l', [0] * bases_in_region)
+            self.COV_r = array.array('l', [0] * bases_in_region)
+
+            self.QCOV_f = array.array('l', [0] * bases_in_region)
+            self.QCOV_r = array.array('l', [0] * bases_in_region)
+
+            self.MEDBQ_f = array.array('f', [float('NaN')] * bases_in_region)
+            self.MEDBQ_r = array.array('f', [float('NaN')] * bases_in_region)
+
+            self.FLBQ_f = array.array('f', [float('NaN')] * bases_in_region)
+            self.FLBQ_r = array.array('f', [float('NaN')] * bases_in_region)
+
+            self.MEDMQ_f = array.array('f', [float('NaN')] * bases_in_region)
+            self.MEDMQ_r = array.array('f', [float('NaN')] * bases_in_region)
+
+            self.FLMQ_f = array.array('f', [float('NaN')] * bases_in_region)
+            self.FLMQ_r = array.array('f', [float('NaN')] * bases_in_region)
+
+        self.bq_hists = QualityHistogramArray(num_strands * tile_size)
+        self.mq_hists = QualityHistogramArray(num_strands * tile_size)
+        self.cov_runs = array.array('l', [0] * (num_strands * tile_size))
+        self.qcov_runs = array.array('l', [0] * (num_strands * tile_size))
+
+    cdef void start_tile(self, int tile_begin) nogil:
+        """
+        Move on to the tile starting at tile_begin. The histograms of the previous
+        tile are discarded, so its summary statistics must already have been computed.
+        """
+        self.tile_begin = tile_begin
+        self.tile_end = min(tile_begin + self.tile_size, self.end)
+        self.bq_hists.reset()
+        self.mq_hists.reset()
+
+    cdef void add_reads(self, CompactRead** reads_start, CompactRead** reads_end) nogil:
+        """
+        Add all reads in the window [reads_start, reads_end) and compute the
+        summary statistics for the current tile.
+        """
+        cdef CompactRead* read
+        cdef uint8_t* base_qualities
+
+        while reads_start != reads_end:
+            read = reads_start[0]
+            base_qualities = get_compact_read_qual(read)
+
+            self.add_alignment(
+                read.pos,
+                read.end,
+                read.flag,
+                read.mapq,
+                read.n_cigar,
+                get_compact_read_cigar(read),
+                &base_qualities,
+                1,
+                read.sample_level
+            )
+
+            reads_start += 1
+
+        self.compute_summary_statistics_for_tile()
+
+    cdef void add_collapsed_reads(
+            self,
+            CompactRead** reads_start,
+            CompactRead** reads_end,
+            uint8_t** base_qualities
+    ) nogil:
         """
+        As add_reads, but reads with the same alignment (start, end, strand, mapping
+        quality and CIGAR), as is typical of amplicon data, are added together: the
+        coverage and mapping quality are updated once with the number of reads, and only
+        the base qualities are added read by read. The window is sorted in place to bring
+        these reads together. 'base_qualities' must have room for a pointer per read.
         """
-        cdef int region_size = self.end - self.begin
-        cdef int begin = self.begin
-        cdef int end = self.end
+        cdef CompactRead* read
+        cdef CompactRead** group_end
+        cdef int multiplicity
+
+        qsort(reads_start, reads_end - reads_start, sizeof(CompactRead*), compare_alignments)
+
+        while reads_start != reads_end:
+            read = reads_start[0]
+            group_end = reads_start
+            multiplicity = 0
+
+            while group_end != reads_end and compare_alignments(reads_start, group_end) == 0:
+                base_qualities[multiplicity] = get_compact_read_qual(group_end[0])
+                multiplicity += 1
+                group_end += 1
+
+            self.add_alignment(
+                read.pos,
+                read.end,
+                read.flag,
+                read.mapq,
+                read.n_cigar,
+                get_compact_read_cigar(read),
+                base_qualities,
+                multiplicity,
+                read.sample_level
+            )
+
+            reads_start = group_end
+
+        self.compute_summary_statistics_for_tile()
+
+    cdef void add_read(self, bam1_t* src) nogil:
+        """
+        Add a single read straight from a BAM record.
+        """
+        cdef uint8_t* base_qualities = bam_get_qual(src)
+
+        self.add_alignment(
+            src.core.pos,
+            bam_endpos(src),
+            src.core.flag,
+            src.core.qual,
+            src.core.n_cigar,
+            bam_get_cigar(src),
+            &base_qualities,
+            1,
+            0
+        )
+
+    cdef void add_alignment(
+            self,
+            int read_begin,
+            int read_end,
+            int flag,
+            int mapping_quality,
+            uint32_t n_cigar,
+            uint32_t* cigar_p,
+            uint8_t** base_qualities,
+            int multiplicity,
+            int sample_level
+    ) nogil:
+        """
+        Add the coverage and quality data from 'multiplicity' reads with the same
+        alignment to the per-base arrays and histograms of the current tile, where
+        base_qualities holds the base qualities of each read, and sample_level is the
+        level at which the reads were kept by a DepthCap. Reads which do not
+        overlap the tile are ignored. A read is counted in the tile containing its
+        first base inside the region, so reads spanning several tiles are only counted
+        once. Unwanted reads have already been discarded by the ReadFilter when the
+        reads were loaded.
+        """
+        cdef int begin = self.tile_begin
+        cdef int end = self.tile_end
+        cdef int region_begin = self.begin
         cdef int bq_cutoff = self.bq_cutoff
         cdef int mq_cutoff = self.mq_cutoff
-        cdef long* COV = self.COV.data.as_longs
-        cdef long* COV_f = self.COV_f.data.as_longs
-        cdef long* COV_r = self.COV_r.data.as_longs
-        cdef long* QCOV = self.QCOV.data.as_longs
-        cdef long* QCOV_f = self.QCOV_f.data.as_longs
-        cdef long* QCOV_r = self.QCOV_r.data.as_longs
+        cdef int tile_length = end - begin
+        cdef int mapping_quality_passes = mapping_quality >= mq_cutoff
+        cdef long coverage_weight = multiplicity
+        cdef long* QCOV
+        cdef long* cov_runs
+        cdef long* qcov_runs
         cdef int index
+        cdef int offset
         cdef int base_quality
-        cdef int mapping_quality
+        cdef uint8_t* read_qualities
+        cdef int r
         cdef uint32_t k, i
-        cdef uint32_t pos, n_cigar
+        cdef uint32_t pos
         cdef int op,l
-        cdef uint32_t* cigar_p
-        cdef bam1_t* src
-        cdef uint8_t* base_qualities
-        cdef int iterator_status = 0
-        cdef int is_forward_read = 0
+        cdef int run_begin
+        cdef int run_end
+        cdef int mq_run_begin = -1
+        cdef int mq_run_end = -1
+        cdef int strand_hist_offset
+
+        if read_begin >= end:
+            return
+
+        if read_end <= begin:
+            return
+
+        # Reverse bit is set, so read is reverse. Only the counters and histograms
+        # for the read's own strand are updated.
+        if not self.directional:
+            QCOV = self.QCOV.data.as_longs
+            strand_hist_offset = 0
+        elif flag & BAM_FREVERSE != 0:
+            QCOV = self.QCOV_r.data.as_longs
+            strand_hist_offset = self.tile_size
+        else:
+            QCOV = self.QCOV_f.data.as_longs
+            strand_hist_offset = 0
 
-        while reads_start != reads_end:
+        if self.extrapolate_coverage:
+            coverage_weight <<= sample_level
 
-            src = reads_start[0]
+        cov_runs = self.cov_runs.data.as_longs + strand_hist_offset
+        qcov_runs = self.qcov_runs.data.as_longs + strand_hist_offset
 
-            if src.core.pos >= end:
-                reads_start += 1
-                continue
+        if max(read_begin, region_begin) >= begin:
+            if flag & BAM_FREVERSE == 0:
+                self.n_reads_in_region_f += multiplicity
+            else:
+                self.n_reads_in_region_r += multiplicity
 
-            if bam_endpos(src) <= begin:
-                reads_start += 1
-                continue
+        pos = read_begin
+        index = 0
 
-            # Skip duplicate reads
-            if self.count_duplicates == 0 and src.core.flag & BAM_FDUP != 0:
-                reads_start += 1
-                continue
+        for k from 0 <= k < n_cigar:
+            op = cigar_p[k] & BAM_CIGAR_MASK
+            l = cigar_p[k] >> BAM_CIGAR_SHIFT
 
-            # Reverse bit is set, so read is reverse
-            if src.core.flag & BAM_FREVERSE != 0:
-                is_forward_read = 0
-            else:
-                is_forward_read = 1
+            if op == BAM_CSOFT_CLIP or op == BAM_CINS:
+                index += l
+            elif op == BAM_CMATCH or op == BAM_CDEL or op == BAM_CREF_SKIP:
+                # The part of the run inside the tile, in tile coordinates. A run ending
+                # at the end of the tile needs no end marker.
+                run_begin = max(<int>pos, begin) - begin
+                run_end = min(<int>(pos + l), end) - begin
 
-            n_cigar = src.core.n_cigar
+                if run_begin < run_end and (op != BAM_CREF_SKIP or self.count_ref_skips):
+                    cov_runs[run_begin] += coverage_weight
 
-            # This is an unmapped read whose mate is mapped in this region. Skip these.
-            if n_cigar == 0:
-                reads_start += 1
-                continue
+                    if run_end < tile_length:
+                        cov_runs[run_end] -= coverage_weight
 
-            # _logger.info("Read. Start = {}. End = {}. Name = {}. ISize = {}".format(
-            #     src.core.pos,
-            #     bam_endpos(src),
-            #     bam_get_qname(src),
-            #     src.core.isize
-            # ))
+                    if op == BAM_CMATCH:
+                        # Mapping quality is the same for every base of the read, so
+                        # matches separated only by insertions or soft-clips are
+                        # joined into one run, which is recorded when it is broken by
+                        # a deletion or skip, or when the read ends.
+                        if run_begin != mq_run_end:
+                            if mq_run_begin != -1:
+                                self.mq_hists.add_data_to_run(
+                                    strand_hist_offset + mq_run_begin,
+                                    strand_hist_offset + mq_run_end,
+                                    mapping_quality,
+                                    multiplicity
+                                )
 
-            self.n_reads_in_region += 1
+                            mq_run_begin = run_begin
 
-            if is_forward_read:
-                self.n_reads_in_region_f += 1
-            else:
-                self.n_reads_in_region_r += 1
+                        mq_run_end = run_end
 
-            mapping_quality = src.core.qual
-            base_qualities = bam_get_qual(src)
-            pos = src.core.pos
-            cigar_p = <uint32_t*> (src.data + src.core.l_qname)
-            index = 0
+                        for r from 0 <= r < multiplicity:
+                            read_qualities = base_qualities[r]
 
-            for k from 0 <= k < n_cigar:
-                op = cigar_p[k] & BAM_CIGAR_MASK
-                l = cigar_p[k] >> BAM_CIGAR_SHIFT
+                            for i from run_begin + begin <= i < run_end + begin:
+                                base_quality = read_qualities[index + (i-pos)]
+                                self.bq_hists.add_data(strand_hist_offset + i - begin, base_quality)
 
-                if op == BAM_CSOFT_CLIP or op == BAM_CINS:
-                    index += l
-                elif op == BAM_CMATCH:
-                    for i from pos <= i < pos + l:
-                        if begin <= i < end:
-                            offset = i - begin
-                            base_quality = base_qualities[index + (i-pos)]
-
-                            self.bq_hists.add_data(offset, base_quality)
-                            self.mq_hists.add_data(offset, mapping_quality)
-                            COV[offset] += 1
-
-                            if is_forward_read:
-                                self.bq_hists_f.add_data(offset, base_quality)
-                                self.mq_hists_f.add_data(offset, mapping_quality)
-                                COV_f[offset] += 1
-                            else:
-                                self.bq_hists_r.add_data(offset, base_quality)
-                                self.mq_hists_r.add_data(offset, mapping_quality)
-                                COV_r[offset] += 1
-
-
-                            if mapping_quality >= mq_cutoff and base_quality >= bq_cutoff:
-                                QCOV[offset] += 1
-
-                                if is_forward_read:
-                                    QCOV_f[offset] += 1
-                                else:
-                                    QCOV_r[offset] += 1
-
-                    pos += l
-                    index += l
+                                if mapping_quality_passes and base_quality >= bq_cutoff:
+                                    offset = i - region_begin
+                                    QCOV[offset] += 1
 
-                elif op == BAM_CDEL or op == BAM_CREF_SKIP:
-                    for i from pos <= i < pos + l:
-                        if begin <= i < end:
-                            offset = i - begin
-                            COV[offset] += 1
+                    elif mapping_quality_passes:
+                        qcov_runs[run_begin] += multiplicity
 
-                            if is_forward_read:
-                                COV_f[offset] += 1
-                            else:
-                                COV_r[offset] += 1
+                        if run_end < tile_length:
+                            qcov_runs[run_end] -= multiplicity
 
-                            if mapping_quality >= mq_cutoff:
-                                QCOV[offset] += 1
+                if op == BAM_CMATCH:
+                    index += l
 
-                                if is_forward_read:
-                                    QCOV_f[offset] += 1
-                                else:
-                                    QCOV_r[offset] += 1
+                pos += l
 
-                    pos += l
-            reads_start += 1
+        if mq_run_begin != -1:
+            self.mq_hists.add_data_to_run(
+                strand_hist_offset + mq_run_begin,
+                strand_hist_offset + mq_run_end if mq_run_end < tile_length else -1,
+                mapping_quality,
+                multiplicity
+            )
+
+    cdef void sum_runs_for_tile(self) nogil:
+        """
+        Add the coverage runs recorded for the current tile to the per-base coverage
+        arrays, and convert the mapping quality runs into histograms.
+        """
+        cdef int tile_length = self.tile_end - self.tile_begin
+        cdef int first_offset = self.tile_begin - self.begin
+        cdef int reverse_offset = self.tile_size
+
+        if not self.directional:
+            add_runs_to_coverage(self.cov_runs.data.as_longs, self.COV.data.as_longs + first_offset, tile_length)
+            add_runs_to_coverage(self.qcov_runs.data.as_longs, self.QCOV.data.as_longs + first_offset, tile_length)
+            self.mq_hists.sum_runs(0, tile_length)
+            return
+
+        add_runs_to_coverage(self.cov_runs.data.as_longs, self.COV_f.data.as_longs + first_offset, tile_length)
+        add_runs_to_coverage(self.qcov_runs.data.as_longs, self.QCOV_f.data.as_longs + first_offset, tile_length)
+        add_runs_to_coverage(
+            self.cov_runs.data.as_longs + reverse_offset, self.COV_r.data.as_longs + first_offset, tile_length
+        )
+        add_runs_to_coverage(
+            self.qcov_runs.data.as_longs + reverse_offset, self.QCOV_r.data.as_longs + first_offset, tile_length
+        )
+        self.mq_hists.sum_runs(0, tile_length)
+        self.mq_hists.sum_runs(reverse_offset, reverse_offset + tile_length)
 
-        self.compute_summary_statistics_for_region()
+    cdef void compute_summary_statistics_for_tile(self) nogil:
+        """
+        Fill in the per-base summary statistics for the current tile. The combined
+        coverage and quality metrics are derived here by adding the two strands.
+        """
+        self.sum_runs_for_tile()
+
+        if not self.directional:
+            self.compute_non_directional_summary_statistics_for_tile()
+            return
 
-    cdef void compute_summary_statistics_for_region(self):
+        cdef int i
+        cdef int offset
+        cdef int reverse_i
+        cdef int bq_cutoff = self.bq_cutoff
+        cdef int mq_cutoff = self.mq_cutoff
+        cdef long* COV = self.COV.data.as_longs
+        cdef long* COV_f = self.COV_f.data.as_longs
+        cdef long* COV_r = self.COV_r.data.as_longs
+        cdef long* QCOV = self.QCOV.data.as_longs
+        cdef long* QCOV_f = self.QCOV_f.data.as_longs
+        cdef long* QCOV_r = self.QCOV_r.data.as_longs
         cdef float* MEDBQ = self.MEDBQ.data.as_floats
         cdef float* MEDBQ_f = self.MEDBQ_f.data.as_floats
         cdef float* MEDBQ_r = self.MEDBQ_r.data.as_floats
@@ -244,26 +479,82 @@ cdef class RegionCoverageCalculator(object):
         cdef float* FLMQ_f = self.FLMQ_f.data.as_floats
         cdef float* FLMQ_r = self.FLMQ_r.data.as_floats
 
-        for i in range(self.end - self.begin):
-            MEDBQ[i] = self.bq_hists.compute_median(i)
-            MEDBQ_f[i] = self.bq_hists_f.compute_median(i)
-            MEDBQ_r[i] = self.bq_hists_r.compute_median(i)
+        for i in range(self.tile_end - self.tile_begin):
+            offset = i + self.tile_begin - self.begin
+            reverse_i = self.tile_size + i
+
+            COV[offset] = COV_f[offset] + COV_r[offset]
+            QCOV[offset] = QCOV_f[offset] + QCOV_r[offset]
+
+            MEDBQ[offset] = self.bq_hists.compute_median_of_pair(i, reverse_i)
+            MEDBQ_f[offset] = self.bq_hists.compute_median(i)
+            MEDBQ_r[offset] = self.bq_hists.compute_median(reverse_i)
+
+            MEDMQ[offset] = self.mq_hists.compute_median_of_pair(i, reverse_i)
+            MEDMQ_f[offset] = self.mq_hists.compute_median(i)
+            MEDMQ_r[offset] = self.mq_hists.compute_median(reverse_i)
+
+            FLBQ[offset] = self.bq_hists.compute_fraction_below_threshold_of_pair(i, reverse_i, bq_cutoff)
+            FLBQ_f[offset] = self.bq_hists.compute_fraction_below_threshold(i, bq_cutoff)
+            FLBQ_r[offset] = self.bq_hists.compute_fraction_below_threshold(reverse_i, bq_cutoff)
+
+            FLMQ[offset] = self.mq_hists.compute_fraction_below_threshold_of_pair(i, reverse_i, mq_cutoff)
+            FLMQ_f[offset] = self.mq_hists.compute_fraction_below_threshold(i, mq_cutoff)
+            FLMQ_r[offset] = self.mq_hists.compute_fraction_below_threshold(reverse_i, mq_cutoff)
+
+    cdef void compute_non_directional_summary_statistics_for_tile(self) nogil:
+        cdef int i
+        cdef int offset
+        cdef int bq_cutoff = self.bq_cutoff
+        cdef int mq_cutoff = self.mq_cutoff
+        cdef float* MEDBQ = self.MEDBQ.data.as_floats
+        cdef float* MEDMQ = self.MEDMQ.data.as_floats
+        cdef float* FLBQ = self.FLBQ.data.as_floats
+        cdef float* FLMQ = self.FLMQ.data.as_floats
 
-            MEDMQ[i] = self.mq_hists.compute_median(i)
-            MEDMQ_f[i] = self.mq_hists_f.compute_median(i)
-            MEDMQ_r[i] = self.mq_hists_r.compute_median(i)
+        for i in range(self.tile_end - self.tile_begin):
+            offset = i + self.tile_begin - self.begin
+            MEDBQ[offset] = self.bq_hists.compute_median(i)
+            MEDMQ[offset] = self.mq_hists.compute_median(i)
+            FLBQ[offset] = self.bq_hists.compute_fraction_below_threshold(i, bq_cutoff)
+            FLMQ[offset] = self.mq_hists.compute_fraction_below_threshold(i, mq_cutoff)
 
-            FLBQ[i] = self.bq_hists.compute_fraction_below_threshold(i, <int>(self.bq_cutoff))
-            FLBQ_f[i] = self.bq_hists_f.compute_fraction_below_threshold(i, <int>(self.bq_cutoff))
-            FLBQ_r[i] = self.bq_hists_r.compute_fraction_below_threshold(i, <int>(self.bq_cutoff))
+    def get_coverage_summary_for_interval(self, int begin, int end, int n_reads_f, int n_reads_r):
+        """
+        Return the coverage summary of the sub-interval [begin, end) of the region, which
+        overlaps n_reads_f forward and n_reads_r reverse reads. This is used when several
+        overlapping regions share one calculator covering their union.
+        """
+        cdef int slice_begin = begin - self.begin
+        cdef int slice_end = end - self.begin
 
-            FLMQ[i] = self.mq_hists.compute_fraction_below_threshold(i, <int>(self.mq_cutoff))
-            FLMQ_f[i] = self.mq_hists_f.compute_fraction_below_threshold(i, <int>(self.mq_cutoff))
-            FLMQ_r[i] = self.mq_hists_r.compute_fraction_below_threshold(i, <int>(self.mq_cutoff))
+        return PerBaseCoverageSummary(
+            n_reads_f + n_reads_r,
+            n_reads_f,
+            n_reads_r,
+            self.COV[slice_begin:slice_end],
+            self.QCOV[slice_begin:slice_end],
+            self.MEDBQ[slice_begin:slice_end],
+            self.FLBQ[slice_begin:slice_end],
+            self.MEDMQ[slice_begin:slice_end],
+            self.FLMQ[slice_begin:slice_end],
+            slice_or_none(self.COV_f, slice_begin, slice_end),
+            slice_or_none(self.QCOV_f, slice_begin, slice_end),
+            slice_or_none(self.MEDBQ_f, slice_begin, slice_end),
+            slice_or_none(self.FLBQ_f, slice_begin, slice_end),
+            slice_or_none(self.MEDMQ_f, slice_begin, slice_end),
+            slice_or_none(self.FLMQ_f, slice_begin, slice_end),
+            slice_or_none(self.COV_r, slice_begin, slice_end),
+            slice_or_none(self.QCOV_r, slice_begin, slice_end),
+            slice_or_none(self.MEDBQ_r, slice_begin, slice_end),
+            slice_or_none(self.FLBQ_r, slice_begin, slice_end),
+            slice_or_none(self.MEDMQ_r, slice_begin, slice_end),
+            slice_or_none(self.FLMQ_r, slice_begin, slice_end)
+        )
 
     def get_coverage_summary(self):
         return PerBaseCoverageSummary(
-            self.n_reads_in_region,
+            self.n_reads_in_region_f + self.n_reads_in_region_r,
             self.n_reads_in_region_f,
             self.n_reads_in_region_r,
             self.COV,
@@ -287,16 +578,193 @@ cdef class RegionCoverageCalculator(object):
         )
 
 
-cdef void load_reads_into_array(ReadArray read_array, bam_file, chrom, start, end):
+cdef void add_runs_to_coverage(long* runs, long* coverage, int n_bases) nogil:
+    """
+    Add the cumulative sum of the run start and end markers in 'runs' to 'coverage',
+    and clear the markers.
+    """
+    cdef long depth = 0
+    cdef int i
+
+    for i from 0 <= i < n_bases:
+        depth += runs[i]
+        coverage[i] += depth
+        runs[i] = 0
+
+
+cdef object slice_or_none(array.array values, int begin, int end):
+    if values is None:
+        return None
+
+    return values[begin:end]
+
+
+cdef inline double get_time() nogil:
+    cdef timespec now
+    clock_gettime(CLOCK_MONOTONIC, &now)
+    return now.tv_sec + 1e-9 * now.tv_nsec
+
+
+cdef class CoverageTimer:
     """
-    Load a chunk of BAM data into an in-memory read array
+    Accumulates the time spent reading reads from the input file, which is mostly
+    decompression, and the time spent in the coverage calculation itself. Used to
+    decide whether more decompression threads would help. Reads are prefetched in the
+    background while the coverage is calculated, so the two times overlap; the waiting
+    time is the time spent blocked on reads which were not ready yet.
+
+    Also counts how often moving to the next part of the file could re-use the BGZF
+    block which was already decompressed, and how often a block had to be loaded.
+    """
+    cdef public double reading_time
+    cdef public double kernel_time
+    cdef public double waiting_time
+    cdef public long block_reuses
+    cdef public long block_loads
+
+    def __init__(self):
+        self.reading_time = 0.0
+        self.kernel_time = 0.0
+        self.waiting_time = 0.0
+        self.block_reuses = 0
+        self.block_loads = 0
+
+
+# Bytes used per base of a tile of a RegionCoverageCalculator for each strand kept (the
+# base and mapping quality histograms and the coverage runs), and by each set of six
+# per-base output arrays. The directional kernel keeps two strands and three sets of
+# arrays (combined, forward and reverse), the non-directional one a single strand and
+# one set of arrays. The size of a quality histogram depends on the range of qualities
+# seen and the depth, and is typically 64 bins of counts widened to 16 bits.
+cdef long HISTOGRAM_BYTES_PER_BASE = 64 * sizeof(int16_t) + sizeof(int)
+cdef long TILE_BYTES_PER_BASE_PER_STRAND = 2 * HISTOGRAM_BYTES_PER_BASE + 2 * sizeof(long)
+cdef long PER_BASE_ARRAY_BYTES_PER_BASE = 2 * sizeof(long) + 4 * sizeof(float)
+
+
+cdef long get_tile_bytes_per_base(int directional):
+    return (2 if directional else 1) * TILE_BYTES_PER_BASE_PER_STRAND
+
+
+cdef long get_per_base_array_bytes_per_base(int directional):
+    return (3 if directional else 1) * PER_BASE_ARRAY_BYTES_PER_BASE
+
+# Rough size of one read in a ReadArray, including its CIGAR, qualities and pointers. The
+# slab grows by doubling, so up to twice this much may be allocated per read.
+cdef long READ_ARRAY_BYTES_PER_READ = 256
+
+
+cdef class MemoryBudget:
+    """
+    Limit on the memory used for the reads and per-base histograms of one cluster,
+    and the peak memory actually used. A limit of 0 means no limit. A quarter of the
+    budget is set aside for the histograms, which sets the size of the tiles that
+    large regions are processed in, and the rest for the reads of two clusters: the
+    one being processed and the one being prefetched. The histograms are shared
+    between the num_calculators regions which may be calculated at the same time.
+
+    Clusters with more reads than fit in the budget are loaded one tile at a time. The
+    per-base results of a region are always kept in full until they are written out,
+    so the peak can still be more than the limit for very long regions. The largest
+    amount of memory needed for the per-base results of one region is recorded too.
+    """
+    cdef public long max_bytes
+    cdef public int tile_size
+    cdef public long peak_bytes
+    cdef public long peak_region_bytes
+    cdef public int num_calculators
+    cdef public int directional
+
+    def __init__(self, long max_bytes=0, directional=True, int num_calculators=1):
+        self.max_bytes = max_bytes
+        self.peak_bytes = 0
+        self.peak_region_bytes = 0
+        self.num_calculators = num_calculators
+        self.directional = directional
+
+        if max_bytes > 0:
+            self.tile_size = max(
+                1000, (max_bytes // 4) // (num_calculators * get_tile_bytes_per_base(directional))
+            )
+        else:
+            self.tile_size = 0
+
+    def get_max_reads(self):
+        """
+        Return the largest number of reads which can be loaded for one cluster within
+        the budget, or None if there is no limit.
+        """
+        if self.max_bytes <= 0:
+            return None
+
+        return max(1, (self.max_bytes - self.max_bytes // 4) // (4 * READ_ARRAY_BYTES_PER_READ))
+
+    def get_max_array_bytes(self):
+        """
+        Return the largest size a ReadArray may keep its buffers at between clusters,
+        or 0 if there is no limit.
+        """
+        return (self.max_bytes - self.max_bytes // 4) // 2
+
+    def should_load_in_tiles(self, int span, estimated_reads):
+        """
+        Returns True if the reads of a cluster spanning 'span' bases should be loaded
+        one tile at a time, because about 'estimated_reads' reads would not fit in the
+        budget. If the reads cannot be estimated, 'estimated_reads' is None and any
+        cluster longer than a tile is loaded in tiles.
+        """
+        if self.max_bytes <= 0 or span <= self.tile_size:
+            return False
+
+        if estimated_reads is None:
+            return True
+
+        return estimated_reads > self.get_max_reads()
+
+    cdef void record_usage(self, long n_bytes):
+        if n_bytes > self.peak_bytes:
+            self.peak_bytes = n_bytes
+
+    cdef void record_region(self, int bases_in_region):
+        cdef long n_bytes = bases_in_region * get_per_base_array_bytes_per_base(self.directional)
+
+        if n_bytes > self.peak_region_bytes:
+            self.peak_region_bytes = n_bytes
+
+
+cdef long get_calculator_memory_usage(int bases_in_region, int tile_size, int directional):
+    if tile_size <= 0 or tile_size > bases_in_region:
+        tile_size = bases_in_region
+
+    return bases_in_region * get_per_base_array_bytes_per_base(directional) + \
+        tile_size * get_tile_bytes_per_base(directional)
+
+
+cdef void load_reads_into_array(
+        ReadArray read_array,
+        ReadFilter read_filter,
+        DepthCap depth_cap,
+        CoverageTimer timer,
+        bam_file,
+        chrom,
+        start,
+        end
+):
+    """
+    Load a chunk of BAM data into an in-memory read array. Reads rejected by the
+    filter, or dropped by the depth cap if there is one, are skipped without being
+    copied.
     """
     cdef int iterator_status = 0
+    cdef int sample_level = 0
+    cdef double start_time = get_time()
 
     _logger.info("Loading data for %s:%s-%s", chrom, start, end)
 
     cdef IteratorRowRegion read_iterator = bam_file.fetch(chrom, start, end)
 
+    if depth_cap is not None:
+        depth_cap.start_region(bam_file.get_tid(chrom), start)
+
     while True:
         iterator_status = hts_itr_next(
             hts_get_bgzfp(read_iterator.htsfile),
@@ -308,10 +776,216 @@ cdef void load_reads_into_array(ReadArray read_array, bam_file, chrom, start, en
         if iterator_status < 0:
             break
 
-        read_array.append(read_iterator.b)
+        if not read_filter.passes(read_iterator.b):
+            continue
 
+        if depth_cap is not None:
+            sample_level = depth_cap.select(read_iterator.b)
 
-def get_region_coverage_summary(bam_file, cluster, config):
+            if sample_level == -1:
+                continue
+
+        read_array.append(read_iterator.b, sample_level)
+
+    read_filter.mark_region_as_counted(bam_file.get_tid(chrom), end)
+
+    if depth_cap is not None:
+        depth_cap.mark_region_as_seen(bam_file.get_tid(chrom), end)
+
+    timer.reading_time += get_time() - start_time
+
+
+cdef int load_reads_from_iterator(
+        ReadArray read_array,
+        ReadFilter read_filter,
+        DepthCap depth_cap,
+        CoverageTimer timer,
+        MultiRegionIterator read_iterator,
+        int start,
+        int end
+) except -1:
+    """
+    Load the reads overlapping [start, end) from a multi-region iterator into an
+    in-memory read array, dropping reads as for load_reads_into_array. The first read
+    starting at or after 'end' is left pending in the iterator for the next cluster.
+    Reads which end before 'start' lie between clusters and are skipped without being
+    filtered.
+
+    The GIL is released while reading, so this can run on a background thread.
+    """
+    cdef bam1_t* read = read_iterator.b
+    cdef int cap_depth = depth_cap is not None
+    cdef int sample_level = 0
+    cdef double start_time = get_time()
+
+    if cap_depth:
+        depth_cap.start_region(read_iterator.tid, start)
+
+    with nogil:
+        while True:
+            if read_iterator.has_read == 0:
+                if read_iterator.cnext() < 0:
+                    break
+
+                read_iterator.has_read = 1
+
+            if read.core.pos >= end:
+                break
+
+            read_iterator.has_read = 0
+
+            if bam_endpos(read) <= start:
+                continue
+
+            if read_filter.passes(read) == 0:
+                continue
+
+            if cap_depth:
+                sample_level = depth_cap.select(read)
+
+                if sample_level == -1:
+                    continue
+
+            read_array.append(read, sample_level)
+
+    read_filter.mark_region_as_counted(read_iterator.tid, end)
+
+    if depth_cap is not None:
+        depth_cap.mark_region_as_seen(read_iterator.tid, end)
+
+    timer.reading_time += get_time() - start_time
+    return 0
+
+
+class ReadPrefetchThread(threading.Thread):
+    """
+    Loads the reads of the next cluster from a MultiRegionIterator on a background
+    thread. Any exception is re-raised by wait().
+    """
+    def __init__(self, read_array, read_filter, depth_cap, timer, read_iterator, start, end):
+        super(ReadPrefetchThread, self).__init__(name="CoverView read prefetch")
+        self.daemon = True
+        self.read_array = read_array
+        self.read_filter = read_filter
+        self.depth_cap = depth_cap
+        self.timer = timer
+        self.read_iterator = read_iterator
+        self.start_pos = start
+        self.end_pos = end
+        self.error = None
+
+    def run(self):
+        try:
+            load_reads_from_iterator(
+                self.read_array,
+                self.read_filter,
+                self.depth_cap,
+                self.timer,
+                self.read_iterator,
+                self.start_pos,
+                self.end_pos
+            )
+        except Exception:
+            self.error = sys.exc_info()
+
+    def wait(self):
+        self.join()
+
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+
+
+cdef class TileReadLoader:
+    """
+    Loads the reads of a cluster which does not fit in the memory budget one tile at a
+    time, so that only the reads overlapping the current tile are held in memory. Tiles
+    must be loaded in order of their start.
+
+    Reads are taken from 'read_iterator' if it is given. 'read_array' then already holds
+    the reads starting before 'loaded_until', and reads which end after the start of
+    the next tile are carried over into it. Otherwise, the reads of each tile are
+    fetched from 'bam_file', and reads spanning several tiles are fetched again.
+    """
+    cdef public ReadArray read_array
+    cdef ReadArrayPool read_array_pool
+    cdef ReadFilter read_filter
+    cdef DepthCap depth_cap
+    cdef CoverageTimer timer
+    cdef MemoryBudget memory_budget
+    cdef MultiRegionIterator read_iterator
+    cdef object bam_file
+    cdef object chrom
+    cdef int loaded_until
+
+    def __init__(
+            self,
+            ReadArray read_array,
+            ReadArrayPool read_array_pool,
+            ReadFilter read_filter,
+            DepthCap depth_cap,
+            CoverageTimer timer,
+            MemoryBudget memory_budget,
+            chrom,
+            int loaded_until,
+            MultiRegionIterator read_iterator=None,
+            bam_file=None
+    ):
+        self.read_array = read_array
+        self.read_array_pool = read_array_pool
+        self.read_filter = read_filter
+        self.depth_cap = depth_cap
+        self.timer = timer
+        self.memory_budget = memory_budget
+        self.chrom = chrom
+        self.loaded_until = loaded_until
+        self.read_iterator = read_iterator
+        self.bam_file = bam_file
+
+    cdef ReadArray load_tile(self, int tile_begin, int tile_end):
+        """
+        Return a ReadArray holding all the reads which overlap [tile_begin, tile_end).
+        The array from the previous tile must no longer be used.
+        """
+        cdef ReadArray next_read_array
+
+        if tile_end <= self.loaded_until:
+            return self.read_array
+
+        if self.read_iterator is None:
+            self.read_array.clear()
+            load_reads_into_array(
+                self.read_array, self.read_filter, self.depth_cap, self.timer, self.bam_file, self.chrom,
+                tile_begin, tile_end
+            )
+        else:
+            next_read_array = self.read_array_pool.acquire(self.chrom, tile_begin, tile_end)
+            self.read_array.copy_reads_ending_after(tile_begin, next_read_array)
+            self.read_array_pool.release(self.read_array)
+            self.read_array = next_read_array
+            load_reads_from_iterator(
+                self.read_array, self.read_filter, self.depth_cap, self.timer, self.read_iterator,
+                tile_begin, tile_end
+            )
+
+        self.loaded_until = tile_end
+        return self.read_array
+
+    cdef void record_usage(self, long calculator_bytes):
+        self.memory_budget.record_usage(self.read_array.get_memory_usage() + calculator_bytes)
+
+
+def get_region_coverage_summary(
+        bam_file,
+        cluster,
+        config,
+        ReadFilter read_filter,
+        CoverageTimer timer,
+        MemoryBudget memory_budget,
+        ReadArrayPool read_array_pool,
+        DepthCap depth_cap=None,
+        region_thread_pool=None,
+        collapse_reads=False
+):
     """
     Calculate and return coverage metrics for a specified region. Metrics include total
     coverage, coverage above the required base-quality and mapping quality threshold, fractions of
@@ -322,60 +996,862 @@ def get_region_coverage_summary(bam_file, cluster, config):
     currently spent in this function.
     
     """
-    cdef ReadArray read_array = ReadArray(100)
-    cdef bam1_t** reads_start
-    cdef bam1_t** reads_end
+    cdef ReadArray read_array
+    cdef TileReadLoader loader
 
     cluster_chrom = tgmi.bamutils.get_valid_chromosome_name(cluster[0].chromosome, bam_file)
     cluster_begin = cluster[0].start_pos
-    cluster_end = cluster[-1].end_pos
+    cluster_end = max(interval.end_pos for interval in cluster)
 
     _logger.debug("Processing cluster of regions spanning {}:{}-{}".format(
         cluster_chrom, cluster_begin, cluster_end
     ))
 
+    if memory_budget.should_load_in_tiles(
+            cluster_end - cluster_begin, read_array_pool.estimate_reads(cluster_chrom, cluster_begin, cluster_end)):
+        _logger.debug("Loading reads one tile at a time")
+
+        loader = TileReadLoader(
+            read_array_pool.acquire(cluster_chrom, cluster_begin, cluster_begin + memory_budget.tile_size),
+            read_array_pool, read_filter, depth_cap, timer, memory_budget, cluster_chrom, cluster_begin,
+            bam_file=bam_file
+        )
+
+        for summary in get_tiled_cluster_coverage_summaries(
+                loader, cluster_chrom, cluster, config, timer, memory_budget, collapse_reads):
+            yield summary
+
+        read_array_pool.release(loader.read_array)
+        return
+
+    read_array = read_array_pool.acquire(cluster_chrom, cluster_begin, cluster_end)
+
     _logger.debug("Loading reads into in-memory array")
 
     load_reads_into_array(
         read_array,
+        read_filter,
+        depth_cap,
+        timer,
         bam_file,
         cluster_chrom,
         cluster_begin,
         cluster_end
     )
 
-    bq_cutoff = float(config['low_bq'])
-    mq_cutoff = float(config['low_mq'])
+    for summary in get_cluster_coverage_summaries(
+            read_array, cluster_chrom, cluster, config, timer, memory_budget, region_thread_pool,
+            collapse_reads):
+        yield summary
 
-    for interval in cluster:
+    read_array_pool.release(read_array)
 
-        if config['outputs']['profiles'] or config['outputs']['regions']:
 
-            coverage_calc = RegionCoverageCalculator(
-                cluster_chrom,
-                interval.start_pos,
-                interval.end_pos,
-                bq_cutoff,
-                mq_cutoff,
-                config['count_duplicate_reads']
+def merge_clusters_starting_in_tiled_clusters(clusters, cluster_spans, load_in_tiles):
+    """
+    Only the reads of the last tile of a cluster loaded in tiles are left in memory
+    once it has been processed, so a cluster starting before the end of such a cluster
+    could not take the reads it shares with it from there. These clusters are merged
+    into the tiled cluster instead. Returns the merged clusters, spans and flags.
+    """
+    merged_clusters = []
+    merged_spans = []
+    merged_load_in_tiles = []
+
+    for cluster, (begin, end), tiled in zip(clusters, cluster_spans, load_in_tiles):
+        if len(merged_clusters) > 0 and merged_load_in_tiles[-1] and begin < merged_spans[-1][1]:
+            merged_clusters[-1] = merged_clusters[-1] + cluster
+            merged_spans[-1] = (merged_spans[-1][0], max(merged_spans[-1][1], end))
+        else:
+            merged_clusters.append(cluster)
+            merged_spans.append((begin, end))
+            merged_load_in_tiles.append(tiled)
+
+    return merged_clusters, merged_spans, merged_load_in_tiles
+
+
+def get_chromosome_cluster_coverage_summaries(
+        bam_file,
+        clusters,
+        config,
+        ReadFilter read_filter,
+        CoverageTimer timer,
+        MemoryBudget memory_budget,
+        ReadArrayPool read_array_pool,
+        DepthCap depth_cap=None,
+        region_thread_pool=None,
+        collapse_reads=False
+):
+    """
+    Calculate coverage metrics for all the clusters of regions on one chromosome, in
+    order. The reads for all the clusters are read through a single MultiRegionIterator,
+    so each BGZF block is decompressed at most once per chromosome, and reads which
+    overlap more than one cluster are copied over from the previous cluster instead of
+    being fetched again. Read arrays are taken from, and given back to, the pool.
+
+    While the coverage of one cluster is calculated and written out, the reads of the
+    next cluster are loaded into a second array on a background thread.
+
+    Files which cannot be read with a MultiRegionIterator are fetched cluster by cluster.
+
+    If 'depth_cap' is given, a deterministic subset of the reads overlapping the targets
+    is loaded wherever the depth is more than its maximum.
+
+    Clusters with more reads than fit in the memory budget are loaded one tile at a
+    time, and the reads of the next cluster are only loaded once the last tile has been.
+    """
+    cdef MultiRegionIterator read_iterator
+    cdef ReadArray read_array
+    cdef ReadArray next_read_array = None
+    cdef TileReadLoader loader
+    cdef double start_time = 0.0
+
+    chrom = tgmi.bamutils.get_valid_chromosome_name(clusters[0][0].chromosome, bam_file)
+    target_spans = [(interval.start_pos, interval.end_pos) for cluster in clusters for interval in cluster]
+    read_filter.set_targets(bam_file.get_tid(chrom), target_spans)
+
+    if depth_cap is not None:
+        depth_cap.set_targets(bam_file.get_tid(chrom), target_spans)
+
+    if not bam_file.is_bam:
+        for cluster in clusters:
+            for summary in get_region_coverage_summary(
+                    bam_file, cluster, config, read_filter, timer, memory_budget, read_array_pool,
+                    depth_cap, region_thread_pool, collapse_reads):
+                yield summary
+
+        return
+
+    cluster_spans = [
+        (cluster[0].start_pos, max(interval.end_pos for interval in cluster)) for cluster in clusters
+    ]
+
+    load_in_tiles = [
+        memory_budget.should_load_in_tiles(end - begin, read_array_pool.estimate_reads(chrom, begin, end))
+        for begin, end in cluster_spans
+    ]
+    clusters, cluster_spans, load_in_tiles = merge_clusters_starting_in_tiled_clusters(
+        clusters, cluster_spans, load_in_tiles
+    )
+
+    # Only the first tile of a cluster loaded in tiles is loaded up front
+    load_ends = [
+        min(end, begin + memory_budget.tile_size) if tiled else end
+        for (begin, end), tiled in zip(cluster_spans, load_in_tiles)
+    ]
+
+    read_iterator = MultiRegionIterator(bam_file, chrom, cluster_spans)
+
+    read_array = read_array_pool.acquire(chrom, cluster_spans[0][0], load_ends[0])
+    load_reads_from_iterator(
+        read_array, read_filter, depth_cap, timer, read_iterator, cluster_spans[0][0], load_ends[0]
+    )
+
+    for index, cluster in enumerate(clusters):
+        cluster_begin, cluster_end = cluster_spans[index]
+        prefetch = None
+
+        _logger.debug("Processing cluster of regions spanning {}:{}-{}".format(
+            chrom, cluster_begin, cluster_end
+        ))
+
+        if load_in_tiles[index]:
+            _logger.debug("Loading reads one tile at a time")
+
+            loader = TileReadLoader(
+                read_array, read_array_pool, read_filter, depth_cap, timer, memory_budget, chrom,
+                load_ends[index], read_iterator=read_iterator
             )
 
-            read_array.set_pointers_to_start_and_end_of_interval(
-                interval.start_pos,
-                interval.end_pos,
-                &reads_start,
-                &reads_end
+            for summary in get_tiled_cluster_coverage_summaries(
+                    loader, chrom, cluster, config, timer, memory_budget, collapse_reads):
+                yield summary
+
+            read_array = loader.read_array
+
+        if index + 1 < len(clusters):
+            next_begin = cluster_spans[index + 1][0]
+            next_end = load_ends[index + 1]
+            next_read_array = read_array_pool.acquire(chrom, next_begin, next_end)
+            read_array.copy_reads_ending_after(next_begin, next_read_array)
+
+            prefetch = ReadPrefetchThread(
+                next_read_array, read_filter, depth_cap, timer, read_iterator, next_begin, next_end
             )
 
-            coverage_calc.add_reads(reads_start, reads_end)
+            prefetch.start()
+
+        if not load_in_tiles[index]:
+            for summary in get_cluster_coverage_summaries(
+                    read_array, chrom, cluster, config, timer, memory_budget, region_thread_pool,
+                    collapse_reads):
+                yield summary
+
+        if prefetch is not None:
+            start_time = get_time()
+            prefetch.wait()
+            timer.waiting_time += get_time() - start_time
+            memory_budget.record_usage(read_array.get_memory_usage() + next_read_array.get_memory_usage())
+
+        read_array_pool.release(read_array)
+        read_array = next_read_array
+        next_read_array = None
+
+    timer.block_reuses += read_iterator.block_reuses
+    timer.block_loads += read_iterator.block_loads
 
-            yield RegionCoverageSummary(
+
+def group_overlapping_intervals(intervals):
+    """
+    Split a list of intervals, sorted by start position, into groups of overlapping
+    intervals. Each group covers a contiguous stretch of bases, so the coverage of all
+    the intervals in a group can be accumulated once over their union, with each
+    read processed once however many of the intervals it overlaps.
+    """
+    groups = []
+    group_end = 0
+
+    for interval in intervals:
+        if len(groups) > 0 and interval.start_pos < group_end:
+            groups[-1].append(interval)
+            group_end = max(group_end, interval.end_pos)
+        else:
+            groups.append([interval])
+            group_end = interval.end_pos
+
+    return groups
+
+
+def get_group_coverage_summaries(RegionCoverageCalculator coverage_calc, group, read_counts):
+    """
+    Return a RegionCoverageSummary for each interval in a group of overlapping intervals
+    sharing 'coverage_calc', sliced from its per-base arrays. 'read_counts' holds the
+    numbers of forward and reverse reads overlapping each interval, and is not needed
+    when the group holds a single interval.
+    """
+    if len(group) == 1:
+        interval = group[0]
+
+        return [
+            RegionCoverageSummary(
                 interval.name,
                 interval.chromosome,
                 interval.start_pos,
                 interval.end_pos,
                 coverage_calc.get_coverage_summary()
             )
+        ]
+
+    return [
+        RegionCoverageSummary(
+            interval.name,
+            interval.chromosome,
+            interval.start_pos,
+            interval.end_pos,
+            coverage_calc.get_coverage_summary_for_interval(
+                interval.start_pos, interval.end_pos, n_reads_f, n_reads_r
+            )
+        )
+        for interval, (n_reads_f, n_reads_r) in zip(group, read_counts)
+    ]
+
+
+# The ReadWindow of each thread calculating coverage, re-used from one group to the next
+_thread_state = threading.local()
+
+
+cdef ReadWindow get_thread_read_window():
+    try:
+        return _thread_state.read_window
+    except AttributeError:
+        _thread_state.read_window = ReadWindow()
+        return _thread_state.read_window
+
+
+cdef void count_group_reads_in_tile(
+        CompactRead** reads_start,
+        CompactRead** reads_end,
+        int group_begin,
+        int tile_begin,
+        int n_intervals,
+        int* interval_begins,
+        int* interval_ends,
+        int* n_reads_f,
+        int* n_reads_r
+) nogil:
+    """
+    Count the forward and reverse reads in the window of one tile of a group which
+    overlap each of the group's intervals. A read is only counted in the tile holding
+    its first base inside the group, so reads spanning several tiles are counted once.
+    """
+    cdef CompactRead* read
+    cdef int i
+
+    while reads_start != reads_end:
+        read = reads_start[0]
+        reads_start += 1
+
+        if read.pos < tile_begin and group_begin < tile_begin:
+            continue
+
+        for i from 0 <= i < n_intervals:
+            if read.pos < interval_ends[i] and read.end > interval_begins[i]:
+                if read.flag & BAM_FREVERSE != 0:
+                    n_reads_r[i] += 1
+                else:
+                    n_reads_f[i] += 1
+
+
+cdef list calculate_group_coverage(
+        ReadArray read_array,
+        chrom,
+        group,
+        bq_cutoff,
+        mq_cutoff,
+        int tile_size,
+        int directional,
+        int count_ref_skips,
+        int extrapolate_coverage,
+        int collapse_reads,
+        TileReadLoader loader=None
+):
+    """
+    Calculate the coverage of a group of overlapping intervals from the reads in
+    'read_array', and return a RegionCoverageSummary for each interval. The read array
+    is only read, through a window belonging to the calling thread, so several groups
+    can be processed at once on different threads over the same read array. The GIL is
+    released while the reads are added. If 'collapse_reads' is set, reads with the same
+    alignment are added together.
+
+    If 'loader' is given, the reads of each tile are loaded with it just before the tile
+    is calculated, instead of being taken from 'read_array'.
+    """
+    cdef ReadWindow window = get_thread_read_window()
+    cdef RegionCoverageCalculator coverage_calc
+    cdef CompactRead** reads_start
+    cdef CompactRead** reads_end
+    cdef int group_begin = group[0].start_pos
+    cdef int group_end = max(interval.end_pos for interval in group)
+    cdef int tile_begin = group_begin
+    cdef int tile_end
+    cdef int n_intervals = len(group) if len(group) > 1 else 0
+    cdef long calculator_bytes = get_calculator_memory_usage(group_end - group_begin, tile_size, directional)
+    cdef array.array interval_begins = array.array('i', [interval.start_pos for interval in group])
+    cdef array.array interval_ends = array.array('i', [interval.end_pos for interval in group])
+    cdef array.array n_reads_f = array.array('i', [0] * len(group))
+    cdef array.array n_reads_r = array.array('i', [0] * len(group))
+
+    coverage_calc = RegionCoverageCalculator(
+        chrom,
+        group_begin,
+        group_end,
+        bq_cutoff,
+        mq_cutoff,
+        tile_size,
+        directional,
+        count_ref_skips,
+        extrapolate_coverage
+    )
+
+    while True:
+        tile_end = coverage_calc.tile_end
+
+        if loader is not None:
+            read_array = loader.load_tile(tile_begin, tile_end)
+            read_array.prepare_interval_queries()
+            loader.record_usage(calculator_bytes)
+
+        window.reserve(read_array.get_size())
+
+        with nogil:
+            reads_start = window.reads
+            reads_end = reads_start + read_array.find_reads_in_interval(tile_begin, tile_end, window)
+
+            count_group_reads_in_tile(
+                reads_start,
+                reads_end,
+                group_begin,
+                tile_begin,
+                n_intervals,
+                interval_begins.data.as_ints,
+                interval_ends.data.as_ints,
+                n_reads_f.data.as_ints,
+                n_reads_r.data.as_ints
+            )
+
+            if collapse_reads:
+                coverage_calc.add_collapsed_reads(reads_start, reads_end, window.base_qualities)
+            else:
+                coverage_calc.add_reads(reads_start, reads_end)
+
+        if tile_end >= group_end:
+            break
+
+        tile_begin = tile_end
+        coverage_calc.start_tile(tile_begin)
+
+    return get_group_coverage_summaries(coverage_calc, group, zip(n_reads_f, n_reads_r) if n_intervals > 0 else [])
+
+
+def get_cluster_coverage_summaries(
+        ReadArray read_array,
+        chrom,
+        cluster,
+        config,
+        CoverageTimer timer,
+        MemoryBudget memory_budget,
+        region_thread_pool=None,
+        collapse_reads=False
+):
+    """
+    Calculate coverage metrics for each region in a cluster from the reads which have
+    already been loaded into 'read_array'. Overlapping regions are processed together
+    over their union, and regions longer than the tile size of the memory budget are
+    processed one tile at a time.
+
+    If 'region_thread_pool' is given, the groups of overlapping regions are calculated
+    in parallel on its threads, all reading from the same read array. The summaries are
+    still returned in order. If 'collapse_reads' is set, reads with the same alignment
+    are added to the coverage together, which is faster for amplicon data.
+    """
+    cdef double start_time = 0.0
+    cdef int tile_size = memory_budget.tile_size
+    cdef int group_begin
+    cdef int group_end
+    cdef int directional = config['direction']
+    cdef int count_ref_skips = config['count_ref_skips']
+    cdef int extrapolate_coverage = config['extrapolate_coverage']
+
+    if not (config['outputs']['profiles'] or config['outputs']['regions']):
+        return
+
+    bq_cutoff = float(config['low_bq'])
+    mq_cutoff = float(config['low_mq'])
+    groups = group_overlapping_intervals(cluster)
+    read_array.prepare_interval_queries()
+
+    for group in groups:
+        group_begin = group[0].start_pos
+        group_end = max(interval.end_pos for interval in group)
+
+        memory_budget.record_region(group_end - group_begin)
+        memory_budget.record_usage(
+            read_array.get_memory_usage() + memory_budget.num_calculators *
+            get_calculator_memory_usage(group_end - group_begin, tile_size, directional)
+        )
+
+    if region_thread_pool is not None and len(groups) > 1:
+        start_time = get_time()
+        group_summaries = region_thread_pool.map(
+            lambda group: calculate_group_coverage(
+                read_array, chrom, group, bq_cutoff, mq_cutoff, tile_size, directional, count_ref_skips,
+                extrapolate_coverage, collapse_reads
+            ),
+            groups
+        )
+        timer.kernel_time += get_time() - start_time
+
+        for summaries in group_summaries:
+            for summary in summaries:
+                yield summary
+
+        return
+
+    for group in groups:
+        start_time = get_time()
+        summaries = calculate_group_coverage(
+            read_array, chrom, group, bq_cutoff, mq_cutoff, tile_size, directional, count_ref_skips,
+            extrapolate_coverage, collapse_reads
+        )
+        timer.kernel_time += get_time() - start_time
+
+        for summary in summaries:
+            yield summary
+
+
+def get_tiled_cluster_coverage_summaries(
+        TileReadLoader loader,
+        chrom,
+        cluster,
+        config,
+        CoverageTimer timer,
+        MemoryBudget memory_budget,
+        collapse_reads=False
+):
+    """
+    Alternative to get_cluster_coverage_summaries for clusters whose reads do not fit in
+    the memory budget. The reads of each tile are loaded by 'loader' just before the
+    tile is calculated, so the groups of overlapping regions are processed one after
+    the other, on the calling thread.
+    """
+    cdef double start_time = 0.0
+    cdef double reading_time = 0.0
+    cdef int group_end
+
+    if not (config['outputs']['profiles'] or config['outputs']['regions']):
+        return
+
+    bq_cutoff = float(config['low_bq'])
+    mq_cutoff = float(config['low_mq'])
+
+    for group in group_overlapping_intervals(cluster):
+        group_end = max(interval.end_pos for interval in group)
+        memory_budget.record_region(group_end - group[0].start_pos)
+
+        start_time = get_time()
+        reading_time = timer.reading_time
+        summaries = calculate_group_coverage(
+            None, chrom, group, bq_cutoff, mq_cutoff, memory_budget.tile_size, config['direction'],
+            config['count_ref_skips'], config['extrapolate_coverage'], collapse_reads, loader
+        )
+        timer.kernel_time += get_time() - start_time - (timer.reading_time - reading_time)
+
+        for summary in summaries:
+            yield summary
+
+
+cdef class ChromosomeSweep:
+    """
+    Feeds reads from one chromosome, sorted by start position, straight into the
+    coverage calculators of the sorted target intervals they overlap. Overlapping
+    intervals are grouped, and each group shares one calculator covering their union.
+    Only the groups which overlap the current read position are kept active, and nothing
+    is copied into an intermediate ReadArray. Completed regions are handed out in the
+    same order as the input intervals.
+    """
+    cdef object chrom
+    cdef list groups
+    cdef list active
+    cdef object in_flight
+    cdef object bq_cutoff
+    cdef object mq_cutoff
+    cdef int directional
+    cdef int count_ref_skips
+    cdef int next_group
+    cdef int num_groups
+    cdef int min_active_end
+    cdef int chrom_end
+
+    def __init__(self, chrom, intervals, bq_cutoff, mq_cutoff, directional=True, count_ref_skips=True):
+        self.chrom = chrom
+        self.groups = group_overlapping_intervals(intervals)
+        self.bq_cutoff = bq_cutoff
+        self.mq_cutoff = mq_cutoff
+        self.directional = directional
+        self.count_ref_skips = count_ref_skips
+        self.next_group = 0
+        self.num_groups = len(self.groups)
+        self.chrom_end = max(interval.end_pos for interval in intervals)
+        self.min_active_end = self.chrom_end
+
+        # Calculators which may still receive reads, and all calculators which have not yet
+        # been yielded, in input order. Each entry of the latter is [group, calculator, done,
+        # group_end, read_counts], where read_counts holds the numbers of forward and reverse
+        # reads overlapping each interval of a group of more than one interval.
+        self.active = []
+        self.in_flight = collections.deque()
+
+    cdef int add_read(self, bam1_t* read, CoverageTimer timer) except -1:
+        """
+        Add one read, which has already passed the read filter. Returns 1 if this
+        completed any regions, which can then be collected with pop_completed_summaries.
+        """
+        cdef RegionCoverageCalculator coverage_calc
+        cdef int read_begin = read.core.pos
+        cdef int read_end = bam_endpos(read)
+        cdef int is_reverse_read = (read.core.flag & BAM_FREVERSE) != 0
+        cdef int completed = 0
+        cdef int i
+        cdef double start_time = get_time()
+
+        completed = self.complete_regions_ending_before(read_begin)
+
+        while self.next_group < self.num_groups and self.groups[self.next_group][0].start_pos < read_end:
+            group = self.groups[self.next_group]
+            group_end = max(interval.end_pos for interval in group)
+            entry = [
+                group,
+                RegionCoverageCalculator(
+                    self.chrom,
+                    group[0].start_pos,
+                    group_end,
+                    self.bq_cutoff,
+                    self.mq_cutoff,
+                    directional=self.directional,
+                    count_ref_skips=self.count_ref_skips
+                ),
+                False,
+                group_end,
+                [[0, 0] for interval in group] if len(group) > 1 else []
+            ]
+            self.active.append(entry)
+            self.in_flight.append(entry)
+            self.min_active_end = min(self.min_active_end, group_end)
+            self.next_group += 1
+
+        for entry in self.active:
+            coverage_calc = entry[1]
+            coverage_calc.add_read(read)
+
+            read_counts = entry[4]
+
+            for i in range(len(read_counts)):
+                interval = entry[0][i]
+
+                if interval.start_pos < read_end and interval.end_pos > read_begin:
+                    read_counts[i][is_reverse_read] += 1
+
+        timer.kernel_time += get_time() - start_time
+        return completed
+
+    cdef int complete_regions_ending_before(self, int pos) except -1:
+        """
+        Reads are sorted by start position, so any region ending at or before the start
+        of the current read is complete.
+        """
+        cdef RegionCoverageCalculator coverage_calc
+
+        if self.min_active_end > pos:
+            return 0
+
+        still_active = []
+        self.min_active_end = self.chrom_end
+
+        for entry in self.active:
+            if entry[3] <= pos:
+                coverage_calc = entry[1]
+                coverage_calc.compute_summary_statistics_for_tile()
+                entry[2] = True
+            else:
+                still_active.append(entry)
+                self.min_active_end = min(self.min_active_end, entry[3])
+
+        self.active = still_active
+        return 1
+
+    def pop_completed_summaries(self):
+        """
+        Yield the summaries of the completed regions which are next in input order.
+        """
+        while len(self.in_flight) > 0 and self.in_flight[0][2]:
+            group, coverage_calc, done, group_end, read_counts = self.in_flight.popleft()
+
+            for summary in get_group_coverage_summaries(coverage_calc, group, read_counts):
+                yield summary
+
+    def finish(self, CoverageTimer timer):
+        """
+        Complete all the remaining regions once there are no more reads on the
+        chromosome, and yield their summaries.
+        """
+        cdef RegionCoverageCalculator coverage_calc
+        cdef double start_time = get_time()
+
+        self.complete_regions_ending_before(self.chrom_end)
+        timer.kernel_time += get_time() - start_time
+
+        for summary in self.pop_completed_summaries():
+            yield summary
+
+        # Regions after the last read on the chromosome have no coverage
+        while self.next_group < self.num_groups:
+            for interval in self.groups[self.next_group]:
+                coverage_calc = RegionCoverageCalculator(
+                    self.chrom,
+                    interval.start_pos,
+                    interval.end_pos,
+                    self.bq_cutoff,
+                    self.mq_cutoff,
+                    directional=self.directional
+                )
+                coverage_calc.compute_summary_statistics_for_tile()
+
+                yield RegionCoverageSummary(
+                    interval.name,
+                    interval.chromosome,
+                    interval.start_pos,
+                    interval.end_pos,
+                    coverage_calc.get_coverage_summary()
+                )
+
+            self.next_group += 1
+
+
+def get_chromosome_coverage_summaries(bam_file, intervals, config, ReadFilter read_filter, CoverageTimer timer):
+    """
+    Single-pass alternative to get_region_coverage_summary. Takes all the sorted target
+    intervals on one chromosome and walks the reads of that chromosome exactly once,
+    feeding each read into a ChromosomeSweep.
+
+    Summaries are yielded in the same order as the input intervals.
+    """
+    cdef IteratorRowRegion read_iterator
+    cdef ChromosomeSweep sweep
+    cdef bam1_t* read
+    cdef int iterator_status = 0
+    cdef int read_passes = 0
+    cdef double start_time = 0.0
+
+    if not (config['outputs']['profiles'] or config['outputs']['regions']):
+        return
+
+    chrom = tgmi.bamutils.get_valid_chromosome_name(intervals[0].chromosome, bam_file)
+    chrom_begin = intervals[0].start_pos
+    chrom_end = max(interval.end_pos for interval in intervals)
+    read_filter.set_targets(
+        bam_file.get_tid(chrom), [(interval.start_pos, interval.end_pos) for interval in intervals]
+    )
+
+    sweep = ChromosomeSweep(
+        chrom,
+        intervals,
+        float(config['low_bq']),
+        float(config['low_mq']),
+        config['direction'],
+        config['count_ref_skips']
+    )
+
+    _logger.debug("Sweeping reads on {}:{}-{} for {} regions".format(
+        chrom, chrom_begin, chrom_end, len(intervals)
+    ))
+
+    read_iterator = bam_file.fetch(chrom, chrom_begin, chrom_end)
+    read = read_iterator.b
+
+    while True:
+        start_time = get_time()
+        iterator_status = hts_itr_next(
+            hts_get_bgzfp(read_iterator.htsfile),
+            read_iterator.iter,
+            read,
+            read_iterator.htsfile
+        )
+
+        read_passes = iterator_status >= 0 and read_filter.passes(read)
+        timer.reading_time += get_time() - start_time
+
+        if iterator_status < 0:
+            break
+
+        if read_passes and sweep.add_read(read, timer):
+            for summary in sweep.pop_completed_summaries():
+                yield summary
+
+    for summary in sweep.finish(timer):
+        yield summary
+
+
+def get_streamed_coverage_summaries(
+        AlignmentFile bam_file,
+        intervals,
+        config,
+        ReadFilter read_filter,
+        CoverageTimer timer,
+        ReadCounter read_counter
+):
+    """
+    Index-free alternative to the other coverage calculations, for coordinate-sorted
+    input which can only be read once, from start to end, e.g. from stdin. Every read
+    is counted in 'read_counter', and the reads on each chromosome with targets are fed
+    into a ChromosomeSweep as they arrive.
+
+    Summaries are yielded chromosome by chromosome, in the order of the file header.
+    """
+    cdef ChromosomeSweep sweep = None
+    cdef bam1_t* read = NULL
+    cdef int status = 0
+    cdef int tid = 0
+    cdef int current_tid = -1
+    cdef int last_pos = -1
+    cdef int seen_unplaced_reads = 0
+    cdef int compute_coverage = config['outputs']['profiles'] or config['outputs']['regions']
+    cdef double start_time = 0.0
+
+    bq_cutoff = float(config['low_bq'])
+    mq_cutoff = float(config['low_mq'])
+    directional = config['direction']
+    count_ref_skips = config['count_ref_skips']
+    intervals_by_tid = {}
+    finished_tids = set()
+
+    if compute_coverage:
+        for chromosome_intervals in tgmi.interval.group_genomic_intervals_by_chromosome(intervals):
+            chrom = tgmi.bamutils.get_valid_chromosome_name(chromosome_intervals[0].chromosome, bam_file)
+            tid = bam_file.get_tid(chrom)
+
+            if tid < 0:
+                raise ValueError("Invalid chromosome name ({})".format(chrom))
+
+            intervals_by_tid[tid] = (chrom, chromosome_intervals)
+
+    read = bam_init1()
+    assert read != NULL, "Could not allocate memory for read"
+
+    try:
+        while True:
+            start_time = get_time()
+            status = sam_read1(bam_file.htsfile, bam_file.header, read)
+
+            if status >= 0:
+                read_counter.count(read)
+
+            timer.reading_time += get_time() - start_time
+
+            if status < 0:
+                break
+
+            tid = read.core.tid
+
+            if tid != current_tid:
+                # Unplaced reads come last in a coordinate-sorted file
+                if tid >= 0 and (tid in finished_tids or seen_unplaced_reads):
+                    raise StandardError("Streamed input must be sorted by coordinate")
+
+                if sweep is not None:
+                    for summary in sweep.finish(timer):
+                        yield summary
+
+                if current_tid >= 0:
+                    finished_tids.add(current_tid)
+
+                current_tid = tid
+                last_pos = -1
+                sweep = None
+
+                if tid in intervals_by_tid:
+                    chrom, chromosome_intervals = intervals_by_tid.pop(tid)
+                    _logger.debug("Streaming reads on {} for {} regions".format(chrom, len(chromosome_intervals)))
+                    read_filter.set_targets(
+                        tid, [(interval.start_pos, interval.end_pos) for interval in chromosome_intervals]
+                    )
+                    sweep = ChromosomeSweep(chrom, chromosome_intervals, bq_cutoff, mq_cutoff, directional, count_ref_skips)
+
+            if tid < 0:
+                seen_unplaced_reads = 1
+                continue
+
+            if read.core.pos < last_pos:
+                raise StandardError("Streamed input must be sorted by coordinate")
+
+            last_pos = read.core.pos
+
+            if sweep is not None and read_filter.passes(read) and sweep.add_read(read, timer):
+                for summary in sweep.pop_completed_summaries():
+                    yield summary
+
+        if sweep is not None:
+            for summary in sweep.finish(timer):
+                yield summary
+
+        # Chromosomes with targets but no reads
+        for tid in sorted(intervals_by_tid):
+            chrom, chromosome_intervals = intervals_by_tid[tid]
+            sweep = ChromosomeSweep(chrom, chromosome_intervals, bq_cutoff, mq_cutoff, directional, count_ref_skips)
+
+            for summary in sweep.finish(timer):
+                yield summary
+    finally:
+        bam_destroy1(read)
 
 
 class BamFileCoverageSummary(object):
@@ -472,29 +1948,61 @@ class PerBaseCoverageSummary(object):
     def __repr__(self):
         return self.__str__()
 
-    def as_dict(self):
-        return {
+    def as_arrays(self):
+        """
+        Return the read counts and the per-base profiles of the region keyed by metric
+        name. The profiles are the stored arrays, not copies, and support the buffer
+        protocol, so they can be viewed as NumPy arrays without copying.
+        """
+        summary = {
             "RC": self.num_reads_in_region,
             "RC_f": self.num_forward_reads_in_region,
             "RC_r": self.num_reverse_reads_in_region,
-            "COV": list(self.coverage_at_each_base),
-            "QCOV": list(self.high_quality_coverage_at_each_base),
-            "MEDBQ": list(self.median_quality_at_each_base),
-            "FLBQ":list( self.fraction_of_low_base_qualities_at_each_base),
-            "MEDMQ": list(self.median_mapping_quality_at_each_base),
-            "FLMQ": list(self.fraction_of_low_mapping_qualities_at_each_base),
-            "COV_f": list(self.forward_coverage_at_each_base),
-            "QCOV_f": list(self.forward_high_quality_coverage_at_each_base),
-            "MEDBQ_f": list(self.forward_median_quality_at_each_base),
-            "FLBQ_f": list(self.forward_fraction_of_low_base_qualities_at_each_base),
-            "MEDMQ_f": list(self.forward_median_mapping_quality_at_each_base),
-            "FLMQ_f": list(self.forward_fraction_of_low_mapping_qualities_at_each_base),
-            "COV_r": list(self.reverse_coverage_at_each_base),
-            "QCOV_r": list(self.reverse_high_quality_coverage_at_each_base),
-            "MEDBQ_r": list(self.reverse_median_quality_at_each_base),
-            "FLBQ_r": list(self.reverse_fraction_of_low_base_qualities_at_each_base),
-            "MEDMQ_r": list(self.reverse_median_mapping_quality_at_each_base),
-            "FLMQ_r": list(self.reverse_fraction_of_low_mapping_qualities_at_each_base)
+            "COV": self.coverage_at_each_base,
+            "QCOV": self.high_quality_coverage_at_each_base,
+            "MEDBQ": self.median_quality_at_each_base,
+            "FLBQ": self.fraction_of_low_base_qualities_at_each_base,
+            "MEDMQ": self.median_mapping_quality_at_each_base,
+            "FLMQ": self.fraction_of_low_mapping_qualities_at_each_base
+        }
+
+        # The per-strand data is None unless it was computed
+        if self.forward_coverage_at_each_base is None:
+            return summary
+
+        summary.update({
+            "COV_f": self.forward_coverage_at_each_base,
+            "QCOV_f": self.forward_high_quality_coverage_at_each_base,
+            "MEDBQ_f": self.forward_median_quality_at_each_base,
+            "FLBQ_f": self.forward_fraction_of_low_base_qualities_at_each_base,
+            "MEDMQ_f": self.forward_median_mapping_quality_at_each_base,
+            "FLMQ_f": self.forward_fraction_of_low_mapping_qualities_at_each_base,
+            "COV_r": self.reverse_coverage_at_each_base,
+            "QCOV_r": self.reverse_high_quality_coverage_at_each_base,
+            "MEDBQ_r": self.reverse_median_quality_at_each_base,
+            "FLBQ_r": self.reverse_fraction_of_low_base_qualities_at_each_base,
+            "MEDMQ_r": self.reverse_median_mapping_quality_at_each_base,
+            "FLMQ_r": self.reverse_fraction_of_low_mapping_qualities_at_each_base
+        })
+
+        return summary
+
+    def as_dict(self):
+        return {
+            key: list(value) if isinstance(value, array.array) else value
+            for key, value in self.as_arrays().items()
+        }
+
+    def as_numpy_arrays(self):
+        """
+        As as_arrays, but with each per-base profile wrapped in a NumPy array which
+        shares its memory. NumPy is only needed if this is called.
+        """
+        import numpy
+
+        return {
+            key: numpy.frombuffer(value, dtype=value.typecode) if isinstance(value, array.array) else value
+            for key, value in self.as_arrays().items()
         }
 
     def __str__(self):
@@ -540,18 +2048,18 @@ class PerBaseCoverageSummary(object):
         cdef float* FLBQ_array = fraction_of_low_base_qualities_at_each_base.data.as_floats
         cdef float* MEDMQ_array = median_mapping_quality_at_each_base.data.as_floats
         cdef float* FLMQ_array = fraction_of_low_mapping_qualities_at_each_base.data.as_floats
-        cdef long* COV_f_array = forward_coverage_at_each_base.data.as_longs
-        cdef long* QCOV_f_array = forward_high_quality_coverage_at_each_base.data.as_longs
-        cdef float* MEDBQ_f_array = forward_median_quality_at_each_base.data.as_floats
-        cdef float* FLBQ_f_array = forward_fraction_of_low_base_qualities_at_each_base.data.as_floats
-        cdef float* MEDMQ_f_array = forward_median_mapping_quality_at_each_base.data.as_floats
-        cdef float* FLMQ_f_array = forward_fraction_of_low_mapping_qualities_at_each_base.data.as_floats
-        cdef long* COV_r_array = reverse_coverage_at_each_base.data.as_longs
-        cdef long* QCOV_r_array = reverse_high_quality_coverage_at_each_base.data.as_longs
-        cdef float* MEDBQ_r_array = reverse_median_quality_at_each_base.data.as_floats
-        cdef float* FLBQ_r_array = reverse_fraction_of_low_base_qualities_at_each_base.data.as_floats
-        cdef float* MEDMQ_r_array = reverse_median_mapping_quality_at_each_base.data.as_floats
-        cdef float* FLMQ_r_array = reverse_fraction_of_low_mapping_qualities_at_each_base.data.as_floats
+        cdef long* COV_f_array = NULL
+        cdef long* QCOV_f_array = NULL
+        cdef float* MEDBQ_f_array = NULL
+        cdef float* FLBQ_f_array = NULL
+        cdef float* MEDMQ_f_array = NULL
+        cdef float* FLMQ_f_array = NULL
+        cdef long* COV_r_array = NULL
+        cdef long* QCOV_r_array = NULL
+        cdef float* MEDBQ_r_array = NULL
+        cdef float* FLBQ_r_array = NULL
+        cdef float* MEDMQ_r_array = NULL
+        cdef float* FLMQ_r_array = NULL
 
         cdef int num_bases = len(self.coverage_at_each_base)
         cdef int i, cov, qcov, cov_f, qcov_f, cov_r, qcov_r
@@ -565,6 +2073,21 @@ class PerBaseCoverageSummary(object):
         cdef bytes transcripts_overlapping_start_of_low_qual_window = None
         cdef bytes transcripts_overlapping_end_of_low_qual_window = None
 
+        # The per-strand arrays are only computed when directional summaries are wanted
+        if write_directional_summaries == 1:
+            COV_f_array = forward_coverage_at_each_base.data.as_longs
+            QCOV_f_array = forward_high_quality_coverage_at_each_base.data.as_longs
+            MEDBQ_f_array = forward_median_quality_at_each_base.data.as_floats
+            FLBQ_f_array = forward_fraction_of_low_base_qualities_at_each_base.data.as_floats
+            MEDMQ_f_array = forward_median_mapping_quality_at_each_base.data.as_floats
+            FLMQ_f_array = forward_fraction_of_low_mapping_qualities_at_each_base.data.as_floats
+            COV_r_array = reverse_coverage_at_each_base.data.as_longs
+            QCOV_r_array = reverse_high_quality_coverage_at_each_base.data.as_longs
+            MEDBQ_r_array = reverse_median_quality_at_each_base.data.as_floats
+            FLBQ_r_array = reverse_fraction_of_low_base_qualities_at_each_base.data.as_floats
+            MEDMQ_r_array = reverse_median_mapping_quality_at_each_base.data.as_floats
+            FLMQ_r_array = reverse_fraction_of_low_mapping_qualities_at_each_base.data.as_floats
+
         if write_transcripts_in_profiles == 1:
             overlapping_transcripts = transcript.get_overlaping_transcripts(transcript_database, chromosome, start_position, end_position)
         else:
@@ -580,18 +2103,6 @@ class PerBaseCoverageSummary(object):
             flbq = FLBQ_array[i]
             medmq = MEDMQ_array[i]
             flmq = FLMQ_array[i]
-            cov_f = COV_f_array[i]
-            qcov_f = QCOV_f_array[i]
-            medbq_f = MEDBQ_f_array[i]
-            flbq_f = FLBQ_f_array[i]
-            medmq_f = MEDMQ_f_array[i]
-            flmq_f = FLMQ_f_array[i]
-            cov_r = COV_r_array[i]
-            qcov_r = QCOV_r_array[i]
-            medbq_r = MEDBQ_r_array[i]
-            flbq_r = FLBQ_r_array[i]
-            medmq_r = MEDMQ_r_array[i]
-            flmq_r = FLMQ_r_array[i]
 
             if write_directional_summaries == 0:
                 if write_transcripts_in_profiles == 1:
@@ -627,6 +2138,19 @@ class PerBaseCoverageSummary(object):
                 output_line = output_line.replace("nan", ".")
                 output_file.write(output_line)
             else:
+                cov_f = COV_f_array[i]
+                qcov_f = QCOV_f_array[i]
+                medbq_f = MEDBQ_f_array[i]
+                flbq_f = FLBQ_f_array[i]
+                medmq_f = MEDMQ_f_array[i]
+                flmq_f = FLMQ_f_array[i]
+                cov_r = COV_r_array[i]
+                qcov_r = QCOV_r_array[i]
+                medbq_r = MEDBQ_r_array[i]
+                flbq_r = FLBQ_r_array[i]
+                medmq_r = MEDMQ_r_array[i]
+                flmq_r = FLMQ_r_array[i]
+
                 if write_transcripts_in_profiles == 1:
                     transcripts_overlapping = output.get_transcripts_overlapping_position(
                         overlapping_transcripts,
@@ -776,7 +2300,7 @@ class RegionCoverageSummary(object):
         return str(self.as_dict)
 
 
-def calculate_chromosome_coverage_metrics(bam_file, on_target):
+def calculate_chromosome_coverage_metrics(bam_file, on_target, bam_index_stats=None):
     _logger.info("Calculating per-chromosome coverage metrics")
 
     chromosomes = bam_file.references
@@ -784,11 +2308,11 @@ def calculate_chromosome_coverage_metrics(bam_file, on_target):
 
     number_of_reads_covering_chromosomes = []
 
-    total_reads_in_bam = bam_file.mapped + bam_file.unmapped
     total_on_target_reads = 0
     total_off_target_reads = 0
 
-    bam_index_stats = tgmi.bamutils.load_bam_index_stats_from_file(bam_file)
+    if bam_index_stats is None:
+        bam_index_stats = load_index_stats(bam_file)
 
     for chrom, length in zip(chromosomes, chromosome_lengths):
 
@@ -828,7 +2352,7 @@ def calculate_chromosome_coverage_metrics(bam_file, on_target):
 def calculate_minimal_chromosome_coverage_metrics(bam_file, options):
     _logger.info("Calculating minimal per-chromosome coverage metrics")
 
-    bam_index_stats = tgmi.bamutils.load_bam_index_stats_from_file(bam_file)
+    bam_index_stats = load_index_stats(bam_file)
     number_of_reads_covering_chromosomes = []
 
     for chrom in bam_file.references:
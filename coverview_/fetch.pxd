@@ -0,0 +1,28 @@
+from libc.stdint cimport int64_t
+from pysam.libchtslib cimport bam1_t, BGZF, hts_pair64_t
+
+
+cdef class ReadCounter:
+    cdef int num_references
+    cdef list references
+    cdef list lengths
+    cdef long* mapped_counts
+    cdef long* unmapped_counts
+    cdef void count(self, bam1_t* read)
+
+
+cdef class MultiRegionIterator:
+    cdef object bam_file
+    cdef BGZF* bgzf
+    cdef bam1_t* b
+    cdef hts_pair64_t* chunks
+    cdef int n_chunks
+    cdef int current_chunk
+    cdef int tid
+    cdef int end
+    cdef int has_read
+    cdef long block_reuses
+    cdef long block_loads
+    cdef int cnext(self) nogil except -2
+    cdef double get_compressed_size(self)
+    cdef int seek(self, int64_t offset) nogil except -1
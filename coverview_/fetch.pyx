@@ -0,0 +1,462 @@
+"""
+Utilities for fetching reads from indexed alignment files
+"""
+
+from libc.stdint cimport int64_t, uint64_t
+from libc.stdio cimport SEEK_SET
+from libc.stdlib cimport malloc, calloc, realloc, free, qsort
+
+from pysam.libcalignmentfile cimport AlignmentFile
+from pysam.libchtslib cimport bam1_t, bam_init1, bam_destroy1, bam_read1, BGZF, bgzf_seek, bgzf_tell,\
+    hts_get_bgzfp, hts_itr_t, hts_pair64_t, hts_itr_destroy, sam_itr_queryi, hts_set_opt,\
+    CRAM_OPT_REQUIRED_FIELDS, CRAM_OPT_DECODE_MD, sam_read1, BAM_FUNMAP, hts_set_threads,\
+    bgzf_set_cache_size, hts_version
+
+import logging
+import os
+import pysam
+import re
+import tgmi.bamutils
+
+
+_logger = logging.getLogger("coverview_")
+
+
+cdef extern from "htslib/bgzf.h":
+    # The pysam declaration of BGZF leaves out the fields describing the block which is
+    # currently loaded. We need them to move within that block without re-loading it.
+    ctypedef struct LoadedBGZFBlock "BGZF":
+        int block_length
+        int block_offset
+        int64_t block_address
+
+
+cdef extern from "htslib/hts.h":
+    enum:
+        SAM_QNAME
+        SAM_FLAG
+        SAM_RNAME
+        SAM_POS
+        SAM_MAPQ
+        SAM_CIGAR
+        SAM_SEQ
+        SAM_QUAL
+
+
+# The fields CoverView uses. CRAM decoding skips everything else, i.e. read names, mate
+# information and aux tags. Sequences are not used either, but htslib 1.3 under-estimates
+# the alignment end of reads whose sequence is not decoded, and then drops reads which
+# only just overlap the start of a fetched region.
+COVERAGE_FIELDS = SAM_FLAG | SAM_RNAME | SAM_POS | SAM_MAPQ | SAM_CIGAR | SAM_SEQ | SAM_QUAL
+
+# The depth cap chooses reads by hashing their names, so these must be decoded as well.
+DEPTH_CAP_FIELDS = COVERAGE_FIELDS | SAM_QNAME
+
+# Typical ratio of uncompressed to compressed size for BGZF-compressed BAM data
+cdef double BGZF_COMPRESSION_RATIO = 3.0
+
+# Enough to count the reads on each chromosome when reading through the whole file.
+READ_COUNT_FIELDS = SAM_FLAG | SAM_RNAME
+
+# Before 1.4, htslib only supports multi-threaded BGZF compression, not decompression,
+# and its CRAM decoding threads crash when a file is read after an index seek.
+MIN_HTSLIB_VERSION_FOR_THREADS = (1, 4)
+
+
+def get_htslib_version():
+    """
+    Return the version of the htslib used by pysam as a tuple, e.g. (1, 3).
+    """
+    return tuple(int(part) for part in re.match(r"(\d+)\.(\d+)", hts_version()).groups())
+
+
+def open_alignment_file(
+        file_name,
+        reference_file_name=None,
+        reference_cache_dir=None,
+        int required_fields=COVERAGE_FIELDS,
+        int threads=1,
+        int block_cache_size=0,
+        log_threads=True
+):
+    """
+    Open a BAM or CRAM file for reading. The format is detected from the file contents.
+
+    CRAM files need the reference they were compressed against. This is either given
+    explicitly as a FASTA file, or looked up by the MD5 sums in the CRAM header, in which
+    case sequences are stored in 'reference_cache_dir' so they are only downloaded once.
+    Only 'required_fields' are decoded from CRAM records.
+
+    If 'threads' is greater than 1, an htslib thread pool of that size is attached to the
+    file to decompress data in parallel, where htslib supports it for the file format.
+    No thread pool is attached with htslib versions before MIN_HTSLIB_VERSION_FOR_THREADS.
+    Whether that worked is logged unless 'log_threads' is False, which is used when the
+    same file has already been opened with the same number of threads.
+
+    For BAM files, htslib keeps up to 'block_cache_size' bytes of decompressed BGZF
+    blocks, so that a seek back to a recently read block does not inflate it again.
+    """
+    cdef AlignmentFile alignment_file
+
+    if reference_cache_dir is not None:
+        os.environ["REF_CACHE"] = os.path.join(reference_cache_dir, "%2s", "%2s", "%s")
+
+    alignment_file = pysam.AlignmentFile(file_name, "r", reference_filename=reference_file_name)
+
+    if alignment_file.is_cram:
+        _logger.debug("Input is CRAM. Decoding only the fields needed by CoverView")
+
+        if hts_set_opt(alignment_file.htsfile, CRAM_OPT_REQUIRED_FIELDS, required_fields) != 0:
+            raise StandardError("Could not set required CRAM fields for {}".format(file_name))
+
+        if hts_set_opt(alignment_file.htsfile, CRAM_OPT_DECODE_MD, 0) != 0:
+            raise StandardError("Could not disable MD tag generation for {}".format(file_name))
+
+    if alignment_file.is_bam and block_cache_size > 0:
+        _logger.debug("Caching up to {} bytes of BGZF blocks for {}".format(block_cache_size, file_name))
+        bgzf_set_cache_size(hts_get_bgzfp(alignment_file.htsfile), block_cache_size)
+
+    if threads > 1:
+        if get_htslib_version() < MIN_HTSLIB_VERSION_FOR_THREADS or \
+                hts_set_threads(alignment_file.htsfile, threads) != 0:
+            if log_threads:
+                _logger.warning("Multi-threaded decompression is not supported for {}. Using 1 thread".format(
+                    file_name
+                ))
+        elif log_threads:
+            _logger.info("Using {} threads to decompress {}".format(threads, file_name))
+
+    return alignment_file
+
+
+def is_streamed_input(AlignmentFile alignment_file):
+    """
+    Returns True if the file is being read from stdin, in which case it has no index and
+    can only be read once, from start to end.
+    """
+    return alignment_file.filename in ("-", b"-")
+
+
+cdef class ReadCounter:
+    """
+    Counts the mapped and unmapped reads on each chromosome as they are read, for
+    inputs which have no index holding these counts.
+    """
+    def __init__(self, AlignmentFile alignment_file):
+        self.num_references = alignment_file.nreferences
+        self.references = list(alignment_file.references)
+        self.lengths = list(alignment_file.lengths)
+
+        # The last entry holds reads which are not placed on any chromosome
+        self.mapped_counts = <long*>(calloc(self.num_references + 1, sizeof(long)))
+        self.unmapped_counts = <long*>(calloc(self.num_references + 1, sizeof(long)))
+        assert self.mapped_counts != NULL and self.unmapped_counts != NULL, "Could not allocate memory for ReadCounter"
+
+    def __dealloc__(self):
+        free(self.mapped_counts)
+        free(self.unmapped_counts)
+
+    cdef void count(self, bam1_t* read):
+        cdef int tid = read.core.tid
+
+        if tid < 0 or tid >= self.num_references:
+            tid = self.num_references
+
+        if read.core.flag & BAM_FUNMAP != 0:
+            self.unmapped_counts[tid] += 1
+        else:
+            self.mapped_counts[tid] += 1
+
+    def get_index_stats(self):
+        """
+        Return the counts as a tgmi.bamutils.BamIndexStats object, in the same form as
+        the counts read from a BAM index.
+        """
+        cdef int i = 0
+
+        index_stats = tgmi.bamutils.BamIndexStats()
+        chromosomes = self.references + ["*"]
+        lengths = self.lengths + [0]
+
+        for i from 0 <= i <= self.num_references:
+            index_stats.add_row(
+                tgmi.bamutils.BamIndexStatsRow(
+                    chromosomes[i],
+                    lengths[i],
+                    self.mapped_counts[i] + self.unmapped_counts[i],
+                    self.mapped_counts[i],
+                    self.unmapped_counts[i]
+                )
+            )
+
+        return index_stats
+
+
+def load_index_stats(AlignmentFile alignment_file):
+    """
+    Return the number of mapped and unmapped reads on each chromosome, as a
+    tgmi.bamutils.BamIndexStats object. These are read from the index of BAM files.
+    CRAM indexes do not store read counts, and streamed input has no index, so for
+    these the reads are counted by reading through the whole file, which must not have
+    been read from yet.
+    """
+    cdef bam1_t* read = NULL
+    cdef ReadCounter read_counter
+
+    if alignment_file.is_bam and not is_streamed_input(alignment_file):
+        return tgmi.bamutils.load_bam_index_stats_from_file(alignment_file)
+
+    _logger.info("No read counts are available from an index. Counting reads in {}".format(
+        alignment_file.filename
+    ))
+
+    read_counter = ReadCounter(alignment_file)
+    read = bam_init1()
+    assert read != NULL, "Could not allocate memory for read"
+
+    while sam_read1(alignment_file.htsfile, alignment_file.header, read) >= 0:
+        read_counter.count(read)
+
+    bam_destroy1(read)
+    return read_counter.get_index_stats()
+
+
+cdef int compare_chunks(const void* a, const void* b) nogil:
+    cdef uint64_t a_start = (<hts_pair64_t*>a).u
+    cdef uint64_t b_start = (<hts_pair64_t*>b).u
+
+    if a_start < b_start:
+        return -1
+    elif a_start > b_start:
+        return 1
+    else:
+        return 0
+
+
+cdef class MultiRegionIterator:
+    """
+    Iterates over the reads in a BAM file which lie in any of a list of regions on one
+    chromosome. The index chunks of all the regions are merged before reading starts, so
+    reads are returned once, in sorted order, and each BGZF block is decompressed at most
+    once even when the regions are close together or overlap.
+
+    Like the htslib iterators, this can return reads which lie close to, but do not
+    overlap, any of the regions. Callers must check for overlap themselves.
+
+    The number of seeks which re-used the BGZF block already loaded, and the number
+    which had to load a block, are counted in block_reuses and block_loads.
+    """
+    def __init__(self, AlignmentFile bam_file, chrom, regions):
+        """
+        'regions' is a list of (begin, end) tuples on chromosome 'chrom'.
+        """
+        cdef hts_itr_t* region_iterator = NULL
+        cdef hts_pair64_t* temp = NULL
+        cdef int capacity = 16
+        cdef int i = 0
+        cdef int n_merged = 0
+
+        if not bam_file.is_bam:
+            raise ValueError("Multi-region iteration is only supported for BAM files")
+
+        self.bam_file = bam_file
+        self.bgzf = hts_get_bgzfp(bam_file.htsfile)
+        self.tid = bam_file.get_tid(chrom)
+        self.end = 0
+        self.n_chunks = 0
+        self.current_chunk = -1
+        self.has_read = 0
+        self.block_reuses = 0
+        self.block_loads = 0
+
+        if self.tid < 0:
+            raise ValueError("Invalid chromosome name ({})".format(chrom))
+
+        self.b = bam_init1()
+        self.chunks = <hts_pair64_t*>(malloc(capacity * sizeof(hts_pair64_t)))
+        assert self.b != NULL and self.chunks != NULL, "Could not allocate memory for MultiRegionIterator"
+
+        for begin, end in regions:
+            region_iterator = sam_itr_queryi(bam_file.index, self.tid, begin, end)
+
+            if region_iterator == NULL:
+                raise ValueError("Could not query region {}:{}-{}".format(chrom, begin, end))
+
+            if self.n_chunks + region_iterator.n_off > capacity:
+                while self.n_chunks + region_iterator.n_off > capacity:
+                    capacity *= 2
+
+                temp = <hts_pair64_t*>(realloc(self.chunks, capacity * sizeof(hts_pair64_t)))
+
+                if temp == NULL:
+                    hts_itr_destroy(region_iterator)
+                    raise StandardError, "Could not re-allocate MultiRegionIterator"
+
+                self.chunks = temp
+
+            for i from 0 <= i < region_iterator.n_off:
+                self.chunks[self.n_chunks] = region_iterator.off[i]
+                self.n_chunks += 1
+
+            hts_itr_destroy(region_iterator)
+            self.end = max(self.end, end)
+
+        # Merge overlapping and adjacent chunks, so that no part of the file is read twice
+        qsort(self.chunks, self.n_chunks, sizeof(hts_pair64_t), compare_chunks)
+
+        for i from 0 <= i < self.n_chunks:
+            if n_merged > 0 and self.chunks[i].u <= self.chunks[n_merged - 1].v:
+                if self.chunks[i].v > self.chunks[n_merged - 1].v:
+                    self.chunks[n_merged - 1].v = self.chunks[i].v
+            else:
+                self.chunks[n_merged] = self.chunks[i]
+                n_merged += 1
+
+        _logger.debug("Merged {} index chunks into {} for {} regions on {}".format(
+            self.n_chunks, n_merged, len(regions), chrom
+        ))
+
+        self.n_chunks = n_merged
+
+    def __dealloc__(self):
+        if self.b != NULL:
+            bam_destroy1(self.b)
+
+        free(self.chunks)
+
+    cdef int cnext(self) nogil except -2:
+        """
+        Read the next record into self.b. Returns -1 when there are no more reads in any
+        of the regions. Raises an IOError if the file cannot be read.
+        """
+        cdef int status = 0
+
+        while True:
+            if self.current_chunk < 0 or <uint64_t>bgzf_tell(self.bgzf) >= self.chunks[self.current_chunk].v:
+                self.current_chunk += 1
+
+                if self.current_chunk >= self.n_chunks:
+                    return -1
+
+                self.seek(self.chunks[self.current_chunk].u)
+
+            status = bam_read1(self.bgzf, self.b)
+
+            if status == -1:
+                return -1
+
+            if status < 0:
+                with gil:
+                    raise IOError("Could not read BAM record (error {})".format(status))
+
+            if self.b.core.tid != self.tid or self.b.core.pos >= self.end:
+                self.current_chunk = self.n_chunks
+                return -1
+
+            return status
+
+    cdef double get_compressed_size(self):
+        """
+        Approximate number of compressed bytes which will be read from the file. The
+        part of each chunk lying inside a single BGZF block is only known in uncompressed
+        bytes, and is scaled by a typical compression ratio.
+        """
+        cdef double size = 0.0
+        cdef int i = 0
+
+        for i from 0 <= i < self.n_chunks:
+            size += (self.chunks[i].v >> 16) - (self.chunks[i].u >> 16)
+            size += (<double>(self.chunks[i].v & 0xFFFF) - <double>(self.chunks[i].u & 0xFFFF)) / BGZF_COMPRESSION_RATIO
+
+        return max(0.0, size)
+
+    cdef int seek(self, int64_t offset) nogil except -1:
+        """
+        Move to the specified virtual file offset. If the offset lies in the BGZF block
+        which is already loaded, we move within that block instead of re-loading it.
+        Raises an IOError if the seek fails.
+        """
+        cdef LoadedBGZFBlock* block = <LoadedBGZFBlock*>(self.bgzf)
+
+        if bgzf_tell(self.bgzf) == offset:
+            self.block_reuses += 1
+        elif block.block_length > 0 and block.block_address == (offset >> 16):
+            block.block_offset = offset & 0xFFFF
+            self.block_reuses += 1
+        else:
+            if bgzf_seek(self.bgzf, offset, SEEK_SET) < 0:
+                with gil:
+                    raise IOError("Could not seek to offset {} in BAM file".format(offset))
+
+            self.block_loads += 1
+
+        return 0
+
+
+cdef class ReadCountEstimator:
+    """
+    Estimates the number of reads in a region of a BAM file without reading it, from
+    the size of the compressed data the index points to for that region and the average
+    compressed size of a read in the whole file.
+    """
+    cdef AlignmentFile bam_file
+    cdef double bytes_per_read
+
+    def __init__(self, AlignmentFile bam_file, index_stats):
+        if not bam_file.is_bam:
+            raise ValueError("Read counts can only be estimated for BAM files")
+
+        total_reads = index_stats.get_total_reads_in_bam()
+
+        if total_reads == 0:
+            raise ValueError("Read counts cannot be estimated for an empty BAM file")
+
+        self.bam_file = bam_file
+        self.bytes_per_read = os.path.getsize(bam_file.filename) / <double>total_reads
+
+    def estimate_reads_in_region(self, chrom, int begin, int end):
+        cdef MultiRegionIterator region_iterator
+
+        if end <= begin:
+            return 0
+
+        chrom = tgmi.bamutils.get_valid_chromosome_name(chrom, self.bam_file)
+        region_iterator = MultiRegionIterator(self.bam_file, chrom, [(begin, end)])
+        return int(region_iterator.get_compressed_size() / self.bytes_per_read)
+
+
+def make_read_count_estimator(alignment_file):
+    """
+    Return a ReadCountEstimator for the file, or None if the number of reads cannot be
+    estimated from the index, e.g. for CRAM files.
+    """
+    if not alignment_file.is_bam:
+        return None
+
+    index_stats = load_index_stats(alignment_file)
+
+    if index_stats.get_total_reads_in_bam() == 0:
+        return None
+
+    return ReadCountEstimator(alignment_file, index_stats)
+
+
+class pyMultiRegionIterator(object):
+    """
+    Expose the MultiRegionIterator class to Python. For testing and general utility.
+    """
+    def __init__(self, bam_file, chrom, regions):
+        self._iterator = MultiRegionIterator(bam_file, chrom, regions)
+
+    def get_read_positions(self):
+        cdef MultiRegionIterator read_iterator = self._iterator
+        positions = []
+
+        while read_iterator.cnext() >= 0:
+            positions.append(read_iterator.b.core.pos)
+
+        return positions
+
+    def get_block_counts(self):
+        cdef MultiRegionIterator read_iterator = self._iterator
+        return read_iterator.block_reuses, read_iterator.block_loads
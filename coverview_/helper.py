@@ -80,7 +80,14 @@ def read_config_file(fn, _logger):
     ini_data = parse_ini_file(fn)
 
     ret['count_duplicate_reads'] = process_option(_logger, ini_data, 'READS.DUPLICATES', 'boolean', True)
+    ret['count_secondary_reads'] = process_option(_logger, ini_data, 'READS.SECONDARY', 'boolean', True)
+    ret['count_supplementary_reads'] = process_option(_logger, ini_data, 'READS.SUPPLEMENTARY', 'boolean', True)
+    ret['count_qc_fail_reads'] = process_option(_logger, ini_data, 'READS.QC_FAIL', 'boolean', True)
+    ret['min_mapq'] = process_option(_logger, ini_data, 'READS.MIN_MAPQ', 'int', 0)
     ret['direction'] = process_option(_logger, ini_data, 'READS.DIRECTION', 'boolean', False)
+    ret['count_ref_skips'] = process_option(_logger, ini_data, 'READS.REF_SKIPS', 'boolean', True)
+    ret['max_depth'] = process_option(_logger, ini_data, 'READS.MAX_DEPTH', 'int', 0)
+    ret['extrapolate_coverage'] = process_option(_logger, ini_data, 'READS.EXTRAPOLATE_COVERAGE', 'boolean', False)
     ret['only_flagged_profiles'] = process_option(_logger, ini_data, 'OUTPUTS.ONLY_FLAGGED_PROFILES', 'boolean', False)
     ret['low_bq'] = process_option(_logger, ini_data, 'QUALITY.LOW_BQ', 'int', 10)
     ret['low_mq'] = process_option(_logger, ini_data, 'QUALITY.LOW_MQ', 'int', 20)
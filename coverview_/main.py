@@ -5,16 +5,24 @@ import collections
 import json
 import logging
 import pysam
+import resource
 import tgmi.bed
 import tgmi.interval
-import tgmi.math
 import datetime
 import helper
 
+from multiprocessing.pool import ThreadPool
+
 from . import output
-from .calculators import calculate_chromosome_coverage_metrics, get_region_coverage_summary
+from .calculators import calculate_chromosome_coverage_metrics
+from .calculators import get_chromosome_coverage_summaries, get_chromosome_cluster_coverage_summaries
+from .calculators import get_streamed_coverage_summaries
+from .calculators import CoverageTimer, MemoryBudget
 from .calculators import calculate_minimal_chromosome_coverage_metrics
-from .statistics import median
+from .fetch import open_alignment_file, make_read_count_estimator, is_streamed_input, ReadCounter
+from .fetch import COVERAGE_FIELDS, DEPTH_CAP_FIELDS, READ_COUNT_FIELDS
+from .reads import make_depth_cap, make_read_filter, ReadArrayPool
+from .statistics import median_of_array, min_or_nan_of_array, max_or_nan_of_array
 
 
 _version = 'v1.4.3'
@@ -22,10 +30,35 @@ _logger = logging.getLogger("coverview_")
 
 
 class CoverageCalculator(object):
-    def __init__(self, options, config):
+    def __init__(self, options, config, bam_file=None):
+        """
+        Streamed input can only be opened once, so it is passed in as 'bam_file'. Other
+        inputs are opened again here, and the decompression threads are not reported
+        again, as main has already done that when opening the file.
+        """
         self.options = options
         self.config = config
-        self.bam_file = pysam.Samfile(options.input, "rb")
+
+        if bam_file is not None:
+            self.bam_file = bam_file
+        else:
+            self.bam_file = open_alignment_file(
+                options.input,
+                options.reference,
+                options.reference_cache,
+                DEPTH_CAP_FIELDS if config['max_depth'] > 0 else COVERAGE_FIELDS,
+                threads=options.threads,
+                block_cache_size=options.bgzf_cache * 1024 * 1024,
+                log_threads=False
+            )
+
+        self.index_stats = None
+        self.read_filter = make_read_filter(config)
+        self.depth_cap = make_depth_cap(config)
+        self.timer = CoverageTimer()
+        self.memory_budget = MemoryBudget(
+            options.max_memory * 1024 * 1024, config['direction'], max(1, options.region_threads)
+        )
         self.transcript_database = None
         self.out_poor = None
         self.num_reads_on_target = collections.defaultdict(int)
@@ -74,43 +107,44 @@ class CoverageCalculator(object):
     def compute_summaries_of_region_coverage(self, profile):
         """
         Caclculates medians, minimums and maximums of various coverage metrics
-        for a single region.
+        for a single region. These are computed directly on the per-base arrays,
+        without converting them to lists.
         """
         summary = {}
 
-        summary['MEDCOV'] = median(profile.coverage_at_each_base)
-        summary['MEDQCOV'] = median(profile.high_quality_coverage_at_each_base)
-        summary['MINCOV'] = int(tgmi.math.min_or_nan(profile.coverage_at_each_base))
-        summary['MINQCOV'] = int(tgmi.math.min_or_nan(profile.high_quality_coverage_at_each_base))
-        summary['MAXFLBQ'] = round(tgmi.math.max_or_nan(profile.fraction_of_low_base_qualities_at_each_base), 3)
-        summary['MAXFLMQ'] = round(tgmi.math.max_or_nan(profile.fraction_of_low_mapping_qualities_at_each_base), 3)
+        summary['MEDCOV'] = median_of_array(profile.coverage_at_each_base)
+        summary['MEDQCOV'] = median_of_array(profile.high_quality_coverage_at_each_base)
+        summary['MINCOV'] = int(min_or_nan_of_array(profile.coverage_at_each_base))
+        summary['MINQCOV'] = int(min_or_nan_of_array(profile.high_quality_coverage_at_each_base))
+        summary['MAXFLBQ'] = round(max_or_nan_of_array(profile.fraction_of_low_base_qualities_at_each_base), 3)
+        summary['MAXFLMQ'] = round(max_or_nan_of_array(profile.fraction_of_low_mapping_qualities_at_each_base), 3)
 
         if self.config['direction']:
-            summary['MEDCOV_f'] = median(profile.forward_coverage_at_each_base)
-            summary['MEDQCOV_r'] = median(profile.reverse_high_quality_coverage_at_each_base)
-            summary['MEDQCOV_f'] = median(profile.forward_high_quality_coverage_at_each_base)
-            summary['MEDCOV_r'] = median(profile.reverse_coverage_at_each_base)
-            summary['MINCOV_f'] = int(tgmi.math.min_or_nan(profile.forward_coverage_at_each_base))
-            summary['MINQCOV_f'] = int(tgmi.math.min_or_nan(profile.forward_high_quality_coverage_at_each_base))
+            summary['MEDCOV_f'] = median_of_array(profile.forward_coverage_at_each_base)
+            summary['MEDQCOV_r'] = median_of_array(profile.reverse_high_quality_coverage_at_each_base)
+            summary['MEDQCOV_f'] = median_of_array(profile.forward_high_quality_coverage_at_each_base)
+            summary['MEDCOV_r'] = median_of_array(profile.reverse_coverage_at_each_base)
+            summary['MINCOV_f'] = int(min_or_nan_of_array(profile.forward_coverage_at_each_base))
+            summary['MINQCOV_f'] = int(min_or_nan_of_array(profile.forward_high_quality_coverage_at_each_base))
 
             summary['MAXFLBQ_f'] = round(
-                tgmi.math.max_or_nan(profile.forward_fraction_of_low_base_qualities_at_each_base),
+                max_or_nan_of_array(profile.forward_fraction_of_low_base_qualities_at_each_base),
                 3
             )
             summary['MAXFLMQ_f'] = round(
-                tgmi.math.max_or_nan(profile.forward_fraction_of_low_mapping_qualities_at_each_base),
+                max_or_nan_of_array(profile.forward_fraction_of_low_mapping_qualities_at_each_base),
                 3
             )
 
-            summary['MINCOV_r'] = int(tgmi.math.min_or_nan(profile.reverse_coverage_at_each_base))
-            summary['MINQCOV_r'] = int(tgmi.math.min_or_nan(profile.reverse_high_quality_coverage_at_each_base))
+            summary['MINCOV_r'] = int(min_or_nan_of_array(profile.reverse_coverage_at_each_base))
+            summary['MINQCOV_r'] = int(min_or_nan_of_array(profile.reverse_high_quality_coverage_at_each_base))
             summary['MAXFLBQ_r'] = round(
-                tgmi.math.max_or_nan(profile.reverse_fraction_of_low_base_qualities_at_each_base),
+                max_or_nan_of_array(profile.reverse_fraction_of_low_base_qualities_at_each_base),
                 3
             )
 
             summary['MAXFLMQ_r'] = round(
-                tgmi.math.max_or_nan(profile.reverse_fraction_of_low_mapping_qualities_at_each_base),
+                max_or_nan_of_array(profile.reverse_fraction_of_low_mapping_qualities_at_each_base),
                 3
             )
 
@@ -155,45 +189,235 @@ class CoverageCalculator(object):
                 self.transcript_database
             )
 
+    def process_region_coverage_summary(self, target):
+        """
+        Compute the region-level summaries for one target, check it against the pass
+        criteria and write all the outputs for it.
+        """
+        per_base_summary = target.per_base_coverage_profile
+        self.num_reads_on_target[target.chromosome] += per_base_summary.num_reads_in_region
+
+        target.summary = self.compute_summaries_of_region_coverage(
+            target.per_base_coverage_profile
+        )
+
+        target.passes_thresholds = self.does_region_pass_coverage_thresholds(
+            target
+        )
+
+        if not target.passes_thresholds:
+            if '_' in target.region_name:
+                ids = target.region_name[:target.region_name.find('_')]
+            else:
+                ids = target.region_name
+
+            self.ids_of_flagged_targets.add(ids)
+        self.write_outputs_for_region(target)
+
     def calculate_coverage_summaries(self, intervals):
         _logger.info("Coverage metrics will be generated in a single process")
         self.write_output_file_headers()
-        num_clusters = 0
 
-        for cluster in tgmi.interval.cluster_genomic_intervals(intervals):
-            num_clusters += 1
-            for target in get_region_coverage_summary(self.bam_file, cluster, self.config):
+        if self.options.region_threads > 1 and (self.options.sweep or is_streamed_input(self.bam_file)):
+            _logger.warning("Regions are only calculated on several threads when reads are fetched per cluster")
+
+        if self.options.amplicon and (self.options.sweep or is_streamed_input(self.bam_file)):
+            _logger.warning("Amplicon reads are only collapsed when reads are fetched per cluster")
 
-                if target is None:
-                    continue
+        if self.depth_cap is not None and (self.options.sweep or is_streamed_input(self.bam_file)):
+            _logger.warning("The depth is only capped when reads are fetched per cluster")
 
-                per_base_summary = target.per_base_coverage_profile
-                self.num_reads_on_target[target.chromosome] += per_base_summary.num_reads_in_region
+        if is_streamed_input(self.bam_file):
+            self.calculate_coverage_summaries_in_stream(intervals)
+        elif self.options.sweep:
+            self.calculate_coverage_summaries_in_chromosome_sweeps(intervals)
+        else:
+            self.calculate_coverage_summaries_in_clusters(intervals)
+
+        _logger.info("Finished computing coverage metrics in all regions")
 
-                target.summary = self.compute_summaries_of_region_coverage(
-                    target.per_base_coverage_profile
+        for reason, count in sorted(self.read_filter.get_discarded_read_counts().items()):
+            _logger.info("Discarded {} {} reads".format(count, reason.replace('_', ' ')))
+
+        if self.depth_cap is not None and not (self.options.sweep or is_streamed_input(self.bam_file)):
+            depth_counts = self.depth_cap.get_depth_counts()
+            _logger.info(
+                "Capped the depth at {}: dropped {} of {} reads, and the maximum depth was {} "
+                "before capping and {} after".format(
+                    self.config['max_depth'],
+                    depth_counts["reads_dropped"],
+                    depth_counts["reads_seen"],
+                    depth_counts["max_raw_depth"],
+                    depth_counts["max_capped_depth"]
                 )
+            )
 
-                target.passes_thresholds = self.does_region_pass_coverage_thresholds(
-                    target
+        _logger.info(
+            "Spent {:.2f}s reading and decompressing reads and {:.2f}s calculating coverage, "
+            "and waited {:.2f}s for reads to be prefetched".format(
+                self.timer.reading_time, self.timer.kernel_time, self.timer.waiting_time
+            )
+        )
+
+        if self.timer.block_reuses + self.timer.block_loads > 0:
+            _logger.info("Re-used an already decompressed BGZF block for {} of {} seeks".format(
+                self.timer.block_reuses, self.timer.block_reuses + self.timer.block_loads
+            ))
+
+        if not (self.options.sweep or is_streamed_input(self.bam_file)):
+            _logger.info("Peak memory used for reads and histograms was {:.1f} MB{}".format(
+                self.memory_budget.peak_bytes / (1024 * 1024),
+                " (limit {} MB)".format(self.options.max_memory) if self.options.max_memory > 0 else ""
+            ))
+
+            if 0 < self.memory_budget.max_bytes < self.memory_budget.peak_bytes:
+                _logger.warning(
+                    "The peak memory used for reads and histograms was more than the limit of {} MB. "
+                    "The per-base results of a region are always held in full, and needed up to "
+                    "{:.1f} MB".format(
+                        self.options.max_memory, self.memory_budget.peak_region_bytes / (1024 * 1024)
+                    )
                 )
 
-                if not target.passes_thresholds:
-                    if '_' in target.region_name:
-                        ids = target.region_name[:target.region_name.find('_')]
-                    else:
-                        ids = target.region_name
+        _logger.info("Peak resident memory of the process was {:.1f} MB".format(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        ))
 
-                    self.ids_of_flagged_targets.add(ids)
-                self.write_outputs_for_region(target)
+    def calculate_coverage_summaries_in_clusters(self, intervals):
+        """
+        Fetch the reads for each cluster of nearby targets into memory, and compute
+        the coverage of each target in the cluster from there. The reads for all the
+        clusters on a chromosome are read in one pass through the file.
+
+        Clusters are sized to hold a roughly constant number of reads, estimated from the
+        index, unless this is switched off or the reads cannot be estimated. With a memory
+        limit, clusters are also capped at the number of reads which fit in the limit.
+
+        The in-memory read arrays are re-used from one cluster to the next, and are
+        pre-sized from the estimated number of reads in each cluster when available.
+
+        With more than one region thread, the regions of each cluster are calculated in
+        parallel by a pool of threads sharing the cluster's reads.
+        """
+        num_clusters = 0
+        region_thread_pool = None
+        read_count_estimator = None
+        max_reads = self.options.reads_per_cluster if self.options.reads_per_cluster > 0 else None
+        max_reads_in_budget = self.memory_budget.get_max_reads()
+
+        if max_reads_in_budget is not None:
+            max_reads = min(max_reads or max_reads_in_budget, max_reads_in_budget)
+
+        if max_reads is not None:
+            read_count_estimator = make_read_count_estimator(self.bam_file)
+
+        if read_count_estimator is None:
+            _logger.debug("Clustering regions by span")
+
+            if max_reads_in_budget is not None:
+                _logger.info(
+                    "Reads per cluster cannot be estimated for this input, so clusters longer "
+                    "than {} bases are loaded one tile at a time".format(self.memory_budget.tile_size)
+                )
+        else:
+            _logger.debug("Clustering regions by an estimated {} reads per cluster".format(
+                max_reads
+            ))
+
+        read_array_pool = ReadArrayPool(read_count_estimator, self.memory_budget.get_max_array_bytes())
+
+        if self.options.region_threads > 1:
+            _logger.info("Regions will be calculated on {} threads".format(self.options.region_threads))
+            region_thread_pool = ThreadPool(self.options.region_threads)
+
+        try:
+            for chromosome_intervals in tgmi.interval.group_genomic_intervals_by_chromosome(intervals):
+                clusters = list(tgmi.interval.cluster_genomic_intervals(
+                    chromosome_intervals,
+                    read_count_estimator=read_count_estimator,
+                    max_reads=max_reads
+                ))
+                num_clusters += len(clusters)
+                chromosome_summaries = get_chromosome_cluster_coverage_summaries(
+                    self.bam_file,
+                    clusters,
+                    self.config,
+                    self.read_filter,
+                    self.timer,
+                    self.memory_budget,
+                    read_array_pool,
+                    self.depth_cap,
+                    region_thread_pool,
+                    self.options.amplicon
+                )
+
+                for target in chromosome_summaries:
+
+                    if target is None:
+                        continue
+
+                    self.process_region_coverage_summary(target)
+        finally:
+            if region_thread_pool is not None:
+                region_thread_pool.close()
+                region_thread_pool.join()
 
-        _logger.info("Finished computing coverage metrics in all regions")
         _logger.debug("Data was processed in {} clusters".format(num_clusters))
 
+    def calculate_coverage_summaries_in_chromosome_sweeps(self, intervals):
+        """
+        Walk the reads on each chromosome once, streaming them into the coverage
+        calculators of all the targets they overlap.
+        """
+        num_chromosomes = 0
+
+        if self.options.max_memory > 0:
+            _logger.warning("The memory limit is not applied when sweeping chromosomes")
+
+        for chromosome_intervals in tgmi.interval.group_genomic_intervals_by_chromosome(intervals):
+            num_chromosomes += 1
+            chromosome_summaries = get_chromosome_coverage_summaries(
+                self.bam_file,
+                chromosome_intervals,
+                self.config,
+                self.read_filter,
+                self.timer
+            )
+
+            for target in chromosome_summaries:
+                self.process_region_coverage_summary(target)
+
+        _logger.debug("Data was processed in {} chromosome sweeps".format(num_chromosomes))
+
+    def calculate_coverage_summaries_in_stream(self, intervals):
+        """
+        Read the whole input once, in order, sweeping the targets on each chromosome as
+        its reads arrive. No index is needed, and the number of reads on each chromosome
+        is counted along the way and kept in self.index_stats.
+        """
+        read_counter = ReadCounter(self.bam_file)
+        summaries = get_streamed_coverage_summaries(
+            self.bam_file,
+            intervals,
+            self.config,
+            self.read_filter,
+            self.timer,
+            read_counter
+        )
+
+        for target in summaries:
+            self.process_region_coverage_summary(target)
+
+        self.index_stats = read_counter.get_index_stats()
+
 
 def get_default_config():
     return {
         "count_duplicate_reads": True,
+        "count_secondary_reads": True,
+        "count_supplementary_reads": True,
+        "count_qc_fail_reads": True,
+        "min_mapq": 0,
         "outputs": {
             "regions": True,
             "profiles": True,
@@ -207,6 +431,9 @@ def get_default_config():
         "only_flagged_profiles": False,
         "pass": None,
         "direction": False,
+        "count_ref_skips": True,
+        "max_depth": 0,
+        "extrapolate_coverage": False,
     }
 
 
@@ -220,7 +447,14 @@ def load_and_validate_config(config_file_name):
 
     allowed_config_parameters = {
         "count_duplicate_reads",
+        "count_qc_fail_reads",
+        "count_secondary_reads",
+        "count_supplementary_reads",
+        "min_mapq",
         "direction",
+        "count_ref_skips",
+        "max_depth",
+        "extrapolate_coverage",
         "low_bq",
         "low_mq",
         "only_flagged_profiles",
@@ -279,10 +513,27 @@ def get_input_options(command_line_args):
         default=None,
         dest='input',
         action='store',
-        help="Input BAM file",
+        help="Input BAM or CRAM file, or - to stream a coordinate-sorted BAM or SAM file from stdin",
         required=True
     )
 
+    parser.add_argument(
+        "-r",
+        "--reference",
+        default=None,
+        dest='reference',
+        action='store',
+        help="Reference FASTA file. Only used for CRAM input"
+    )
+
+    parser.add_argument(
+        "--reference-cache",
+        default=None,
+        dest='reference_cache',
+        action='store',
+        help="Directory for caching reference sequences downloaded for CRAM input"
+    )
+
     parser.add_argument(
         "-o",
         "--output",
@@ -319,6 +570,70 @@ def get_input_options(command_line_args):
         help="Transcript database file"
     )
 
+    parser.add_argument(
+        "--threads",
+        default=1,
+        dest='threads',
+        action='store',
+        type=int,
+        help="Number of threads used by htslib to decompress the input file"
+    )
+
+    parser.add_argument(
+        "--reads-per-cluster",
+        default=500000,
+        dest='reads_per_cluster',
+        action='store',
+        type=int,
+        help="Estimated number of reads to load into memory at a time. Set to 0 to cluster regions by span instead"
+    )
+
+    parser.add_argument(
+        "--bgzf-cache",
+        default=0,
+        dest='bgzf_cache',
+        action='store',
+        type=int,
+        help="Size in MB of the cache of decompressed BGZF blocks kept by htslib for BAM input"
+    )
+
+    parser.add_argument(
+        "--max-memory",
+        default=0,
+        dest='max_memory',
+        action='store',
+        type=int,
+        help="Approximate limit in MB on the memory used for the reads and per-base histograms of a cluster. "
+             "Set to 0 for no limit"
+    )
+
+    parser.add_argument(
+        "--sweep",
+        default=False,
+        dest='sweep',
+        action='store_true',
+        help="Read each chromosome in a single pass instead of fetching reads per cluster of targets"
+    )
+
+    parser.add_argument(
+        "--region-threads",
+        default=1,
+        dest='region_threads',
+        action='store',
+        type=int,
+        help="Number of threads calculating the coverage of the regions in a cluster in parallel. "
+             "The summaries of a whole cluster are then kept until they are written out"
+    )
+
+    parser.add_argument(
+        "--amplicon",
+        default=False,
+        dest='amplicon',
+        action='store_true',
+        help="Add reads with the same start, CIGAR, mapping quality and strand to the coverage together. "
+             "This is faster for amplicon data, and gives the same results"
+    )
+
     options = parser.parse_args(command_line_args)
     #config = load_and_validate_config(options.config)
     config = helper.read_config_file(options.config, _logger)
@@ -343,6 +658,21 @@ def configure_logging():
     logger.setLevel(logging.INFO)
 
 
+def write_meta_data_file(options, meta_data):
+    """
+    Write the run information used by the GUI to <prefix>_meta.json. This is written
+    when CoverView starts, and again at the end with statistics collected during the run.
+    """
+    with open(options.output + '_meta.json', 'w') as json_file:
+        json.dump(
+            meta_data,
+            json_file,
+            sort_keys=True,
+            indent=4,
+            separators=(',', ':')
+        )
+
+
 def main(command_line_args):
     configure_logging()
     options, config = get_input_options(command_line_args)
@@ -353,7 +683,25 @@ def main(command_line_args):
     _logger.debug(options)
     _logger.debug(config)
 
-    bam_file = pysam.Samfile(options.input, "rb")
+    # Only used for the header and read counts, so nothing else is decoded from CRAM files.
+    # Input streamed from stdin is read only once, so all the fields are needed.
+    if options.input == "-":
+        _logger.info("Streaming input from stdin. Reads will be processed in a single pass")
+
+        bam_file = open_alignment_file(
+            options.input,
+            options.reference,
+            options.reference_cache,
+            threads=options.threads
+        )
+    else:
+        bam_file = open_alignment_file(
+            options.input,
+            options.reference,
+            options.reference_cache,
+            READ_COUNT_FIELDS,
+            options.threads
+        )
 
     sample_name = ''
     if 'RG' in bam_file.header:
@@ -366,27 +714,17 @@ def main(command_line_args):
             sample_name = list(sample_names)[0]
 
 
-    with open(options.output + '_meta.json', 'w') as json_file:
-
-        date = str(datetime.datetime.now())
-        date = date[:date.find('.')]
+    date = str(datetime.datetime.now())
+    date = date[:date.find('.')]
 
-        json_output_dict = {
-            "date": date,
-            "sample_name": sample_name,
-            "command_line_opts": vars(options),
-            "config_opts": config
-        }
-
-        json.dump(
-            json_output_dict,
-            json_file,
-            sort_keys=True,
-            indent=4,
-            separators=(',', ':')
-
-        )
+    meta_data = {
+        "date": date,
+        "sample_name": sample_name,
+        "command_line_opts": vars(options),
+        "config_opts": config
+    }
 
+    write_meta_data_file(options, meta_data)
 
     if options.bedfile is None:
         _logger.info("No input BED file specified. Computing minimal coverage information")
@@ -415,14 +753,25 @@ def main(command_line_args):
         number_of_targets = len(regions_with_unique_names)
         _logger.info("There are {} target regions".format(number_of_targets))
 
-        coverage_calculator = CoverageCalculator(options, config)
+        if is_streamed_input(bam_file):
+            coverage_calculator = CoverageCalculator(options, config, bam_file)
+        else:
+            coverage_calculator = CoverageCalculator(options, config)
         coverage_calculator.calculate_coverage_summaries(
             regions_with_unique_names
         )
 
+        meta_data["discarded_reads"] = coverage_calculator.read_filter.get_discarded_read_counts()
+
+        if coverage_calculator.depth_cap is not None:
+            meta_data["depth_cap"] = coverage_calculator.depth_cap.get_depth_counts()
+
+        write_meta_data_file(options, meta_data)
+
         chromosome_coverage_metrics = calculate_chromosome_coverage_metrics(
             bam_file,
-            coverage_calculator.num_reads_on_target
+            coverage_calculator.num_reads_on_target,
+            coverage_calculator.index_stats
         )
 
         output.output_chromosome_coverage_metrics(
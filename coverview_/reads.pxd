@@ -1,12 +1,143 @@
 
+from libc.stdint cimport int8_t, int32_t, uint8_t, uint16_t, uint32_t
 from pysam.libchtslib cimport bam1_t
 
 
+cdef struct CompactRead:
+    # Packed projection of a bam1_t holding only the fields needed by the coverage
+    # calculation. Each record is followed in memory by its n_cigar CIGAR operations
+    # and then its l_qseq base qualities. A read kept by a DepthCap at sample level k
+    # stands for 2^k reads.
+    int32_t pos
+    int32_t end
+    uint16_t flag
+    uint8_t mapq
+    uint8_t sample_level
+    uint32_t n_cigar
+    int32_t l_qseq
+
+
+cdef inline uint32_t* get_compact_read_cigar(CompactRead* read) nogil:
+    return <uint32_t*>(read + 1)
+
+
+cdef inline uint8_t* get_compact_read_qual(CompactRead* read) nogil:
+    return <uint8_t*>(get_compact_read_cigar(read) + read.n_cigar)
+
+
+cdef class ReadWindow:
+    cdef CompactRead** reads
+    cdef int* index_stack
+    cdef uint8_t** base_qualities
+    cdef int capacity
+    cdef void reserve(self, int n_reads)
+
+
 cdef class ReadArray:
-    cdef bam1_t** reads
+    cdef CompactRead** reads
+    cdef size_t* __offsets
+    cdef uint8_t* __slab
+    cdef size_t __slab_size
+    cdef size_t __slab_capacity
     cdef int __size
     cdef int __capacity
-    cdef int __longest_read
-    cdef void append(self, bam1_t* read)
-    cdef void set_pointers_to_start_and_end_of_interval(self, int start, int end, bam1_t*** window_start, bam1_t*** window_end)
-    cdef int count_reads_in_interval(self, int start_pos, int end_pos)
\ No newline at end of file
+    cdef int __pointers_are_stale
+    cdef int* __parents
+    cdef int* __child_offsets
+    cdef int* __child_counts
+    cdef int* __members
+    cdef int* __index_stack
+    cdef ReadWindow __window
+    cdef int __index_capacity
+    cdef int __num_top_level_reads
+    cdef int __index_is_stale
+    cdef void clear(self)
+    cdef void reserve(self, int n_reads)
+    cdef CompactRead* allocate_record(self, size_t record_size) nogil except NULL
+    cdef int append(self, bam1_t* read, int sample_level=*) nogil except -1
+    cdef void append_compact_read(self, CompactRead* read)
+    cdef void copy_reads_ending_after(self, int start, ReadArray destination)
+    cdef int get_size(self) nogil
+    cdef size_t get_memory_usage(self)
+    cdef void update_read_pointers(self)
+    cdef void build_interval_index(self)
+    cdef int find_first_read_ending_after(self, int list_begin, int list_end, int pos) nogil
+    cdef void prepare_interval_queries(self)
+    cdef int find_reads_in_interval(self, int start, int end, ReadWindow window) nogil
+    cdef void set_pointers_to_start_and_end_of_interval(self, int start, int end, CompactRead*** window_start, CompactRead*** window_end)
+    cdef int count_reads_in_interval(self, int start_pos, int end_pos)
+
+
+cdef class ReadArrayPool:
+    cdef list free_arrays
+    cdef object read_count_estimator
+    cdef long max_array_bytes
+    cdef object estimate_reads(self, chrom, int begin, int end)
+    cdef ReadArray acquire(self, chrom, int begin, int end)
+    cdef void release(self, ReadArray read_array)
+
+
+cdef class TargetSpans:
+    cdef int tid
+    cdef int* begins
+    cdef int* ends
+    cdef int n_spans
+    cdef int set_spans(self, int tid, spans) except -1
+    cdef int overlaps(self, bam1_t* read) nogil
+
+
+cdef class ReadFilter:
+    cdef int excluded_flags
+    cdef int min_mapping_quality
+    cdef int counted_tid
+    cdef int counted_until
+    cdef long n_unmapped
+    cdef long n_secondary
+    cdef long n_supplementary
+    cdef long n_qc_fail
+    cdef long n_duplicate
+    cdef long n_low_mapping_quality
+    cdef TargetSpans targets
+    cdef int set_targets(self, int tid, spans) except -1
+    cdef int should_count(self, bam1_t* read) nogil
+    cdef int passes(self, bam1_t* read) nogil
+    cdef void mark_region_as_counted(self, int tid, int end)
+
+
+cdef struct DepthCapDecision:
+    # The sample level chosen for a read by a DepthCap, or -1 if it was dropped, with
+    # the fields used to recognise the read if it is fetched again
+    int32_t pos
+    int32_t end
+    uint32_t name_hash
+    uint16_t flag
+    int8_t level
+
+
+cdef class DepthCap:
+    cdef int max_depth
+    cdef int tid
+    cdef int seen_until
+    cdef int keep_from
+    cdef int* raw_ends
+    cdef int* kept_ends
+    cdef int n_raw_ends
+    cdef int n_kept_ends
+    cdef int heap_capacity
+    cdef DepthCapDecision* decisions
+    cdef int n_decisions
+    cdef int decision_capacity
+    cdef int replay_index
+    cdef long n_seen
+    cdef long n_dropped
+    cdef int max_raw_depth
+    cdef int max_kept_depth
+    cdef TargetSpans targets
+    cdef void start_reference(self, int tid) nogil
+    cdef int find_decision(self, bam1_t* read, uint32_t name_hash) nogil
+    cdef int record_decision(self, bam1_t* read, uint32_t name_hash, int level) nogil except -1
+    cdef int reserve_heaps(self) nogil except -1
+    cdef int set_targets(self, int tid, spans) except -1
+    cdef int select(self, bam1_t* read) nogil except -2
+    cdef void start_region(self, int tid, int start)
+    cdef void mark_region_as_seen(self, int tid, int end)
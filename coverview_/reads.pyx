@@ -2,11 +2,13 @@
 Utility classes and functions for efficient processing of read data
 """
 
+from libc.stdint cimport uint8_t, uint32_t
 from pysam.libcalignmentfile cimport bam1_t
-from pysam.libchtslib cimport bam_dup1, bam_destroy1, bam_endpos
+from pysam.libchtslib cimport bam_endpos, bam_get_cigar, bam_get_qname, bam_get_qual, BAM_FUNMAP, BAM_FSECONDARY,\
+    BAM_FSUPPLEMENTARY, BAM_FQCFAIL, BAM_FDUP
 from pysam.libcalignedsegment cimport AlignedSegment
 
-cdef extern from "stdlib.h":
+cdef extern from "stdlib.h" nogil:
     void free(void *)
     void *malloc(size_t)
     void *calloc(size_t,size_t)
@@ -19,7 +21,7 @@ cdef extern from "math.h":
     double fabs(double)
     int abs(int)
 
-cdef extern from "string.h":
+cdef extern from "string.h" nogil:
   ctypedef int size_t
   void *memcpy(void *dst,void *src,size_t len)
   int strncmp(char *s1,char *s2,size_t len)
@@ -34,150 +36,1082 @@ import logging
 _logger = logging.getLogger("coverview_")
 
 
-cdef int bisectReadsLeft(bam1_t** reads, int testPos, int nReads):
+# Slab space reserved per read when sizing a ReadArray. Records are usually smaller
+# than this, so the slab rarely needs to grow.
+cdef size_t TYPICAL_RECORD_SIZE = 256
+
+
+cdef inline size_t get_slab_record_size(bam1_t* read) nogil:
     """
-    Specialisation of bisection algorithm for array of
-    read pointers.
+    Number of bytes needed to store a read in a ReadArray slab: the CompactRead header
+    followed by the CIGAR operations and base qualities, padded so that the next record
+    is 8-byte aligned.
     """
-    cdef int low = 0
-    cdef int high = nReads
-    cdef int mid = 0
+    return (sizeof(CompactRead) + read.core.n_cigar * sizeof(uint32_t) + read.core.l_qseq + 7) & ~(<size_t>7)
 
-    while low < high:
 
-        mid = (low + high) / 2
+cdef inline size_t get_compact_read_record_size(CompactRead* read) nogil:
+    """
+    Number of bytes used by a CompactRead which is already stored in a slab.
+    """
+    return (sizeof(CompactRead) + read.n_cigar * sizeof(uint32_t) + read.l_qseq + 7) & ~(<size_t>7)
 
-        if reads[mid].core.pos < testPos:
-            low = mid + 1
-        else:
-            high = mid
 
-    return low
+cdef inline void project_read(bam1_t* read, CompactRead* record, int sample_level) nogil:
+    """
+    Fill in a CompactRead from a full BAM record. Only the fields used by the coverage
+    calculation are kept; the read name, sequence and aux tags are dropped.
+    """
+    record.pos = read.core.pos
+    record.end = bam_endpos(read)
+    record.flag = read.core.flag
+    record.mapq = read.core.qual
+    record.sample_level = sample_level
+    record.n_cigar = read.core.n_cigar
+    record.l_qseq = read.core.l_qseq
+    memcpy(get_compact_read_cigar(record), bam_get_cigar(read), read.core.n_cigar * sizeof(uint32_t))
+    memcpy(get_compact_read_qual(record), bam_get_qual(read), read.core.l_qseq)
 
 
-cdef int bisectReadsRight(bam1_t** reads, int testPos, int nReads):
+cdef class ReadWindow:
     """
-    Specialisation of bisection algorithm for array of
-    read pointers.
+    Buffers for a window of reads looked up in a ReadArray: pointers to the reads found,
+    the stack used to walk the containment index, and room for a pointer to the base
+    qualities of each read. Threads which look up windows in the same ReadArray at the
+    same time each need their own ReadWindow.
     """
-    cdef int low = 0
-    cdef int high = nReads
-    cdef int mid = 0
+    def __init__(self):
+        self.reads = NULL
+        self.index_stack = NULL
+        self.base_qualities = NULL
+        self.capacity = 0
 
-    while low < high:
+    def __dealloc__(self):
+        free(self.reads)
+        free(self.index_stack)
+        free(self.base_qualities)
 
-        mid = (low + high) / 2
+    cdef void reserve(self, int n_reads):
+        """
+        Make room for windows of up to 'n_reads' reads. Buffers are never shrunk.
+        """
+        if n_reads <= self.capacity:
+            return
 
-        if testPos < reads[mid].core.pos:
-            high = mid
-        else:
-            low = mid + 1
+        free(self.reads)
+        free(self.index_stack)
+        free(self.base_qualities)
 
-    return low
+        self.reads = <CompactRead**>(malloc(n_reads * sizeof(CompactRead*)))
+        self.index_stack = <int*>(malloc(n_reads * sizeof(int)))
+        self.base_qualities = <uint8_t**>(malloc(n_reads * sizeof(uint8_t*)))
+
+        if self.reads == NULL or self.index_stack == NULL or self.base_qualities == NULL:
+            raise StandardError, "Could not allocate ReadWindow"
+
+        self.capacity = n_reads
 
 
 cdef class ReadArray:
     """
-    Simple structure to wrap a raw C array, with some bounds
-    checking.
+    Stores a sorted array of reads in memory. Rather than allocating each read
+    separately, the reads are projected into CompactRead records in one large contiguous
+    slab and indexed by their offset into it. Loading a cluster of reads therefore needs
+    only a handful of allocations, and the whole cluster is freed in one call.
+
+    Windows of reads are looked up through a nested containment list, which is built
+    the first time a window is requested after reads have been added. Reads which are
+    contained in another read are stored in that read's sub-list, so the reads in each
+    list have increasing start and end positions and can be bisected on either. A long
+    read therefore only affects the cost of queries which actually overlap it.
     """
     def __init__(self, int size):
         """
-        Allocate an array of size 'size', with initial values
-        'init'.
+        Allocate space for 'size' reads. The slab is sized for reads of a typical
+        length and grows as needed.
         """
-        self.reads = <bam1_t**>(malloc(size*sizeof(bam1_t*)))
+        self.reads = <CompactRead**>(malloc(size*sizeof(CompactRead*)))
+        self.__offsets = <size_t*>(malloc(size*sizeof(size_t)))
         assert self.reads != NULL, "Could not allocate memory for ReadArray"
-        
+        assert self.__offsets != NULL, "Could not allocate memory for ReadArray"
+
+        self.__slab_capacity = size * TYPICAL_RECORD_SIZE
+        self.__slab_size = 0
+        self.__slab = <uint8_t*>(malloc(self.__slab_capacity))
+        assert self.__slab != NULL, "Could not allocate memory for ReadArray"
+
         self.__size = 0 # We don't put anything in here yet, just allocate memory
         self.__capacity = size
-        self.__longest_read = 0
+        self.__pointers_are_stale = 0
+
+        self.__parents = NULL
+        self.__child_offsets = NULL
+        self.__child_counts = NULL
+        self.__members = NULL
+        self.__index_stack = NULL
+        self.__window = None
+        self.__index_capacity = 0
+        self.__num_top_level_reads = 0
+        self.__index_is_stale = 1
 
         cdef int index = 0
 
         for index from 0 <= index < size:
             self.reads[index] = NULL
-    
+
     def __dealloc__(self):
         """
-        Free memory
+        Free memory. The reads live in the slab, so they are not freed individually.
         """
-        cdef int index = 0
+        free(self.reads)
+        free(self.__offsets)
+        free(self.__slab)
+        free(self.__parents)
+        free(self.__child_offsets)
+        free(self.__child_counts)
+        free(self.__members)
+        free(self.__index_stack)
 
-        if self.reads != NULL:
-            for index from 0 <= index < self.__size:
-                if self.reads[index] != NULL:
-                    bam_destroy1(self.reads[index])
-                    self.reads[index] = NULL
-            
-            free(self.reads)
+    cdef void clear(self):
+        """
+        Remove all the reads, but keep the buffers so the array can be re-used.
+        """
+        self.__size = 0
+        self.__slab_size = 0
+        self.__pointers_are_stale = 0
+        self.__index_is_stale = 1
 
-    cdef void append(self, bam1_t* read):
+    cdef void reserve(self, int n_reads):
         """
-        Append a new read to the array, re-allocating if necessary.
+        Grow the buffers to hold at least 'n_reads' reads of a typical length, so that
+        loading them needs no further re-allocation. Buffers are never shrunk.
         """
-        cdef bam1_t** temp = NULL
+        cdef CompactRead** temp = NULL
+        cdef size_t* temp_offsets = NULL
+        cdef uint8_t* temp_slab = NULL
+        cdef size_t new_slab_capacity = n_reads * TYPICAL_RECORD_SIZE
 
-        if self.__size == self.__capacity:
-            temp = <bam1_t**>(realloc(self.reads, 2*sizeof(bam1_t*)*self.__capacity))
+        if n_reads > self.__capacity:
+            temp = <CompactRead**>(realloc(self.reads, n_reads * sizeof(CompactRead*)))
+            temp_offsets = <size_t*>(realloc(self.__offsets, n_reads * sizeof(size_t)))
+
+            if temp == NULL or temp_offsets == NULL:
+                raise StandardError, "Could not re-allocate ReadArray"
+
+            self.reads = temp
+            self.__offsets = temp_offsets
+            self.__capacity = n_reads
+
+        if new_slab_capacity > self.__slab_capacity:
+            temp_slab = <uint8_t*>(realloc(self.__slab, new_slab_capacity))
 
-            if temp == NULL:
+            if temp_slab == NULL:
                 raise StandardError, "Could not re-allocate ReadArray"
+
+            self.__slab = temp_slab
+            self.__slab_capacity = new_slab_capacity
+            self.__pointers_are_stale = 1
+
+    cdef CompactRead* allocate_record(self, size_t record_size) nogil except NULL:
+        """
+        Reserve space for a record of 'record_size' bytes at the end of the slab,
+        re-allocating if necessary, and return a pointer to it. Only takes the GIL to
+        raise an error, so reads can be loaded with the GIL released.
+        """
+        cdef CompactRead** temp = NULL
+        cdef size_t* temp_offsets = NULL
+        cdef uint8_t* temp_slab = NULL
+        cdef size_t new_slab_capacity = 0
+        cdef CompactRead* record = NULL
+
+        if self.__size == self.__capacity:
+            temp = <CompactRead**>(realloc(self.reads, 2*sizeof(CompactRead*)*self.__capacity))
+            temp_offsets = <size_t*>(realloc(self.__offsets, 2*sizeof(size_t)*self.__capacity))
+
+            if temp == NULL or temp_offsets == NULL:
+                with gil:
+                    raise StandardError, "Could not re-allocate ReadArray"
             else:
                 self.reads = temp
+                self.__offsets = temp_offsets
                 self.__capacity *= 2
 
-        self.reads[self.__size] = bam_dup1(read)
+        if self.__slab_size + record_size > self.__slab_capacity:
+            new_slab_capacity = 2 * self.__slab_capacity
+
+            while self.__slab_size + record_size > new_slab_capacity:
+                new_slab_capacity *= 2
+
+            temp_slab = <uint8_t*>(realloc(self.__slab, new_slab_capacity))
+
+            if temp_slab == NULL:
+                with gil:
+                    raise StandardError, "Could not re-allocate ReadArray"
+            else:
+                # Moving the slab invalidates the read pointers, which are re-computed from
+                # the offsets when they are next needed.
+                self.__slab = temp_slab
+                self.__slab_capacity = new_slab_capacity
+                self.__pointers_are_stale = 1
+
+        record = <CompactRead*>(self.__slab + self.__slab_size)
+
+        self.__offsets[self.__size] = self.__slab_size
+        self.reads[self.__size] = record
+        self.__slab_size += record_size
         self.__size += 1
+        self.__index_is_stale = 1
+
+        return record
+
+    cdef int append(self, bam1_t* read, int sample_level=0) nogil except -1:
+        """
+        Project a new read into the slab, re-allocating if necessary. 'sample_level' is
+        the level at which the read was kept by a DepthCap, if any.
+        """
+        cdef CompactRead* record = self.allocate_record(get_slab_record_size(read))
+
+        project_read(read, record, sample_level)
+        return 0
+
+    cdef void append_compact_read(self, CompactRead* read):
+        """
+        Copy a read which has already been projected, e.g. from another ReadArray,
+        into the slab.
+        """
+        cdef size_t record_size = get_compact_read_record_size(read)
+        cdef CompactRead* record = self.allocate_record(record_size)
+
+        memcpy(record, read, record_size)
+
+    cdef void copy_reads_ending_after(self, int start, ReadArray destination):
+        """
+        Append every read which ends after 'start' to 'destination', keeping them in
+        sorted order. Used to carry reads over into the next cluster on the same
+        chromosome without fetching them again.
+        """
+        cdef int index = 0
+
+        if self.__pointers_are_stale == 1:
+            self.update_read_pointers()
+
+        for index from 0 <= index < self.__size:
+            if self.reads[index].end > start:
+                destination.append_compact_read(self.reads[index])
+
+    cdef int get_size(self) nogil:
+        return self.__size
+
+    cdef size_t get_memory_usage(self):
+        """
+        Number of bytes currently allocated by the array, including unused capacity.
+        """
+        return self.__slab_capacity + self.__capacity * (sizeof(CompactRead*) + sizeof(size_t)) + \
+            self.__index_capacity * (5 * sizeof(int) + sizeof(CompactRead*))
+
+    cdef void update_read_pointers(self):
+        """
+        Re-compute the pointer to each read from its offset into the slab. This is
+        needed after the slab has been moved by realloc.
+        """
+        cdef int index = 0
+
+        for index from 0 <= index < self.__size:
+            self.reads[index] = <CompactRead*>(self.__slab + self.__offsets[index])
+
+        self.__pointers_are_stale = 0
+
+    cdef void build_interval_index(self):
+        """
+        Build the nested containment list. The reads are already sorted by start
+        position, so a read's parent is the closest earlier read which ends after it,
+        and is found with a stack of the reads which could still contain later reads.
+        Reads with the same end are siblings rather than nested, which keeps identical
+        reads at high depth from forming long chains.
+        """
+        cdef int n = self.__size
+        cdef int i = 0
+        cdef int parent = 0
+        cdef int depth = 0
+        cdef int next_offset = 0
+        cdef int* cursors = NULL
+
+        if n > self.__index_capacity:
+            free(self.__parents)
+            free(self.__child_offsets)
+            free(self.__child_counts)
+            free(self.__members)
+            free(self.__index_stack)
+
+            self.__parents = <int*>(malloc(self.__capacity * sizeof(int)))
+            self.__child_offsets = <int*>(malloc(self.__capacity * sizeof(int)))
+            self.__child_counts = <int*>(malloc(self.__capacity * sizeof(int)))
+            self.__members = <int*>(malloc(self.__capacity * sizeof(int)))
+            self.__index_stack = <int*>(malloc(self.__capacity * sizeof(int)))
+
+            if self.__parents == NULL or self.__child_offsets == NULL or self.__child_counts == NULL or \
+                    self.__members == NULL or self.__index_stack == NULL:
+                raise StandardError, "Could not allocate interval index for ReadArray"
+
+            self.__index_capacity = self.__capacity
+
+        self.__num_top_level_reads = 0
+
+        for i from 0 <= i < n:
+            self.__child_counts[i] = 0
+
+            while depth > 0 and self.reads[self.__index_stack[depth - 1]].end <= self.reads[i].end:
+                depth -= 1
+
+            if depth == 0:
+                self.__parents[i] = -1
+                self.__num_top_level_reads += 1
+            else:
+                parent = self.__index_stack[depth - 1]
+                self.__parents[i] = parent
+                self.__child_counts[parent] += 1
+
+            self.__index_stack[depth] = i
+            depth += 1
+
+        # The top-level list comes first in __members, followed by each sub-list in
+        # order of its parent. The stack is re-used to hold the fill position of each
+        # sub-list.
+        cursors = self.__index_stack
+        next_offset = self.__num_top_level_reads
 
-        cdef int read_length = bam_endpos(read) - read.core.pos
+        for i from 0 <= i < n:
+            self.__child_offsets[i] = next_offset
+            cursors[i] = next_offset
+            next_offset += self.__child_counts[i]
 
-        if read_length > self.__longest_read:
-            self.__longest_read = read_length
+        next_offset = 0
+
+        for i from 0 <= i < n:
+            parent = self.__parents[i]
+
+            if parent == -1:
+                self.__members[next_offset] = i
+                next_offset += 1
+            else:
+                self.__members[cursors[parent]] = i
+                cursors[parent] += 1
+
+        self.__index_is_stale = 0
+
+    cdef int find_first_read_ending_after(self, int list_begin, int list_end, int pos) nogil:
+        """
+        Bisect one list of the containment index for the first read which ends after
+        'pos'. Returns list_end if there is none.
+        """
+        cdef int low = list_begin
+        cdef int high = list_end
+        cdef int mid = 0
+
+        while low < high:
+            mid = (low + high) / 2
+
+            if self.reads[self.__members[mid]].end <= pos:
+                low = mid + 1
+            else:
+                high = mid
+
+        return low
+
+    cdef void prepare_interval_queries(self):
+        """
+        Bring the read pointers and the containment index up to date, so that windows
+        can be looked up with find_reads_in_interval.
+        """
+        if self.__pointers_are_stale == 1:
+            self.update_read_pointers()
+
+        if self.__index_is_stale == 1 and self.__size > 0:
+            self.build_interval_index()
+
+    cdef int find_reads_in_interval(self, int start, int end, ReadWindow window) nogil:
+        """
+        Fill 'window' with exactly the reads which overlap [start, end), which are not
+        in sorted order, and return how many there are. The array must not have changed
+        since prepare_interval_queries was called, and is not modified here, so several
+        threads can look up windows at once as long as each has its own ReadWindow.
+        """
+        cdef int n_found = 0
+        cdef int depth = 0
+        cdef int parent = -1
+        cdef int list_begin = 0
+        cdef int list_end = 0
+        cdef int index = 0
+        cdef int read_index = 0
+
+        if self.__size == 0:
+            return 0
+
+        # Scan the top-level list, and then the sub-list of every overlapping read
+        # found. Reads contained in a read which does not overlap the interval cannot
+        # overlap it either.
+        while True:
+            if parent == -1:
+                list_begin = 0
+                list_end = self.__num_top_level_reads
+            else:
+                list_begin = self.__child_offsets[parent]
+                list_end = list_begin + self.__child_counts[parent]
+
+            index = self.find_first_read_ending_after(list_begin, list_end, start)
+
+            while index < list_end:
+                read_index = self.__members[index]
+
+                if self.reads[read_index].pos >= end:
+                    break
+
+                window.reads[n_found] = self.reads[read_index]
+                n_found += 1
+
+                if self.__child_counts[read_index] > 0:
+                    window.index_stack[depth] = read_index
+                    depth += 1
+
+                index += 1
+
+            if depth == 0:
+                break
+
+            depth -= 1
+            parent = window.index_stack[depth]
+
+        return n_found
 
     cdef void set_pointers_to_start_and_end_of_interval(
             self,
             int start,
             int end,
-            bam1_t*** window_start,
-            bam1_t*** window_end
+            CompactRead*** window_start,
+            CompactRead*** window_end
     ):
         """
-        Set the start and end pointers to point to the relevant first and
-        last +1 reads as specified by the co-ordinates.
+        Set the start and end pointers to delimit exactly the reads which overlap
+        [start, end). The window is an internal buffer of read pointers, which is only
+        valid until the next call, and the reads in it are not in sorted order.
         """
-        cdef int firstOverlapStart = -1
-        cdef int startPosOfReads = -1
-        cdef int endPosOfReads = -1
+        cdef int n_found = 0
 
-        if self.__size == 0:
-            window_start[0] = self.reads
-            window_end[0] = self.reads
-        else:
-            firstOverlapStart = max(1, start - self.__longest_read)
-            startPosOfReads = bisectReadsLeft(self.reads, firstOverlapStart, self.__size)
-            endPosOfReads = bisectReadsLeft(self.reads, end, self.__size)
+        self.prepare_interval_queries()
 
-            while startPosOfReads < self.__size and bam_endpos(self.reads[startPosOfReads]) <= start:
-                startPosOfReads += 1
+        if self.__window is None:
+            self.__window = ReadWindow()
 
-            window_start[0] = self.reads + startPosOfReads
-            window_end[0] = min(self.reads + endPosOfReads, self.reads + self.__size)
+        self.__window.reserve(self.__size)
+        n_found = self.find_reads_in_interval(start, end, self.__window)
 
-            assert startPosOfReads <= endPosOfReads
+        window_start[0] = self.__window.reads
+        window_end[0] = self.__window.reads + n_found
 
     cdef int count_reads_in_interval(self, int start_pos, int end_pos):
         """
         Utility function for returning the number of reads in a specified genomic interval.        
         """
-        cdef bam1_t** start
-        cdef bam1_t** end
+        cdef CompactRead** start
+        cdef CompactRead** end
 
         self.set_pointers_to_start_and_end_of_interval(start_pos, end_pos, &start, &end)
 
         return end - start
 
 
+cdef class ReadArrayPool:
+    """
+    Keeps ReadArrays between clusters, so that their buffers are re-used instead of
+    being allocated and grown again for every cluster. If a read count estimator is
+    given, each array handed out is pre-sized for the estimated number of reads in the
+    cluster it will hold.
+
+    If 'max_array_bytes' is more than 0, arrays whose buffers have grown beyond that
+    many bytes are freed when they are given back, instead of being kept at that size.
+    """
+    def __init__(self, read_count_estimator=None, long max_array_bytes=0):
+        self.free_arrays = []
+        self.read_count_estimator = read_count_estimator
+        self.max_array_bytes = max_array_bytes
+
+    cdef object estimate_reads(self, chrom, int begin, int end):
+        """
+        Return the estimated number of reads in chrom:begin-end, or None if there is no
+        read count estimator.
+        """
+        if self.read_count_estimator is None:
+            return None
+
+        return self.read_count_estimator.estimate_reads_in_region(chrom, begin, end)
+
+    cdef ReadArray acquire(self, chrom, int begin, int end):
+        """
+        Return an empty ReadArray with room for the reads in chrom:begin-end.
+        """
+        cdef ReadArray read_array
+        cdef int expected_reads = self.estimate_reads(chrom, begin, end) or 0
+
+        if len(self.free_arrays) > 0:
+            read_array = self.free_arrays.pop()
+            read_array.clear()
+        else:
+            read_array = ReadArray(100)
+
+        read_array.reserve(expected_reads)
+        return read_array
+
+    cdef void release(self, ReadArray read_array):
+        """
+        Give back an array which is no longer needed. Its reads must not be used after
+        this.
+        """
+        if self.max_array_bytes > 0 and read_array.get_memory_usage() > self.max_array_bytes:
+            return
+
+        self.free_arrays.append(read_array)
+
+
+cdef class TargetSpans:
+    """
+    The merged (begin, end) spans of the targets on one reference, used to tell which
+    reads overlap a target. Every read overlaps the targets until they have been set.
+    """
+    def __init__(self):
+        self.tid = -1
+        self.begins = NULL
+        self.ends = NULL
+        self.n_spans = 0
+
+    def __dealloc__(self):
+        free(self.begins)
+        free(self.ends)
+
+    cdef int set_spans(self, int tid, spans) except -1:
+        """
+        Set the (begin, end) spans of the targets on reference 'tid'.
+        """
+        cdef int n_spans = 0
+        cdef int* begins = <int*>(realloc(self.begins, max(1, len(spans)) * sizeof(int)))
+        cdef int* ends = NULL
+
+        if begins != NULL:
+            self.begins = begins
+
+        ends = <int*>(realloc(self.ends, max(1, len(spans)) * sizeof(int)))
+
+        if ends != NULL:
+            self.ends = ends
+
+        if begins == NULL or ends == NULL:
+            raise StandardError, "Could not allocate TargetSpans"
+
+        # Overlapping targets are merged, so the spans are sorted by their ends too
+        for begin, end in sorted(spans):
+            if n_spans > 0 and begin <= ends[n_spans - 1]:
+                ends[n_spans - 1] = max(ends[n_spans - 1], end)
+            else:
+                begins[n_spans] = begin
+                ends[n_spans] = end
+                n_spans += 1
+
+        self.tid = tid
+        self.n_spans = n_spans
+        return 0
+
+    cdef int overlaps(self, bam1_t* read) nogil:
+        """
+        Returns 1 if the read overlaps one of the targets, or if they have not been set,
+        otherwise 0.
+        """
+        cdef int pos = read.core.pos
+        cdef int low = 0
+        cdef int high = self.n_spans
+        cdef int mid = 0
+
+        if self.tid == -1:
+            return 1
+
+        if read.core.tid != self.tid:
+            return 0
+
+        # Find the first target ending after the start of the read
+        while low < high:
+            mid = (low + high) / 2
+
+            if self.ends[mid] <= pos:
+                low = mid + 1
+            else:
+                high = mid
+
+        return low < self.n_spans and self.begins[low] < bam_endpos(read)
+
+
+cdef class ReadFilter:
+    """
+    Decides which reads are loaded at all. Reads are filtered as they are read from
+    the BAM file, so excluded reads are never copied into a ReadArray or passed to the
+    coverage calculators. The number of reads discarded for each reason is recorded.
+
+    Neighbouring clusters can fetch the same reads, so a read is only counted the first
+    time it is seen. Regions must be fetched in sorted order for this to work. Once the
+    targets on a reference have been set, only discarded reads which overlap one of
+    them are counted, so the counts do not depend on how much of the file around the
+    targets was read.
+    """
+    def __init__(
+            self,
+            count_duplicates,
+            count_secondary,
+            count_supplementary,
+            count_qc_fail,
+            int min_mapping_quality
+    ):
+        self.excluded_flags = 0
+
+        if not count_duplicates:
+            self.excluded_flags |= BAM_FDUP
+
+        if not count_secondary:
+            self.excluded_flags |= BAM_FSECONDARY
+
+        if not count_supplementary:
+            self.excluded_flags |= BAM_FSUPPLEMENTARY
+
+        if not count_qc_fail:
+            self.excluded_flags |= BAM_FQCFAIL
+
+        self.min_mapping_quality = min_mapping_quality
+        self.counted_tid = -1
+        self.counted_until = -1
+        self.n_unmapped = 0
+        self.n_secondary = 0
+        self.n_supplementary = 0
+        self.n_qc_fail = 0
+        self.n_duplicate = 0
+        self.n_low_mapping_quality = 0
+        self.targets = TargetSpans()
+
+    cdef int set_targets(self, int tid, spans) except -1:
+        """
+        Set the (begin, end) spans of the targets on reference 'tid'. From now on, only
+        discarded reads on that reference which overlap a target are counted.
+        """
+        return self.targets.set_spans(tid, spans)
+
+    cdef int should_count(self, bam1_t* read) nogil:
+        """
+        Returns 1 if a discarded read should be counted, i.e. it has not been counted
+        before and, if the targets have been set, it overlaps one of them.
+        """
+        if read.core.tid == self.counted_tid and read.core.pos < self.counted_until:
+            return 0
+
+        return self.targets.overlaps(read)
+
+    cdef int passes(self, bam1_t* read) nogil:
+        """
+        Returns 1 if the read should be used, otherwise 0. Unmapped reads, including
+        unmapped reads placed next to their mapped mate, are always discarded.
+        """
+        cdef int flag = read.core.flag
+        cdef int count = 0
+
+        if flag & BAM_FUNMAP != 0 or read.core.n_cigar == 0:
+            self.n_unmapped += self.should_count(read)
+            return 0
+
+        if flag & self.excluded_flags == 0 and read.core.qual >= self.min_mapping_quality:
+            return 1
+
+        count = self.should_count(read)
+
+        if flag & self.excluded_flags & BAM_FSECONDARY != 0:
+            self.n_secondary += count
+        elif flag & self.excluded_flags & BAM_FSUPPLEMENTARY != 0:
+            self.n_supplementary += count
+        elif flag & self.excluded_flags & BAM_FQCFAIL != 0:
+            self.n_qc_fail += count
+        elif flag & self.excluded_flags & BAM_FDUP != 0:
+            self.n_duplicate += count
+        else:
+            self.n_low_mapping_quality += count
+
+        return 0
+
+    cdef void mark_region_as_counted(self, int tid, int end):
+        """
+        Record that all reads starting before 'end' on reference 'tid' have been seen,
+        so they are not counted again if a later fetch returns them.
+        """
+        if tid != self.counted_tid:
+            self.counted_tid = tid
+            self.counted_until = end
+        elif end > self.counted_until:
+            self.counted_until = end
+
+    def get_discarded_read_counts(self):
+        return {
+            "unmapped": self.n_unmapped,
+            "secondary": self.n_secondary,
+            "supplementary": self.n_supplementary,
+            "qc_fail": self.n_qc_fail,
+            "duplicate": self.n_duplicate,
+            "low_mapping_quality": self.n_low_mapping_quality
+        }
+
+
+def make_read_filter(config):
+    """
+    Create a ReadFilter from the [reads] options in the configuration.
+    """
+    return ReadFilter(
+        config['count_duplicate_reads'],
+        config['count_secondary_reads'],
+        config['count_supplementary_reads'],
+        config['count_qc_fail_reads'],
+        config['min_mapq']
+    )
+
+
+cdef inline uint32_t hash_read_name(char* name) nogil:
+    """
+    32-bit FNV-1a hash of a NUL-terminated read name, with the MurmurHash3 finaliser
+    applied so that the high bits are well mixed. Mates share a name and so share a hash.
+    """
+    cdef uint32_t h = 2166136261U
+
+    while name[0] != 0:
+        h = (h ^ <uint8_t>name[0]) * 16777619U
+        name += 1
+
+    h ^= h >> 16
+    h *= 0x85ebca6bU
+    h ^= h >> 13
+    h *= 0xc2b2ae35U
+    h ^= h >> 16
+    return h
+
+
+cdef inline void heap_push(int* heap, int* size, int value) nogil:
+    """
+    Add a value to a binary min-heap holding 'size' values.
+    """
+    cdef int i = size[0]
+    cdef int parent
+
+    size[0] += 1
+
+    while i > 0:
+        parent = (i - 1) / 2
+
+        if heap[parent] <= value:
+            break
+
+        heap[i] = heap[parent]
+        i = parent
+
+    heap[i] = value
+
+
+cdef inline void heap_pop_until(int* heap, int* size, int value) nogil:
+    """
+    Remove all values less than or equal to 'value' from a binary min-heap.
+    """
+    cdef int i
+    cdef int child
+    cdef int last
+
+    while size[0] > 0 and heap[0] <= value:
+        size[0] -= 1
+        last = heap[size[0]]
+        i = 0
+
+        while True:
+            child = 2 * i + 1
+
+            if child >= size[0]:
+                break
+
+            if child + 1 < size[0] and heap[child + 1] < heap[child]:
+                child += 1
+
+            if heap[child] >= last:
+                break
+
+            heap[i] = heap[child]
+            i = child
+
+        heap[i] = last
+
+
+cdef class DepthCap:
+    """
+    Keeps a deterministic subset of the reads wherever the depth is more than
+    'max_depth', so that ultra-deep targets are not loaded in full. The depth at the
+    start of each read is counted from the reads seen so far which are still active
+    there. If this raw depth is more than max_depth * 2^(k-1) but at most
+    max_depth * 2^k, the read is kept only if the top k bits of the hash of its name are
+    zero, i.e. a fraction 1/2^k of the reads is kept at sample level k. Reads chosen at
+    a low level while the depth was still rising stay active, so as a backstop the level
+    is raised by one for every 'max_depth' kept reads still active at the start of the
+    read. Every read is dropped only by the hash of its name, so a read kept at level k
+    stands for 2^k reads on average, and the kept reads are spread evenly over the reads
+    of a deep target rather than taken from its left end.
+
+    Once the targets on a reference have been set, only reads which overlap a target
+    are counted or dropped; other reads are always kept. Every read overlapping a target
+    is fetched whatever the clusters are, so which reads are kept depends only on the
+    reads in the file and the targets. The same reads are kept on every run, and mates
+    are usually kept or dropped together.
+
+    Reads must be given in sorted order, and regions in order of their start. As for
+    the ReadFilter, neighbouring clusters can fetch the same reads; the decisions for
+    reads which may be fetched again are kept, and a read starting before the end of a
+    region already seen is given the same decision as the first time.
+    """
+    def __init__(self, int max_depth):
+        self.max_depth = max_depth
+        self.tid = -1
+        self.seen_until = -1
+        self.keep_from = -1
+        self.raw_ends = NULL
+        self.kept_ends = NULL
+        self.n_raw_ends = 0
+        self.n_kept_ends = 0
+        self.heap_capacity = 0
+        self.decisions = NULL
+        self.n_decisions = 0
+        self.decision_capacity = 0
+        self.replay_index = 0
+        self.n_seen = 0
+        self.n_dropped = 0
+        self.max_raw_depth = 0
+        self.max_kept_depth = 0
+        self.targets = TargetSpans()
+
+    def __dealloc__(self):
+        free(self.raw_ends)
+        free(self.kept_ends)
+        free(self.decisions)
+
+    cdef void start_reference(self, int tid) nogil:
+        """
+        Forget all the reads seen so far, as the reads from a new reference follow.
+        """
+        self.tid = tid
+        self.seen_until = -1
+        self.keep_from = -1
+        self.n_raw_ends = 0
+        self.n_kept_ends = 0
+        self.n_decisions = 0
+        self.replay_index = 0
+
+    cdef int find_decision(self, bam1_t* read, uint32_t name_hash) nogil:
+        """
+        Return the index of the decision made for a read which has been seen before, or
+        -1 if it is not found. Reads are fetched again in the same order, so the search
+        carries on from the last decision found.
+        """
+        cdef int pos = read.core.pos
+        cdef int index = self.replay_index
+        cdef DepthCapDecision* decision
+
+        while index < self.n_decisions and self.decisions[index].pos <= pos:
+            decision = &self.decisions[index]
+
+            if decision.pos == pos and decision.name_hash == name_hash and \
+                    decision.flag == read.core.flag and decision.end == bam_endpos(read):
+                self.replay_index = index + 1
+                return index
+
+            index += 1
+
+        return -1
+
+    cdef int record_decision(self, bam1_t* read, uint32_t name_hash, int level) nogil except -1:
+        """
+        Keep the decision made for a read, so it can be repeated if the read is fetched
+        again. Decisions for reads ending before the start of the current region are
+        discarded to make room, as they cannot be fetched again.
+        """
+        cdef int i
+        cdef int n_kept = 0
+        cdef DepthCapDecision* decisions
+
+        if self.n_decisions == self.decision_capacity:
+            for i from 0 <= i < self.n_decisions:
+                if self.decisions[i].end > self.keep_from:
+                    self.decisions[n_kept] = self.decisions[i]
+                    n_kept += 1
+
+            self.n_decisions = n_kept
+            self.replay_index = 0
+
+            # Grow if compacting did not free at least half of the space
+            if self.n_decisions * 2 >= self.decision_capacity:
+                decisions = <DepthCapDecision*>(realloc(
+                    self.decisions, 2 * (self.decision_capacity + 16) * sizeof(DepthCapDecision)
+                ))
+
+                if decisions == NULL:
+                    with gil:
+                        raise StandardError, "Could not allocate DepthCap"
+
+                self.decisions = decisions
+                self.decision_capacity = 2 * (self.decision_capacity + 16)
+
+        self.decisions[self.n_decisions].pos = read.core.pos
+        self.decisions[self.n_decisions].end = bam_endpos(read)
+        self.decisions[self.n_decisions].name_hash = name_hash
+        self.decisions[self.n_decisions].flag = read.core.flag
+        self.decisions[self.n_decisions].level = level
+        self.n_decisions += 1
+        return 0
+
+    cdef int reserve_heaps(self) nogil except -1:
+        """
+        Make room for one more read in each of the heaps of active read ends.
+        """
+        cdef int* raw_ends
+        cdef int* kept_ends
+
+        if self.n_raw_ends < self.heap_capacity:
+            return 0
+
+        raw_ends = <int*>(realloc(self.raw_ends, 2 * (self.heap_capacity + 16) * sizeof(int)))
+
+        if raw_ends != NULL:
+            self.raw_ends = raw_ends
+
+        kept_ends = <int*>(realloc(self.kept_ends, 2 * (self.heap_capacity + 16) * sizeof(int)))
+
+        if kept_ends != NULL:
+            self.kept_ends = kept_ends
+
+        if raw_ends == NULL or kept_ends == NULL:
+            with gil:
+                raise StandardError, "Could not allocate DepthCap"
+
+        self.heap_capacity = 2 * (self.heap_capacity + 16)
+        return 0
+
+    cdef int set_targets(self, int tid, spans) except -1:
+        """
+        Set the (begin, end) spans of the targets on reference 'tid'. From now on, only
+        reads on that reference which overlap a target are counted or dropped.
+        """
+        return self.targets.set_spans(tid, spans)
+
+    cdef int select(self, bam1_t* read) nogil except -2:
+        """
+        Returns the sample level at which the read is kept, or -1 if it is dropped.
+        """
+        cdef int pos = read.core.pos
+        cdef int end = bam_endpos(read)
+        cdef uint32_t name_hash
+        cdef int raw_depth
+        cdef int level = 0
+        cdef int index
+
+        if read.core.tid != self.tid:
+            self.start_reference(read.core.tid)
+
+        if self.targets.overlaps(read) == 0:
+            return 0
+
+        name_hash = hash_read_name(bam_get_qname(read))
+
+        if pos < self.seen_until:
+            index = self.find_decision(read, name_hash)
+
+            if index != -1:
+                return self.decisions[index].level
+
+            # Not seen before, e.g. because the regions were not fetched in order. The
+            # read is decided from the current depth but not counted.
+            raw_depth = self.n_raw_ends + 1
+        else:
+            self.reserve_heaps()
+            heap_pop_until(self.raw_ends, &self.n_raw_ends, pos)
+            heap_pop_until(self.kept_ends, &self.n_kept_ends, pos)
+            heap_push(self.raw_ends, &self.n_raw_ends, end)
+            raw_depth = self.n_raw_ends
+            self.n_seen += 1
+
+            if raw_depth > self.max_raw_depth:
+                self.max_raw_depth = raw_depth
+
+        while level < 31 and raw_depth > (<long>self.max_depth << level):
+            level += 1
+
+        level = min(31, level + self.n_kept_ends / self.max_depth)
+
+        if level > 0 and name_hash >> (32 - level) != 0:
+            level = -1
+
+        if pos < self.seen_until:
+            return level
+
+        self.record_decision(read, name_hash, level)
+
+        if level == -1:
+            self.n_dropped += 1
+            return -1
+
+        heap_push(self.kept_ends, &self.n_kept_ends, end)
+
+        if self.n_kept_ends > self.max_kept_depth:
+            self.max_kept_depth = self.n_kept_ends
+
+        return level
+
+    cdef void start_region(self, int tid, int start):
+        """
+        Called before the reads of a region are given. Regions must be given in order of
+        their start, so no read ending before 'start' can be given again.
+        """
+        if tid != self.tid:
+            self.start_reference(tid)
+
+        self.keep_from = start
+        self.replay_index = 0
+
+    cdef void mark_region_as_seen(self, int tid, int end):
+        """
+        Record that all reads starting before 'end' on reference 'tid' have been seen,
+        so they are given the same decision if a later fetch returns them.
+        """
+        if tid != self.tid:
+            self.start_reference(tid)
+
+        if end > self.seen_until:
+            self.seen_until = end
+
+    def get_depth_counts(self):
+        """
+        Return the number of reads seen and dropped, and the highest depth seen before
+        and after capping.
+        """
+        return {
+            "reads_seen": self.n_seen,
+            "reads_dropped": self.n_dropped,
+            "max_raw_depth": self.max_raw_depth,
+            "max_capped_depth": self.max_kept_depth
+        }
+
+
+def make_depth_cap(config):
+    """
+    Create a DepthCap from the [reads] options in the configuration, or return None if
+    the depth is not capped.
+    """
+    if config['max_depth'] <= 0:
+        return None
+
+    return DepthCap(config['max_depth'])
+
+
 class pyReadArray:
     """
     Expose the ReadArray class to Python. For testing and general utility.
@@ -198,14 +1132,76 @@ class pyReadArray:
 
         read_array.append(bam_record)
 
+    def clear(self):
+        """
+        Remove all the reads, keeping the allocated memory.
+        """
+        cdef ReadArray read_array = self._read_array
+        read_array.clear()
+
+    def reserve(self, int n_reads):
+        """
+        Grow the array to hold at least 'n_reads' reads.
+        """
+        cdef ReadArray read_array = self._read_array
+        read_array.reserve(n_reads)
+
     def count_reads_in_interval(self, int start_pos, int end_pos):
         """
         Utility function for returning the number of reads in a specified genomic interval.        
         """
-        cdef bam1_t** start
-        cdef bam1_t** end
+        cdef CompactRead** start
+        cdef CompactRead** end
         cdef ReadArray read_array = self._read_array
 
         read_array.set_pointers_to_start_and_end_of_interval(start_pos, end_pos, &start, &end)
 
-        return end - start
\ No newline at end of file
+        return end - start
+
+class pyReadFilter:
+    """
+    Expose the ReadFilter class to Python. For testing and general utility.
+    """
+    def __init__(self, config):
+        self._read_filter = make_read_filter(config)
+
+    def passes(self, AlignedSegment read):
+        cdef ReadFilter read_filter = self._read_filter
+        return read_filter.passes(read._delegate) == 1
+
+    def set_targets(self, int tid, spans):
+        cdef ReadFilter read_filter = self._read_filter
+        read_filter.set_targets(tid, spans)
+
+    def get_discarded_read_counts(self):
+        return self._read_filter.get_discarded_read_counts()
+
+
+class pyDepthCap:
+    """
+    Expose the DepthCap class to Python. For testing and general utility.
+    """
+    def __init__(self, int max_depth):
+        self._depth_cap = DepthCap(max_depth)
+
+    def select(self, AlignedSegment read):
+        """
+        Return the sample level at which the read is kept, or -1 if it is dropped.
+        """
+        cdef DepthCap depth_cap = self._depth_cap
+        return depth_cap.select(read._delegate)
+
+    def start_region(self, int tid, int start):
+        cdef DepthCap depth_cap = self._depth_cap
+        depth_cap.start_region(tid, start)
+
+    def mark_region_as_seen(self, int tid, int end):
+        cdef DepthCap depth_cap = self._depth_cap
+        depth_cap.mark_region_as_seen(tid, end)
+
+    def set_targets(self, int tid, spans):
+        cdef DepthCap depth_cap = self._depth_cap
+        depth_cap.set_targets(tid, spans)
+
+    def get_depth_counts(self):
+        return self._depth_cap.get_depth_counts()
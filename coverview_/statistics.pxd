@@ -2,8 +2,23 @@
 
 cdef class QualityHistogramArray:
     cdef int* n_data_points
-    cdef int** data
+    cdef void* counts
+    cdef int count_size
+    cdef int max_count
+    cdef int num_bins
+    cdef int* bin_qualities
+    cdef int* quality_bins
     cdef int num_hists
-    cdef float compute_fraction_below_threshold(self, int index, int threshold)
-    cdef float compute_median(self, int index)
-    cdef void add_data(self, int index, int quality_score)
\ No newline at end of file
+    cdef int* quality_has_runs
+    cdef size_t get_memory_usage(self) nogil
+    cdef float compute_fraction_below_threshold(self, int index, int threshold) nogil
+    cdef float compute_median(self, int index) nogil
+    cdef float compute_fraction_below_threshold_of_pair(self, int index_a, int index_b, int threshold) nogil
+    cdef float compute_median_of_pair(self, int index_a, int index_b) nogil
+    cdef void reset(self) nogil
+    cdef void add_quality_bin(self, int quality_score) nogil
+    cdef void widen_counts(self) nogil
+    cdef void add_to_count(self, int index, int quality_score, int amount) nogil
+    cdef void add_data(self, int index, int quality_score) nogil
+    cdef void add_data_to_run(self, int index_begin, int index_end, int quality_score, int multiplicity) nogil
+    cdef void sum_runs(self, int index_begin, int index_end) nogil
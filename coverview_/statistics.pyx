@@ -11,10 +11,52 @@ greater than the cost of the function call
 from __future__ import division
 
 
-cdef extern from "stdlib.h":
+from cpython cimport array
+from libc.math cimport NAN
+from libc.stdint cimport int8_t, int16_t, int32_t
+
+
+cdef extern from "stdlib.h" nogil:
     void free(void *)
     void* malloc(size_t)
     void* calloc(size_t,size_t)
+    void qsort(void*, size_t, size_t, int(*)(const void*, const void*))
+
+cdef extern from "string.h" nogil:
+    void* memset(void*, int, size_t)
+    void* memcpy(void*, void*, size_t)
+
+
+# Base and mapping qualities are stored in one byte in a BAM record
+DEF MAX_QUALITY = 255
+
+# Histograms only have bins for the distinct quality scores seen, as long as there are
+# at most this many of them. This is the case for binned base qualities from modern
+# Illumina instruments and for typical mapping qualities.
+DEF MAX_SPARSE_BINS = 16
+
+# Once there are more distinct quality scores, the histograms have bins for every score
+# in the range seen, which is extended in steps of this many scores so the histograms
+# are only re-laid out a few times as new scores are seen
+DEF QUALITY_RANGE_STEP = 8
+
+
+cdef inline int get_count(void* counts, int count_size, size_t position) nogil:
+    if count_size == 1:
+        return (<int8_t*>counts)[position]
+    elif count_size == 2:
+        return (<int16_t*>counts)[position]
+    else:
+        return (<int32_t*>counts)[position]
+
+
+cdef inline void set_count(void* counts, int count_size, size_t position, int value) nogil:
+    if count_size == 1:
+        (<int8_t*>counts)[position] = <int8_t>value
+    elif count_size == 2:
+        (<int16_t*>counts)[position] = <int16_t>value
+    else:
+        (<int32_t*>counts)[position] = value
 
 
 cdef class QualityHistogramArray:
@@ -22,46 +64,212 @@ cdef class QualityHistogramArray:
     Stores an array of histograms of quality scores and computes summary stats
     (mean, median etc) on that histogram. Using histograms for this rather
     than storing the raw quality values is an optimisation for both storage and
-    run-time. We store 101s elements per histogram rather than n_bases, and the median
-    can be computed in O(N) rather than O(N*logN).
+    run-time. We store one element per quality score per histogram rather than
+    n_bases, and the median can be computed in O(N) rather than O(N*logN).
+
+    All the histograms are kept in a single block of memory, with num_bins counts per
+    histogram. The bins are in order of quality score, and only exist for the quality
+    scores which have been seen: a sparse histogram with a bin for each distinct score
+    while there are at most MAX_SPARSE_BINS of them, and a dense one covering the range
+    of scores seen otherwise. Medians and fractions below a threshold then cost O(num_bins).
+    The counts start out as 8-bit integers which are widened to 16 and then 32 bits when
+    they would overflow.
+
+    A quality score can also be added to a run of consecutive histograms in constant
+    time with add_data_to_run, which only records the start and end of the run. The
+    runs must then be converted into counts with sum_runs before the histograms are
+    used. An array should be filled either with add_data or with add_data_to_run, but
+    not with both.
     """
     def __init__(self, int num_hists):
-        cdef int size = 101
         self.num_hists = num_hists
-        self.data = <int**>(malloc(num_hists*sizeof(int*)))
+        self.counts = NULL
+        self.count_size = sizeof(int8_t)
+        self.max_count = 127
+        self.num_bins = 0
         self.n_data_points = <int*>(calloc(num_hists, sizeof(int)))
+        self.quality_has_runs = <int*>(calloc(MAX_QUALITY + 1, sizeof(int)))
+        self.bin_qualities = <int*>(calloc(MAX_QUALITY + 1, sizeof(int)))
+        self.quality_bins = <int*>(malloc((MAX_QUALITY + 1) * sizeof(int)))
+        memset(self.quality_bins, -1, (MAX_QUALITY + 1) * sizeof(int))
 
+    def __dealloc__(self):
+        free(self.counts)
+        free(self.n_data_points)
+        free(self.quality_has_runs)
+        free(self.bin_qualities)
+        free(self.quality_bins)
+
+    cdef size_t get_memory_usage(self) nogil:
+        return self.num_hists * (self.num_bins * self.count_size + sizeof(int))
+
+    cdef void reset(self) nogil:
+        """
+        Empty all the histograms, so the array can be re-used. The bins and the count
+        size are kept.
+        """
+        if self.counts != NULL:
+            memset(self.counts, 0, self.num_hists * self.num_bins * self.count_size)
+
+        memset(self.n_data_points, 0, self.num_hists * sizeof(int))
+        memset(self.quality_has_runs, 0, (MAX_QUALITY + 1) * sizeof(int))
+
+    cdef void add_quality_bin(self, int quality_score) nogil:
+        """
+        Re-lay out the histograms with a bin for quality_score, and for every score in
+        the range seen if there are too many distinct scores for sparse histograms.
+        """
+        cdef int* old_bin_qualities = self.bin_qualities
+        cdef int old_num_bins = self.num_bins
+        cdef int new_num_bins = 0
+        cdef int min_quality
+        cdef int max_quality
+        cdef void* new_counts
+        cdef size_t i
+        cdef int b
+        cdef int quality
+
+        self.bin_qualities = <int*>(calloc(MAX_QUALITY + 1, sizeof(int)))
+
+        if old_num_bins < MAX_SPARSE_BINS:
+            for b from 0 <= b < old_num_bins:
+                if quality_score < old_bin_qualities[b] and new_num_bins == b:
+                    self.bin_qualities[new_num_bins] = quality_score
+                    new_num_bins += 1
+
+                self.bin_qualities[new_num_bins] = old_bin_qualities[b]
+                new_num_bins += 1
+
+            if new_num_bins == old_num_bins:
+                self.bin_qualities[new_num_bins] = quality_score
+                new_num_bins += 1
+        else:
+            min_quality = min(quality_score, old_bin_qualities[0])
+            max_quality = max(quality_score, old_bin_qualities[old_num_bins - 1])
+            min_quality = (min_quality // QUALITY_RANGE_STEP) * QUALITY_RANGE_STEP
+            max_quality = min(
+                ((max_quality + QUALITY_RANGE_STEP) // QUALITY_RANGE_STEP) * QUALITY_RANGE_STEP, MAX_QUALITY + 1
+            )
+
+            for quality from min_quality <= quality < max_quality:
+                self.bin_qualities[new_num_bins] = quality
+                new_num_bins += 1
+
+        for b from 0 <= b < new_num_bins:
+            self.quality_bins[self.bin_qualities[b]] = b
+
+        new_counts = calloc(self.num_hists * new_num_bins, self.count_size)
+
+        for i from 0 <= i < <size_t>self.num_hists:
+            for b from 0 <= b < old_num_bins:
+                set_count(
+                    new_counts,
+                    self.count_size,
+                    i * new_num_bins + self.quality_bins[old_bin_qualities[b]],
+                    get_count(self.counts, self.count_size, i * old_num_bins + b)
+                )
+
+        free(old_bin_qualities)
+        free(self.counts)
+        self.counts = new_counts
+        self.num_bins = new_num_bins
+
+    cdef void widen_counts(self) nogil:
+        """
+        Double the size of each count, when a count would overflow. Counts which grow by
+        more than one at a time may need widening twice.
+        """
+        cdef size_t num_counts = self.num_hists * self.num_bins
+        cdef int new_count_size = 2 * self.count_size
+        cdef void* new_counts = malloc(num_counts * new_count_size)
+        cdef size_t i
+
+        for i from 0 <= i < num_counts:
+            set_count(new_counts, new_count_size, i, get_count(self.counts, self.count_size, i))
+
+        free(self.counts)
+        self.counts = new_counts
+        self.count_size = new_count_size
+        self.max_count = 32767 if new_count_size == 2 else 2147483647
+
+    cdef void add_to_count(self, int index, int quality_score, int amount) nogil:
+        cdef size_t position
+        cdef int value
+
+        if self.quality_bins[quality_score] < 0:
+            self.add_quality_bin(quality_score)
+
+        position = <size_t>index * self.num_bins + self.quality_bins[quality_score]
+        value = get_count(self.counts, self.count_size, position) + amount
+
+        while value > self.max_count or value < -self.max_count - 1:
+            self.widen_counts()
+
+        set_count(self.counts, self.count_size, position, value)
+
+    cdef void add_data(self, int index, int quality_score) nogil:
+        self.n_data_points[index] += 1
+        self.add_to_count(index, quality_score, 1)
+
+    cdef void add_data_to_run(self, int index_begin, int index_end, int quality_score, int multiplicity) nogil:
+        """
+        Add quality_score 'multiplicity' times to each histogram in [index_begin, index_end),
+        as the difference between consecutive histograms. An index_end of -1 extends the
+        run to the end of the histograms which are later passed to sum_runs.
+        """
+        self.n_data_points[index_begin] += multiplicity
+        self.add_to_count(index_begin, quality_score, multiplicity)
+        self.quality_has_runs[quality_score] = 1
+
+        if index_end >= 0:
+            self.n_data_points[index_end] -= multiplicity
+            self.add_to_count(index_end, quality_score, -multiplicity)
+
+    cdef void sum_runs(self, int index_begin, int index_end) nogil:
+        """
+        Convert the runs added to the histograms in [index_begin, index_end) into counts,
+        by taking the cumulative sum over the histograms. Only the quality scores which
+        were added to runs are summed.
+        """
         cdef int i = 0
+        cdef int quality_bin = 0
+        cdef int running_total = 0
+        cdef size_t position
 
-        for i from 0 <= i < num_hists:
-            self.data[i] = <int*>(calloc(size, sizeof(int)))
+        for i from index_begin + 1 <= i < index_end:
+            self.n_data_points[i] += self.n_data_points[i - 1]
 
-    def __dealloc__(self):
-        cdef int i = 0
-        for i from 0 < i < self.num_hists:
-            free(self.data[i])
+        for quality_bin from 0 <= quality_bin < self.num_bins:
+            if self.quality_has_runs[self.bin_qualities[quality_bin]] == 0:
+                continue
 
-        free(self.data)
-        free(self.n_data_points)
+            running_total = 0
 
-    cdef void add_data(self, int index, int quality_score):
-        self.n_data_points[index] += 1
-        self.data[index][quality_score] += 1
+            for i from index_begin <= i < index_end:
+                position = <size_t>i * self.num_bins + quality_bin
+                running_total += get_count(self.counts, self.count_size, position)
 
-    cdef float compute_fraction_below_threshold(self, int index, int threshold):
+                while running_total > self.max_count:
+                    self.widen_counts()
+
+                set_count(self.counts, self.count_size, position, running_total)
+
+    cdef float compute_fraction_below_threshold(self, int index, int threshold) nogil:
 
         cdef int total = 0
         cdef int i = 0
+        cdef size_t row = <size_t>index * self.num_bins
 
         if self.n_data_points[index] == 0:
-            return float('NaN')
+            return NAN
         else:
-            for i from 0 <= i < threshold:
-                total += self.data[index][i]
+            while i < self.num_bins and self.bin_qualities[i] < threshold:
+                total += get_count(self.counts, self.count_size, row + i)
+                i += 1
 
             return <float>(total) / <float>(self.n_data_points[index])
 
-    cdef float compute_median(self, int index):
+    cdef float compute_median(self, int index) nogil:
 
         cdef int total = 0
         cdef int current_bin = 0
@@ -69,17 +277,72 @@ cdef class QualityHistogramArray:
         cdef int half = self.n_data_points[index] // 2
         cdef int is_even_number_of_data_points = (self.n_data_points[index] % 2 == 0)
         cdef int data_this_bin = 0
+        cdef size_t row = <size_t>index * self.num_bins
 
         if self.n_data_points[index] == 0:
-            return float('NaN')
+            return NAN
 
         while True:
-            data_this_bin = self.data[index][current_bin]
+            data_this_bin = get_count(self.counts, self.count_size, row + current_bin)
 
             if is_even_number_of_data_points and total == half and total + data_this_bin > half:
-                return (current_bin + last_non_empty_bin) / 2.0
+                return (self.bin_qualities[current_bin] + self.bin_qualities[last_non_empty_bin]) / 2.0
             elif total + data_this_bin > half:
-                return current_bin
+                return self.bin_qualities[current_bin]
+            else:
+                if data_this_bin > 0:
+                    last_non_empty_bin = current_bin
+
+                total += data_this_bin
+                current_bin += 1
+
+    cdef float compute_fraction_below_threshold_of_pair(self, int index_a, int index_b, int threshold) nogil:
+        """
+        Fraction of the data in the sum of the histograms at index_a and index_b which
+        lies below the threshold. Used to combine per-strand histograms.
+        """
+        cdef int total = 0
+        cdef int n_data_points = self.n_data_points[index_a] + self.n_data_points[index_b]
+        cdef size_t row_a = <size_t>index_a * self.num_bins
+        cdef size_t row_b = <size_t>index_b * self.num_bins
+        cdef int i = 0
+
+        if n_data_points == 0:
+            return NAN
+
+        while i < self.num_bins and self.bin_qualities[i] < threshold:
+            total += get_count(self.counts, self.count_size, row_a + i) + \
+                get_count(self.counts, self.count_size, row_b + i)
+            i += 1
+
+        return <float>(total) / <float>(n_data_points)
+
+    cdef float compute_median_of_pair(self, int index_a, int index_b) nogil:
+        """
+        Median of the sum of the histograms at index_a and index_b. Used to combine
+        per-strand histograms.
+        """
+        cdef int total = 0
+        cdef int current_bin = 0
+        cdef int last_non_empty_bin = -1
+        cdef int n_data_points = self.n_data_points[index_a] + self.n_data_points[index_b]
+        cdef int half = n_data_points // 2
+        cdef int is_even_number_of_data_points = (n_data_points % 2 == 0)
+        cdef int data_this_bin = 0
+        cdef size_t row_a = <size_t>index_a * self.num_bins
+        cdef size_t row_b = <size_t>index_b * self.num_bins
+
+        if n_data_points == 0:
+            return NAN
+
+        while True:
+            data_this_bin = get_count(self.counts, self.count_size, row_a + current_bin) + \
+                get_count(self.counts, self.count_size, row_b + current_bin)
+
+            if is_even_number_of_data_points and total == half and total + data_this_bin > half:
+                return (self.bin_qualities[current_bin] + self.bin_qualities[last_non_empty_bin]) / 2.0
+            elif total + data_this_bin > half:
+                return self.bin_qualities[current_bin]
             else:
                 if data_this_bin > 0:
                     last_non_empty_bin = current_bin
@@ -109,6 +372,22 @@ class pyQualityHistogramArray(object):
         cdef QualityHistogramArray hist_array = self._hist_array
         return hist_array.compute_median(index)
 
+    def add_data_to_run(self, int index_begin, int index_end, int quality_score, int multiplicity=1):
+        cdef QualityHistogramArray hist_array = self._hist_array
+        hist_array.add_data_to_run(index_begin, index_end, quality_score, multiplicity)
+
+    def sum_runs(self, int index_begin, int index_end):
+        cdef QualityHistogramArray hist_array = self._hist_array
+        hist_array.sum_runs(index_begin, index_end)
+
+    def compute_fraction_below_threshold_of_pair(self, int index_a, int index_b, int threshold):
+        cdef QualityHistogramArray hist_array = self._hist_array
+        return hist_array.compute_fraction_below_threshold_of_pair(index_a, index_b, threshold)
+
+    def compute_median_of_pair(self, int index_a, int index_b):
+        cdef QualityHistogramArray hist_array = self._hist_array
+        return hist_array.compute_median_of_pair(index_a, index_b)
+
 
 class pyQualityHistogram(object):
     """
@@ -149,4 +428,109 @@ def median(x):
             sorted_list[lower_index] + sorted_list[upper_index]
         )
     else:
-        return sorted_list[list_length // 2]
\ No newline at end of file
+        return sorted_list[list_length // 2]
+
+
+cdef int compare_longs(const void* a, const void* b) nogil:
+    cdef long x = (<long*>a)[0]
+    cdef long y = (<long*>b)[0]
+    return (x > y) - (x < y)
+
+
+def median_of_array(array.array data not None):
+    """
+    Calculate the median of an array of longs, as for median(), but sorting a copy
+    of the array in C rather than a list of Python integers.
+    """
+    cdef size_t length = len(data)
+    cdef long* values
+    cdef long lower
+    cdef long upper
+
+    if data.ob_descr.typecode != b'l':
+        return median(data)
+
+    if length == 0:
+        return float('NaN')
+
+    values = <long*>malloc(length * sizeof(long))
+    memcpy(values, data.data.as_longs, length * sizeof(long))
+    qsort(values, length, sizeof(long), compare_longs)
+
+    lower = values[(length - 1) // 2]
+    upper = values[length // 2]
+    free(values)
+
+    if length % 2 == 0:
+        return 0.5 * (lower + upper)
+    else:
+        return upper
+
+
+def min_or_nan_of_array(array.array data not None):
+    """
+    The minimum of an array of longs or floats, or NaN if it is empty. As for the
+    built-in min(), a value only replaces the current minimum if it compares less
+    than it, so NaN values are treated in the same way.
+    """
+    cdef size_t length = len(data)
+    cdef size_t i
+    cdef long min_long
+    cdef float min_float
+
+    if length == 0:
+        return float('NaN')
+
+    if data.ob_descr.typecode == b'l':
+        min_long = data.data.as_longs[0]
+
+        for i in range(1, length):
+            if data.data.as_longs[i] < min_long:
+                min_long = data.data.as_longs[i]
+
+        return min_long
+
+    if data.ob_descr.typecode == b'f':
+        min_float = data.data.as_floats[0]
+
+        for i in range(1, length):
+            if data.data.as_floats[i] < min_float:
+                min_float = data.data.as_floats[i]
+
+        return min_float
+
+    return min(data)
+
+
+def max_or_nan_of_array(array.array data not None):
+    """
+    The maximum of an array of longs or floats, or NaN if it is empty. NaN values
+    are treated as by the built-in max().
+    """
+    cdef size_t length = len(data)
+    cdef size_t i
+    cdef long max_long
+    cdef float max_float
+
+    if length == 0:
+        return float('NaN')
+
+    if data.ob_descr.typecode == b'l':
+        max_long = data.data.as_longs[0]
+
+        for i in range(1, length):
+            if data.data.as_longs[i] > max_long:
+                max_long = data.data.as_longs[i]
+
+        return max_long
+
+    if data.ob_descr.typecode == b'f':
+        max_float = data.data.as_floats[0]
+
+        for i in range(1, length):
+            if data.data.as_floats[i] > max_float:
+                max_float = data.data.as_floats[i]
+
+        return max_float
+
+    return max(data)
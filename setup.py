@@ -56,6 +56,15 @@ modules = [
         library_dirs=pysam_library_dirs,
         runtime_library_dirs=pysam_library_dirs
     ),
+    Extension(
+        "coverview_.fetch",
+        ["coverview_/fetch.pyx"],
+        include_dirs=include_dirs,
+        extra_compile_args=compile_flags,
+        libraries=['chtslib'],
+        library_dirs=pysam_library_dirs,
+        runtime_library_dirs=pysam_library_dirs
+    ),
     Extension(
         "coverview_.reads",
         ["coverview_/reads.pyx"],
@@ -0,0 +1,44 @@
+import testutils.runners
+import unittest
+
+
+class TestCoverViewWithAmpliconReads(unittest.TestCase):
+    """
+    In amplicon mode, reads with the same alignment are added to the coverage together.
+    Here we check that this gives the same output as adding them one at a time.
+    """
+    read_sets = [
+        ("1", 100, 150, 300),
+        ("1", 100, 120, 20),
+        ("1", 180, 150, 250),
+        ("1", 1990, 50, 4),
+    ]
+
+    regions = [
+        ("1", 90, 260, "Amplicon_1"),
+        ("1", 170, 340, "Amplicon_2"),
+        ("1", 1000, 3000, "Region_3"),
+    ]
+
+    def check_amplicon_mode_matches_default(self, command_line_arguments):
+        default_profiles, default_regions, _ = testutils.runners.run_coverview_and_load_outputs(
+            self.read_sets, self.regions, command_line_arguments
+        )
+
+        amplicon_profiles, amplicon_regions, _ = testutils.runners.run_coverview_and_load_outputs(
+            self.read_sets, self.regions, command_line_arguments + ["--amplicon"]
+        )
+
+        assert amplicon_profiles == default_profiles
+        assert amplicon_regions == default_regions
+        assert amplicon_regions["Amplicon_1"]["RC"] == 570
+
+    def test_amplicon_mode_matches_default(self):
+        self.check_amplicon_mode_matches_default([])
+
+    def test_amplicon_mode_matches_default_with_memory_limit_and_region_threads(self):
+        self.check_amplicon_mode_matches_default(["--max-memory", "1", "--region-threads", "2"])
+
+
+if __name__ == "__main__":
+    unittest.main()
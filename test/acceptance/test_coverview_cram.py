@@ -0,0 +1,45 @@
+import testutils.runners
+import unittest
+
+
+class TestCoverViewWithCRAMInput(unittest.TestCase):
+
+    def test_cram_profiles_match_bam_profiles(self):
+        read_sets = [
+            ("1", 32, 100, 3),
+            ("1", 90, 100, 2),
+            ("2", 500, 50, 4),
+        ]
+
+        regions = [
+            ("1", 20, 80, "Region_1"),
+            ("1", 60, 150, "Region_2"),
+            ("2", 480, 600, "Region_3"),
+        ]
+
+        bam_profiles = testutils.runners.run_coverview_and_load_outputs(read_sets, regions).profiles
+        cram_profiles = testutils.runners.run_coverview_and_load_outputs(read_sets, regions, use_cram=True).profiles
+
+        assert cram_profiles == bam_profiles
+        assert cram_profiles['Region_2']["1:100"]['COV'] == 5
+
+    def test_cram_read_counts_match_bam_read_counts(self):
+        read_sets = [
+            ("1", 32, 100, 3),
+            ("1", 500, 50, 4),
+        ]
+
+        regions = [
+            ("1", 20, 80, "Region_1"),
+        ]
+
+        bam_summary = testutils.runners.run_coverview_and_load_outputs(read_sets, regions).summary
+        cram_summary = testutils.runners.run_coverview_and_load_outputs(read_sets, regions, use_cram=True).summary
+
+        assert cram_summary == bam_summary
+        assert cram_summary["1"]["RC"] == 7
+        assert cram_summary["1"]["RCIN"] == 3
+
+
+if __name__ == "__main__":
+    unittest.main()
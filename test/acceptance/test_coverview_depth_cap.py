@@ -0,0 +1,81 @@
+import testutils.runners
+import unittest
+
+
+class TestCoverViewWithDepthCap(unittest.TestCase):
+    """
+    Reads are dropped by the depth cap wherever more than max_depth reads overlap a
+    target. Here we check that which reads are kept does not depend on how the regions
+    are grouped into clusters, that the capped depth stays close to max_depth, and that
+    the extrapolated coverage matches the depth before capping.
+    """
+    max_depth = 20
+
+    read_sets = [
+        ("1", 100, 100, 200),
+        ("1", 200, 100, 300),
+        ("1", 250, 100, 300),
+        ("1", 380, 100, 300),
+    ]
+
+    # The reads starting at 200 only overlap the gap between Region_1 and Region_2,
+    # and are only fetched when the two regions are in the same cluster
+    regions = [
+        ("1", 50, 150, "Region_1"),
+        ("1", 300, 400, "Region_2"),
+        ("1", 420, 500, "Region_3"),
+    ]
+
+    def run_coverview_with_depth_cap(self, command_line_arguments):
+        return testutils.runners.run_coverview_and_load_outputs(
+            self.read_sets,
+            self.regions,
+            command_line_arguments,
+            config_sections={"reads": {"max_depth": self.max_depth}}
+        )
+
+    def test_capped_output_does_not_depend_on_the_clusters(self):
+        profiles, regions, _ = self.run_coverview_with_depth_cap([])
+
+        for command_line_arguments in [
+            ["--reads-per-cluster", "1"],
+            ["--reads-per-cluster", "100"],
+            ["--max-memory", "1", "--reads-per-cluster", "100"],
+        ]:
+            other_profiles, other_regions, _ = self.run_coverview_with_depth_cap(command_line_arguments)
+
+            assert other_profiles == profiles
+            assert other_regions == regions
+
+    def test_capped_depth_stays_close_to_max_depth(self):
+        profiles, _, _ = self.run_coverview_with_depth_cap([])
+
+        for region_profile in profiles.values():
+            for position in region_profile.values():
+                assert position["COV"] <= 3 * self.max_depth
+
+    def test_extrapolated_coverage_matches_uncapped_coverage(self):
+        # Forty reads start every 5 bases, so the depth is 800 away from the ends. With a
+        # cap of 100 about 650 reads are kept, enough for a close estimate.
+        read_sets = [("1", 100 + 5 * i, 100, 40) for i in range(120)]
+        regions = [("1", 200, 600, "Region_1")]
+
+        uncapped_profiles = testutils.runners.run_coverview_and_load_outputs(read_sets, regions).profiles
+
+        capped_profiles = testutils.runners.run_coverview_and_load_outputs(
+            read_sets,
+            regions,
+            config_sections={"reads": {"max_depth": 100, "extrapolate_coverage": True}}
+        ).profiles
+
+        ratios = [
+            float(capped_profiles["Region_1"][position]["COV"]) / uncapped_profiles["Region_1"][position]["COV"]
+            for position in uncapped_profiles["Region_1"]
+        ]
+
+        assert uncapped_profiles["Region_1"]["1:400"]["COV"] == 800
+        assert 0.85 < sum(ratios) / len(ratios) < 1.15
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+import testutils.output_checkers
+import testutils.runners
+import unittest
+
+
+def run_coverview_and_load_discarded_read_counts(read_sets, regions, command_line_arguments, use_stdin=False):
+    with testutils.runners.CoverViewTestRunner() as runner:
+        for read_set in read_sets:
+            runner.add_reads(read_set)
+
+        for region in regions:
+            runner.add_region(region)
+
+        if use_stdin:
+            runner.use_stdin_input()
+
+        # The generated reads all have a mapping quality below 100
+        runner.add_ini_config_data("reads", {"min_mapq": 100})
+        runner.add_command_line_arguments(command_line_arguments)
+        status_code = runner.run_coverview_and_get_exit_code()
+        assert status_code == 0
+
+        return testutils.output_checkers.load_gui_json_output("output_meta.json")["discarded_reads"]
+
+
+class TestCoverViewDiscardedReadCounts(unittest.TestCase):
+
+    def test_only_reads_overlapping_targets_are_counted_however_they_are_read(self):
+        read_sets = [
+            ("1", 32, 100, 3),
+            ("1", 500, 50, 4),
+            ("1", 1950, 100, 2),
+            ("2", 500, 50, 1),
+        ]
+
+        regions = [
+            ("1", 20, 80, "Region_1"),
+            ("1", 1990, 2010, "Region_2"),
+        ]
+
+        counts = [
+            run_coverview_and_load_discarded_read_counts(read_sets, regions, arguments, use_stdin)
+            for arguments, use_stdin in [
+                ([], False),
+                (["--reads-per-cluster", "1"], False),
+                (["--sweep"], False),
+                ([], True),
+            ]
+        ]
+
+        assert counts[0]["low_mapping_quality"] == 5
+        assert all(mode_counts == counts[0] for mode_counts in counts)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+import testutils.runners
+import unittest
+
+
+DIRECTIONAL_CONFIG = {
+    "reads": {
+        "direction": True
+    }
+}
+
+
+class TestCoverViewWithMemoryLimit(unittest.TestCase):
+
+    def test_region_processed_in_tiles_matches_unlimited_output(self):
+        # With a 1 MB limit the region is processed in tiles of 1000 bases, and
+        # these reads cross the tile boundaries.
+        read_sets = [
+            ("1", 32, 100, 3),
+            ("1", 950, 100, 2),
+            ("1", 1990, 50, 4),
+            ("1", 2500, 100, 1),
+        ]
+
+        regions = [
+            ("1", 20, 3020, "Region_1"),
+            ("1", 1000, 1100, "Region_2"),
+        ]
+
+        unlimited_profiles, unlimited_regions, _ = testutils.runners.run_coverview_and_load_outputs(
+            read_sets, regions, [], DIRECTIONAL_CONFIG
+        )
+
+        limited_profiles, limited_regions, _ = testutils.runners.run_coverview_and_load_outputs(
+            read_sets, regions, ["--max-memory", "1"], DIRECTIONAL_CONFIG
+        )
+
+        assert limited_profiles == unlimited_profiles
+        assert limited_regions == unlimited_regions
+        assert limited_regions["Region_1"]["RC"] == 10
+        assert limited_regions["Region_1"]["RC+"] + limited_regions["Region_1"]["RC-"] == 10
+
+    def test_reads_loaded_in_tiles_match_unlimited_output(self):
+        # A 1 MB limit leaves room for a few hundred reads per cluster, so the reads
+        # of Region_1 are loaded one tile at a time. Region_3 is in a cluster of its
+        # own, which starts inside Region_1.
+        read_sets = [
+            ("1", 100, 100, 500),
+            ("1", 1950, 100, 500),
+            ("1", 2950, 100, 500),
+            ("1", 4200, 100, 300),
+        ]
+
+        regions = [
+            ("1", 50, 5000, "Region_1"),
+            ("1", 1000, 1100, "Region_2"),
+            ("1", 2900, 3100, "Region_3"),
+        ]
+
+        unlimited_profiles, unlimited_regions, _ = testutils.runners.run_coverview_and_load_outputs(
+            read_sets, regions, [], DIRECTIONAL_CONFIG
+        )
+
+        limited_profiles, limited_regions, _ = testutils.runners.run_coverview_and_load_outputs(
+            read_sets, regions, ["--max-memory", "1", "--reads-per-cluster", "100"], DIRECTIONAL_CONFIG
+        )
+
+        assert limited_profiles == unlimited_profiles
+        assert limited_regions == unlimited_regions
+        assert limited_regions["Region_1"]["RC"] == 1800
+        assert limited_regions["Region_2"]["RC"] == 0
+        assert limited_regions["Region_3"]["RC"] == 500
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,49 @@
+import testutils.runners
+import unittest
+
+
+class TestCoverViewWithOverlappingRegions(unittest.TestCase):
+    """
+    Overlapping regions share one coverage calculator over their union. Here we check
+    that each region still gets exactly the output it gets when processed on its own.
+    """
+    read_sets = [
+        ("1", 32, 100, 3),
+        ("1", 90, 100, 2),
+        ("1", 250, 50, 4),
+    ]
+
+    regions = [
+        ("1", 20, 150, "Region_1"),
+        ("1", 60, 100, "Region_2"),
+        ("1", 140, 280, "Region_3"),
+        ("1", 140, 280, "Region_4"),
+    ]
+
+    def check_overlapping_regions_match_separate_regions(self, command_line_arguments):
+        profiles, regions_output, _ = testutils.runners.run_coverview_and_load_outputs(
+            self.read_sets, self.regions, command_line_arguments
+        )
+
+        for region in self.regions:
+            separate_profiles, separate_regions_output, _ = testutils.runners.run_coverview_and_load_outputs(
+                self.read_sets, [region], command_line_arguments
+            )
+
+            region_name = region[3]
+            assert profiles[region_name] == separate_profiles[region_name]
+            assert regions_output[region_name] == separate_regions_output[region_name]
+
+        assert regions_output["Region_1"]["RC"] == 5
+        assert regions_output["Region_2"]["RC"] == 5
+        assert regions_output["Region_3"]["RC"] == 6
+
+    def test_overlapping_regions_match_separate_regions(self):
+        self.check_overlapping_regions_match_separate_regions([])
+
+    def test_overlapping_regions_match_separate_regions_in_sweep(self):
+        self.check_overlapping_regions_match_separate_regions(["--sweep"])
+
+
+if __name__ == "__main__":
+    unittest.main()
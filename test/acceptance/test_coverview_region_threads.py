@@ -0,0 +1,51 @@
+import testutils.runners
+import unittest
+
+
+class TestCoverViewWithRegionThreads(unittest.TestCase):
+    """
+    The regions of a cluster can be calculated on several threads sharing the cluster's
+    reads. Here we check that this gives the same output as a single thread.
+    """
+    read_sets = [
+        ("1", 32, 100, 3),
+        ("1", 90, 100, 2),
+        ("1", 250, 50, 4),
+        ("1", 1990, 50, 4),
+        ("1", 2500, 100, 1),
+    ]
+
+    regions = [
+        ("1", 20, 150, "Region_1"),
+        ("1", 60, 100, "Region_2"),
+        ("1", 140, 280, "Region_3"),
+        ("1", 400, 500, "Region_4"),
+        ("1", 1000, 3000, "Region_5"),
+        ("1", 2550, 2560, "Region_6"),
+    ]
+
+    def check_region_threads_match_single_thread(self, command_line_arguments):
+        single_thread_profiles, single_thread_regions, _ = testutils.runners.run_coverview_and_load_outputs(
+            self.read_sets, self.regions, command_line_arguments
+        )
+
+        threaded_profiles, threaded_regions, _ = testutils.runners.run_coverview_and_load_outputs(
+            self.read_sets, self.regions, command_line_arguments + ["--region-threads", "3"]
+        )
+
+        assert threaded_profiles == single_thread_profiles
+        assert threaded_regions == single_thread_regions
+        assert threaded_regions["Region_5"]["RC"] == 5
+
+    def test_region_threads_match_single_thread(self):
+        self.check_region_threads_match_single_thread([])
+
+    def test_region_threads_match_single_thread_with_memory_limit(self):
+        self.check_region_threads_match_single_thread(["--max-memory", "1"])
+
+    def test_region_threads_are_not_used_in_sweep(self):
+        self.check_region_threads_match_single_thread(["--sweep"])
+
+
+if __name__ == "__main__":
+    unittest.main()
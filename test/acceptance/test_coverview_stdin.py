@@ -0,0 +1,48 @@
+import testutils.runners
+import unittest
+
+
+class TestCoverViewWithStdinInput(unittest.TestCase):
+
+    def test_streamed_profiles_match_indexed_profiles(self):
+        read_sets = [
+            ("1", 32, 100, 3),
+            ("1", 90, 100, 2),
+            ("2", 500, 50, 1),
+        ]
+
+        regions = [
+            ("1", 20, 80, "Region_1"),
+            ("1", 60, 150, "Region_2"),
+            ("2", 140, 600, "Region_3"),
+            ("2", 5000, 5010, "Region_4"),
+        ]
+
+        indexed_profiles = testutils.runners.run_coverview_and_load_outputs(read_sets, regions).profiles
+        streamed_profiles = testutils.runners.run_coverview_and_load_outputs(
+            read_sets, regions, use_stdin=True).profiles
+
+        assert streamed_profiles == indexed_profiles
+        assert streamed_profiles['Region_3']["2:520"]['COV'] == 1
+        assert streamed_profiles['Region_4']["2:5000"]['COV'] == 0
+
+    def test_streamed_read_counts_match_indexed_read_counts(self):
+        read_sets = [
+            ("1", 32, 100, 3),
+            ("1", 500, 50, 4),
+        ]
+
+        regions = [
+            ("1", 20, 80, "Region_1"),
+        ]
+
+        indexed_summary = testutils.runners.run_coverview_and_load_outputs(read_sets, regions).summary
+        streamed_summary = testutils.runners.run_coverview_and_load_outputs(read_sets, regions, use_stdin=True).summary
+
+        assert streamed_summary == indexed_summary
+        assert streamed_summary["1"]["RC"] == 7
+        assert streamed_summary["1"]["RCIN"] == 3
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+import testutils.runners
+import unittest
+
+
+def run_coverview_and_load_profiles(read_sets, regions, command_line_arguments):
+    return testutils.runners.run_coverview_and_load_outputs(read_sets, regions, command_line_arguments).profiles
+
+
+class TestCoverViewChromosomeSweep(unittest.TestCase):
+
+    def test_sweep_output_matches_cluster_output(self):
+        read_sets = [
+            ("1", 32, 100, 3),
+            ("1", 90, 100, 2),
+            ("1", 500, 50, 1),
+        ]
+
+        regions = [
+            ("1", 20, 80, "Region_1"),
+            ("1", 60, 150, "Region_2"),
+            ("1", 140, 600, "Region_3"),
+        ]
+
+        cluster_output = run_coverview_and_load_profiles(read_sets, regions, [])
+        sweep_output = run_coverview_and_load_profiles(read_sets, regions, ["--sweep"])
+
+        assert sweep_output == cluster_output
+
+    def test_read_spanning_two_regions_is_counted_in_both(self):
+        profile_output = run_coverview_and_load_profiles(
+            [("1", 32, 100, 1)],
+            [("1", 35, 40, "Region_1"), ("1", 120, 125, "Region_2")],
+            ["--sweep"]
+        )
+
+        assert profile_output['Region_1']["1:35"]['COV'] == 1
+        assert profile_output['Region_2']["1:124"]['COV'] == 1
+
+    def test_regions_after_the_last_read_have_zero_coverage(self):
+        profile_output = run_coverview_and_load_profiles(
+            [("1", 32, 100, 1)],
+            [("1", 35, 40, "Region_1"), ("1", 1000, 1005, "Region_2")],
+            ["--sweep"]
+        )
+
+        assert profile_output['Region_1']["1:35"]['COV'] == 1
+        assert profile_output['Region_2']["1:1000"]['COV'] == 0
+        assert profile_output['Region_2']["1:1000"]['MEDBQ'] == "."
+
+
+class TestCoverViewClusterEnd(unittest.TestCase):
+
+    def test_reads_beyond_end_of_last_region_in_cluster_are_loaded(self):
+        profile_output = run_coverview_and_load_profiles(
+            [("1", 32, 100, 1), ("1", 400, 100, 2)],
+            [("1", 35, 600, "Region_1"), ("1", 40, 50, "Region_2")],
+            []
+        )
+
+        assert profile_output['Region_1']["1:450"]['COV'] == 2
+        assert profile_output['Region_2']["1:45"]['COV'] == 1
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+import testutils.runners
+import unittest
+
+
+class TestCoverViewWithDecompressionThreads(unittest.TestCase):
+    """
+    --threads attaches an htslib thread pool to the input file where htslib supports
+    it. Here we check that several clusters on several chromosomes, which need index
+    seeks between them, give the same output as with a single thread.
+    """
+    read_sets = [
+        ("1", 32, 100, 3),
+        ("1", 1990, 50, 4),
+        ("2", 500, 50, 4),
+        ("2", 2500, 100, 2),
+        ("3", 100, 100, 5),
+    ]
+
+    regions = [
+        ("1", 20, 150, "Region_1"),
+        ("1", 1000, 3000, "Region_2"),
+        ("2", 480, 600, "Region_3"),
+        ("2", 2550, 2560, "Region_4"),
+        ("3", 50, 250, "Region_5"),
+    ]
+
+    def check_threads_match_single_thread(self, use_cram):
+        single_thread_outputs = testutils.runners.run_coverview_and_load_outputs(
+            self.read_sets, self.regions, ["--reads-per-cluster", "1"], use_cram=use_cram
+        )
+
+        threaded_outputs = testutils.runners.run_coverview_and_load_outputs(
+            self.read_sets, self.regions, ["--reads-per-cluster", "1", "--threads", "2"], use_cram=use_cram
+        )
+
+        assert threaded_outputs == single_thread_outputs
+        assert threaded_outputs.regions["Region_2"]["RC"] == 4
+
+    def test_bam_output_with_threads_matches_single_thread(self):
+        self.check_threads_match_single_thread(use_cram=False)
+
+    def test_cram_output_with_threads_matches_single_thread(self):
+        self.check_threads_match_single_thread(use_cram=True)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+import array
+import coverview_.calculators
+import unittest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def make_per_base_coverage_summary(coverage, fractions, directional):
+    """
+    Make a summary with all the coverage profiles set to 'coverage' and all the
+    quality profiles set to 'fractions'. The per-strand profiles are None unless
+    'directional' is True.
+    """
+    coverage = array.array('l', coverage)
+    fractions = array.array('f', fractions)
+    strand_coverage = coverage if directional else None
+    strand_fractions = fractions if directional else None
+
+    return coverview_.calculators.PerBaseCoverageSummary(
+        *([3, 2, 1] + [coverage] * 2 + [fractions] * 4 +
+          ([strand_coverage] * 2 + [strand_fractions] * 4) * 2)
+    )
+
+
+class TestPerBaseCoverageSummaryArrays(unittest.TestCase):
+
+    def test_as_arrays_returns_the_stored_arrays(self):
+        summary = make_per_base_coverage_summary([1, 2, 3], [0.5, 0.25, 0.0], True)
+        arrays = summary.as_arrays()
+
+        assert arrays["RC"] == 3
+        assert arrays["COV"] is summary.coverage_at_each_base
+        assert arrays["FLMQ_r"] is summary.reverse_fraction_of_low_mapping_qualities_at_each_base
+
+    def test_as_dict_converts_the_arrays_to_lists(self):
+        summary = make_per_base_coverage_summary([1, 2, 3], [0.5, 0.25, 0.0], False)
+        summary_dict = summary.as_dict()
+
+        assert summary_dict["COV"] == [1, 2, 3]
+        assert summary_dict["FLBQ"] == [0.5, 0.25, 0.0]
+        assert "COV_f" not in summary_dict
+
+    def test_buffers_over_the_arrays_share_memory_with_the_profiles(self):
+        summary = make_per_base_coverage_summary([1, 2, 3], [0.5, 0.25, 0.0], False)
+        coverage_buffer = buffer(summary.as_arrays()["COV"])
+
+        assert array.array('l', coverage_buffer[:]) == array.array('l', [1, 2, 3])
+
+        summary.coverage_at_each_base[1] = 20
+        assert array.array('l', coverage_buffer[:]) == array.array('l', [1, 20, 3])
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_numpy_arrays_share_memory_with_the_profiles(self):
+        summary = make_per_base_coverage_summary([1, 2, 3], [0.5, 0.25, 0.0], False)
+        numpy_arrays = summary.as_numpy_arrays()
+
+        assert list(numpy_arrays["COV"]) == [1, 2, 3]
+        assert list(numpy_arrays["FLBQ"]) == [0.5, 0.25, 0.0]
+
+        summary.coverage_at_each_base[1] = 20
+        assert numpy_arrays["COV"][1] == 20
+
+
+if __name__ == "__main__":
+    unittest.main()
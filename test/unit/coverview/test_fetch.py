@@ -0,0 +1,144 @@
+import bamgen.bamgen
+import coverview_.fetch
+import os
+import pysam
+import tgmi.interval
+import unittest
+import uuid
+
+
+def get_positions_of_reads_overlapping_regions(file_name, chrom, regions):
+    positions = set()
+
+    with pysam.AlignmentFile(file_name, 'rb') as bam_file:
+        for begin, end in regions:
+            for read in bam_file.fetch(chrom, begin, end):
+                positions.add(read.reference_start)
+
+    return sorted(positions)
+
+
+class TestMultiRegionIterator(unittest.TestCase):
+    """
+    Here we are testing that the MultiRegionIterator returns each read overlapping
+    any of a list of regions exactly once, in sorted order.
+    """
+    def setUp(self):
+        self.unique_bam_file_name = str(uuid.uuid4())
+        self.unique_index_file_name = self.unique_bam_file_name + ".bai"
+
+    def tearDown(self):
+        os.remove(self.unique_bam_file_name)
+        os.remove(self.unique_index_file_name)
+
+    def get_iterator_positions(self, chrom, regions):
+        with pysam.AlignmentFile(self.unique_bam_file_name, 'rb') as bam_file:
+            read_iterator = coverview_.fetch.pyMultiRegionIterator(bam_file, chrom, regions)
+            return read_iterator.get_read_positions()
+
+    def test_iterator_returns_no_reads_for_empty_file(self):
+        read_sets = [
+            ("1", 32, 100, 0)
+        ]
+
+        bamgen.bamgen.make_bam_file(self.unique_bam_file_name, read_sets)
+
+        assert self.get_iterator_positions("1", [(0, 1000)]) == []
+
+    def test_iterator_returns_each_read_in_overlapping_regions_once(self):
+        read_sets = [
+            ("1", 100, 100, 10),
+            ("1", 150, 100, 10),
+            ("1", 5000, 100, 10)
+        ]
+
+        regions = [(120, 200), (180, 300), (5050, 5060)]
+
+        bamgen.bamgen.make_bam_file(self.unique_bam_file_name, read_sets)
+        positions = self.get_iterator_positions("1", regions)
+
+        assert positions == [100] * 10 + [150] * 10 + [5000] * 10
+
+    def test_iterator_matches_separate_fetches_of_many_regions(self):
+        read_sets = [("1", pos, 100, 5) for pos in range(0, 200000, 1000)]
+        regions = [(pos, pos + 50) for pos in range(500, 200000, 7000)]
+
+        bamgen.bamgen.make_bam_file(self.unique_bam_file_name, read_sets)
+        positions = self.get_iterator_positions("1", regions)
+        overlapping_positions = [
+            pos for pos in positions if any(pos < end and pos + 100 > begin for begin, end in regions)
+        ]
+
+        assert positions == sorted(positions)
+        assert sorted(set(overlapping_positions)) == get_positions_of_reads_overlapping_regions(
+            self.unique_bam_file_name, "1", regions
+        )
+        assert len(overlapping_positions) == 5 * len(set(overlapping_positions))
+
+    def test_iterator_starting_in_the_loaded_block_does_not_load_it_again(self):
+        read_sets = [
+            ("1", 100, 100, 10),
+            ("1", 5000, 100, 10)
+        ]
+
+        bamgen.bamgen.make_bam_file(self.unique_bam_file_name, read_sets)
+
+        with pysam.AlignmentFile(self.unique_bam_file_name, 'rb') as bam_file:
+            first_iterator = coverview_.fetch.pyMultiRegionIterator(bam_file, "1", [(100, 150)])
+            assert first_iterator.get_read_positions() == [100] * 10
+
+            second_iterator = coverview_.fetch.pyMultiRegionIterator(bam_file, "1", [(5000, 5050)])
+            assert second_iterator.get_read_positions()[-10:] == [5000] * 10
+
+            block_reuses, block_loads = second_iterator.get_block_counts()
+
+        assert block_reuses == 1
+        assert block_loads == 0
+
+
+class TestReadCountEstimator(unittest.TestCase):
+    """
+    Here we are testing that read counts estimated from the BAM index are roughly
+    right, and that clusters sized by estimated read count are shorter where the
+    coverage is deeper.
+    """
+    def setUp(self):
+        self.unique_bam_file_name = str(uuid.uuid4())
+        self.unique_index_file_name = self.unique_bam_file_name + ".bai"
+
+        read_sets = [("1", pos, 100, 100) for pos in range(0, 20000, 100)]
+        read_sets.extend(("1", pos, 100, 1) for pos in range(200000, 400000, 1000))
+        bamgen.bamgen.make_bam_file(self.unique_bam_file_name, read_sets)
+
+    def tearDown(self):
+        os.remove(self.unique_bam_file_name)
+        os.remove(self.unique_index_file_name)
+
+    def test_estimate_for_whole_chromosome_is_close_to_read_count(self):
+        with pysam.AlignmentFile(self.unique_bam_file_name, 'rb') as bam_file:
+            estimator = coverview_.fetch.make_read_count_estimator(bam_file)
+            estimate = estimator.estimate_reads_in_region("1", 0, 500000)
+
+        assert 0.8 * 20200 < estimate < 1.2 * 20200
+
+    def test_clusters_are_shorter_where_coverage_is_deeper(self):
+        intervals = [
+            tgmi.interval.GenomicInterval("1", pos, pos + 50) for pos in range(0, 400000, 1000)
+        ]
+
+        with pysam.AlignmentFile(self.unique_bam_file_name, 'rb') as bam_file:
+            estimator = coverview_.fetch.make_read_count_estimator(bam_file)
+            clusters = list(tgmi.interval.cluster_genomic_intervals(
+                intervals, read_count_estimator=estimator, max_reads=5000
+            ))
+
+        deep_clusters = [c for c in clusters if c[0].start_pos < 20000]
+        shallow_clusters = [c for c in clusters if c[0].start_pos >= 200000]
+
+        assert sum(len(c) for c in clusters) == len(intervals)
+        assert len(deep_clusters) > 2
+        assert len(shallow_clusters) == 1
+
+
+if __name__ == "__main__":
+    unittest.main()
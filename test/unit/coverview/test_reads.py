@@ -62,6 +62,272 @@ class TestReadArray(unittest.TestCase):
         assert read_array.count_reads_in_interval(0, 31) == 0
         assert read_array.count_reads_in_interval(132, 133) == 0
 
+    def test_read_array_counts_are_correct_after_slab_is_reallocated(self):
+        read_sets = [
+            ("1", 32, 100, 1000),
+            ("1", 1000, 100, 500)
+        ]
+
+        bamgen.bamgen.make_bam_file(self.unique_bam_file_name, read_sets)
+        read_array = load_bam_into_read_array(self.unique_bam_file_name)
+
+        assert read_array.count_reads_in_interval(32, 132) == 1000
+        assert read_array.count_reads_in_interval(1050, 1051) == 500
+        assert read_array.count_reads_in_interval(500, 600) == 0
+
+    def test_cleared_read_array_can_be_reused(self):
+        read_sets = [
+            ("1", 32, 100, 5)
+        ]
+
+        bamgen.bamgen.make_bam_file(self.unique_bam_file_name, read_sets)
+        read_array = load_bam_into_read_array(self.unique_bam_file_name)
+        assert read_array.count_reads_in_interval(32, 132) == 5
+
+        read_array.clear()
+        assert read_array.count_reads_in_interval(32, 132) == 0
+
+        read_array.reserve(10000)
+
+        with pysam.AlignmentFile(self.unique_bam_file_name, 'rb') as bam_file:
+            for read in bam_file:
+                read_array.append(read)
+
+        assert read_array.count_reads_in_interval(32, 132) == 5
+
+    def test_reads_contained_in_a_long_read_are_only_counted_where_they_overlap(self):
+        read_sets = [
+            ("1", 32, 5000, 1),
+            ("1", 100, 100, 10),
+            ("1", 1000, 100, 5)
+        ]
+
+        bamgen.bamgen.make_bam_file(self.unique_bam_file_name, read_sets)
+        read_array = load_bam_into_read_array(self.unique_bam_file_name)
+
+        assert read_array.count_reads_in_interval(150, 151) == 11
+        assert read_array.count_reads_in_interval(500, 600) == 1
+        assert read_array.count_reads_in_interval(1050, 1051) == 6
+        assert read_array.count_reads_in_interval(5032, 6000) == 0
+
+
+def make_read_filter_config(**kwargs):
+    config = {
+        "count_duplicate_reads": True,
+        "count_secondary_reads": True,
+        "count_supplementary_reads": True,
+        "count_qc_fail_reads": True,
+        "min_mapq": 0
+    }
+
+    config.update(kwargs)
+    return config
+
+
+def make_read(flag=0, mapping_quality=60, cigar=((0, 10),), name="read", start=100):
+    read = pysam.AlignedSegment()
+    read.query_name = name
+    read.query_sequence = "A" * 10
+    read.query_qualities = pysam.qualitystring_to_array("I" * 10)
+    read.reference_id = 0
+    read.reference_start = start
+    read.mapping_quality = mapping_quality
+    read.cigar = cigar
+    read.flag = flag
+    return read
+
+
+class TestReadFilter(unittest.TestCase):
+    """
+    Here we are testing which reads are discarded when they are loaded, and that the
+    number of discarded reads is recorded for each reason.
+    """
+    def test_default_filter_keeps_all_mapped_reads(self):
+        read_filter = coverview_.reads.pyReadFilter(make_read_filter_config())
+
+        for flag in [0, 16, 256, 512, 1024, 2048]:
+            assert read_filter.passes(make_read(flag=flag))
+
+        assert read_filter.passes(make_read(mapping_quality=0))
+        assert sum(read_filter.get_discarded_read_counts().values()) == 0
+
+    def test_unmapped_reads_are_always_discarded(self):
+        read_filter = coverview_.reads.pyReadFilter(make_read_filter_config())
+
+        assert not read_filter.passes(make_read(flag=4))
+        assert not read_filter.passes(make_read(cigar=()))
+        assert read_filter.get_discarded_read_counts()["unmapped"] == 2
+
+    def test_excluded_flags_are_discarded_and_counted(self):
+        read_filter = coverview_.reads.pyReadFilter(make_read_filter_config(
+            count_duplicate_reads=False,
+            count_secondary_reads=False,
+            count_supplementary_reads=False,
+            count_qc_fail_reads=False
+        ))
+
+        assert not read_filter.passes(make_read(flag=1024))
+        assert not read_filter.passes(make_read(flag=256))
+        assert not read_filter.passes(make_read(flag=2048))
+        assert not read_filter.passes(make_read(flag=512))
+        assert read_filter.passes(make_read(flag=16))
+
+        counts = read_filter.get_discarded_read_counts()
+        assert counts["duplicate"] == 1
+        assert counts["secondary"] == 1
+        assert counts["supplementary"] == 1
+        assert counts["qc_fail"] == 1
+
+    def test_reads_below_minimum_mapping_quality_are_discarded(self):
+        read_filter = coverview_.reads.pyReadFilter(make_read_filter_config(min_mapq=20))
+
+        assert not read_filter.passes(make_read(mapping_quality=19))
+        assert read_filter.passes(make_read(mapping_quality=20))
+        assert read_filter.get_discarded_read_counts()["low_mapping_quality"] == 1
+
+    def test_only_discarded_reads_overlapping_targets_are_counted(self):
+        read_filter = coverview_.reads.pyReadFilter(make_read_filter_config(min_mapq=20))
+        read_filter.set_targets(0, [(200, 300), (105, 150), (140, 160)])
+
+        for start in [50, 95, 96, 155, 159, 160, 190, 299, 300]:
+            assert not read_filter.passes(make_read(mapping_quality=0, start=start))
+
+        # Reads are 10 bases long, so only those starting at 96, 155, 159 and 299 overlap
+        assert read_filter.get_discarded_read_counts()["low_mapping_quality"] == 4
+
+
+def make_deep_reads(n_reads, start=100):
+    return [make_read(name="read_{}".format(i), start=start + i // 100) for i in range(n_reads)]
+
+
+def make_spread_reads(n_reads, reads_per_position=10, start=100):
+    return [make_read(name="read_{}".format(i), start=start + i // reads_per_position) for i in range(n_reads)]
+
+
+class TestDepthCap(unittest.TestCase):
+    """
+    Here we are testing that the depth cap keeps a reproducible subset of the reads
+    where the depth is too high, and that reads fetched again get the same decision.
+    """
+    def select_reads(self, depth_cap, reads):
+        depth_cap.start_region(0, 0)
+        levels = [depth_cap.select(read) for read in reads]
+        depth_cap.mark_region_as_seen(0, 1000)
+        return levels
+
+    def test_reads_are_all_kept_below_the_cap(self):
+        depth_cap = coverview_.reads.pyDepthCap(10)
+        levels = self.select_reads(depth_cap, make_deep_reads(10))
+
+        assert levels == [0] * 10
+        assert depth_cap.get_depth_counts()["reads_dropped"] == 0
+
+    def test_deep_reads_are_capped_and_depths_are_reported(self):
+        depth_cap = coverview_.reads.pyDepthCap(10)
+        levels = self.select_reads(depth_cap, make_deep_reads(1000))
+        counts = depth_cap.get_depth_counts()
+        n_kept = len([level for level in levels if level != -1])
+
+        # All the reads overlap base 109, so the kept depth there is the number kept. The
+        # reads are chosen by their names, not by taking the first ones in file order.
+        assert levels[:10] == [0] * 10
+        assert 10 < n_kept < 30
+        assert any(level != -1 for level in levels[100:])
+        assert counts["reads_seen"] == 1000
+        assert counts["reads_dropped"] == 1000 - n_kept
+        assert counts["max_raw_depth"] == 1000
+        assert counts["max_capped_depth"] == n_kept
+
+    def test_kept_depth_stays_close_to_the_cap(self):
+        depth_cap = coverview_.reads.pyDepthCap(10)
+        self.select_reads(depth_cap, make_spread_reads(2000))
+
+        assert depth_cap.get_depth_counts()["max_raw_depth"] == 100
+        assert depth_cap.get_depth_counts()["max_capped_depth"] < 30
+
+    def test_kept_reads_are_spread_over_the_reads(self):
+        reads = make_spread_reads(2000)
+        levels = self.select_reads(coverview_.reads.pyDepthCap(10), reads)
+        kept_indices = [index for index, level in enumerate(levels) if level != -1]
+
+        # Ten reads start at each position. Keeping reads in file order whenever there
+        # is room would favour the first reads at each position.
+        for window_start in range(0, 2000, 400):
+            assert len([index for index in kept_indices if window_start <= index < window_start + 400]) >= 10
+
+        assert len([index for index in kept_indices if index % 10 >= 5]) >= len(kept_indices) // 3
+
+    def test_selection_depends_only_on_the_read_names(self):
+        reads = make_deep_reads(1000)
+        levels = self.select_reads(coverview_.reads.pyDepthCap(10), reads)
+
+        other_reads = [
+            make_read(flag=16, mapping_quality=20, name=read.query_name, start=read.reference_start)
+            for read in reads
+        ]
+
+        renamed_reads = [
+            make_read(name="other_" + read.query_name, start=read.reference_start) for read in reads
+        ]
+
+        assert self.select_reads(coverview_.reads.pyDepthCap(10), other_reads) == levels
+        assert self.select_reads(coverview_.reads.pyDepthCap(10), renamed_reads) != levels
+
+    def test_extrapolated_depth_matches_the_raw_depth(self):
+        # A raw depth of 160 is just inside sample level 4 for a cap of 10, where about 10
+        # reads are expected to be kept
+        reads = make_spread_reads(3200, reads_per_position=16)
+        levels = self.select_reads(coverview_.reads.pyDepthCap(10), reads)
+        raw_depths = {}
+        extrapolated_depths = {}
+
+        for read, level in zip(reads, levels):
+            for pos in range(read.reference_start, read.reference_end):
+                raw_depths[pos] = raw_depths.get(pos, 0) + 1
+
+                if level != -1:
+                    extrapolated_depths[pos] = extrapolated_depths.get(pos, 0) + 2 ** level
+
+        ratios = [float(extrapolated_depths.get(pos, 0)) / raw_depths[pos] for pos in raw_depths]
+
+        assert 0.85 < sum(2 ** level for level in levels if level != -1) / 3200.0 < 1.15
+        assert 0.85 < sum(ratios) / len(ratios) < 1.15
+
+    def test_reads_outside_the_targets_are_kept_and_not_counted(self):
+        depth_cap = coverview_.reads.pyDepthCap(10)
+        depth_cap.set_targets(0, [(100, 105)])
+        reads = make_deep_reads(100) + make_deep_reads(100, start=200)
+        levels = self.select_reads(depth_cap, reads)
+        counts = depth_cap.get_depth_counts()
+
+        assert levels[:10] == [0] * 10
+        assert -1 in levels[:100]
+        assert levels[100:] == [0] * 100
+        assert counts["reads_seen"] == 100
+
+    def test_same_reads_are_kept_on_every_run(self):
+        reads = make_deep_reads(1000)
+        levels = self.select_reads(coverview_.reads.pyDepthCap(10), reads)
+
+        assert self.select_reads(coverview_.reads.pyDepthCap(10), reads) == levels
+
+    def test_reads_kept_under_a_lower_cap_are_kept_under_a_higher_one(self):
+        reads = make_deep_reads(1000)
+        low_cap_levels = self.select_reads(coverview_.reads.pyDepthCap(10), reads)
+        high_cap_levels = self.select_reads(coverview_.reads.pyDepthCap(40), reads)
+
+        for low_cap_level, high_cap_level in zip(low_cap_levels, high_cap_levels):
+            assert low_cap_level == -1 or high_cap_level != -1
+
+    def test_reads_fetched_again_get_the_same_decision(self):
+        depth_cap = coverview_.reads.pyDepthCap(10)
+        reads = make_deep_reads(1000)
+        levels = self.select_reads(depth_cap, reads)
+
+        depth_cap.start_region(0, 105)
+        assert [depth_cap.select(read) for read in reads[500:]] == levels[500:]
+        assert depth_cap.get_depth_counts()["reads_seen"] == 1000
+
 
 if __name__ == "__main__":
     unittest.main()
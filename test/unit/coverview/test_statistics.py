@@ -1,3 +1,6 @@
+from __future__ import division
+
+import array
 import coverview_.statistics
 import math
 import unittest
@@ -117,5 +120,193 @@ class TestQualityHistogramFractionBelowThresholdCalculation(object):
         assert hist.compute_fraction_below_threshold(threshold) == 0.5
 
 
+class TestQualityHistogramPairCalculation(unittest.TestCase):
+    """
+    Here we are testing that statistics computed over a pair of histograms, as used
+    to combine the forward and reverse strand histograms, match the statistics of a
+    single histogram holding all of the data.
+    """
+    def make_pair_and_combined_histograms(self, data_a, data_b):
+        pair = coverview_.statistics.pyQualityHistogramArray(2)
+        combined = coverview_.statistics.pyQualityHistogram()
+
+        for value in data_a:
+            pair.add_data(0, value)
+            combined.add_data(value)
+
+        for value in data_b:
+            pair.add_data(1, value)
+            combined.add_data(value)
+
+        return pair, combined
+
+    def test_empty_pair_has_median_of_nan(self):
+        pair, combined = self.make_pair_and_combined_histograms([], [])
+        assert math.isnan(pair.compute_median_of_pair(0, 1))
+
+    def test_median_of_pair_matches_median_of_combined_data(self):
+        for data_a, data_b in [
+            ([10], []), ([], [10]), ([10], [20]), ([1, 30, 30], [5, 7]), (range(50), range(50, 100))
+        ]:
+            pair, combined = self.make_pair_and_combined_histograms(data_a, data_b)
+            assert pair.compute_median_of_pair(0, 1) == combined.compute_median()
+
+    def test_fraction_below_threshold_of_pair_matches_combined_data(self):
+        pair, combined = self.make_pair_and_combined_histograms([5, 15, 25], [9])
+        assert pair.compute_fraction_below_threshold_of_pair(0, 1, 10) == combined.compute_fraction_below_threshold(10)
+        assert pair.compute_fraction_below_threshold_of_pair(0, 1, 10) == 0.5
+
+
+class TestQualityHistogramRuns(unittest.TestCase):
+    """
+    Here we are testing that quality scores added to runs of histograms give the same
+    histograms as adding them to each histogram separately.
+    """
+    def test_runs_match_data_added_to_each_histogram(self):
+        runs = [(0, 3, 60), (2, 4, 20), (1, -1, 60), (4, -1, 0)]
+        run_hists = coverview_.statistics.pyQualityHistogramArray(5)
+        single_hists = coverview_.statistics.pyQualityHistogramArray(5)
+
+        for index_begin, index_end, quality in runs:
+            run_hists.add_data_to_run(index_begin, index_end, quality)
+
+            for index in range(index_begin, 5 if index_end == -1 else index_end):
+                single_hists.add_data(index, quality)
+
+        run_hists.sum_runs(0, 5)
+
+        for index in range(5):
+            assert run_hists.compute_median(index) == single_hists.compute_median(index)
+            assert run_hists.compute_fraction_below_threshold(index, 30) == \
+                single_hists.compute_fraction_below_threshold(index, 30)
+
+    def test_runs_are_summed_separately_for_each_range(self):
+        hists = coverview_.statistics.pyQualityHistogramArray(4)
+        hists.add_data_to_run(0, -1, 10)
+        hists.add_data_to_run(2, -1, 30)
+        hists.sum_runs(0, 2)
+        hists.sum_runs(2, 4)
+
+        assert hists.compute_median(1) == 10
+        assert hists.compute_median(3) == 30
+
+
+class TestQualityHistogramStorage(unittest.TestCase):
+    """
+    Here we are testing that the compact histogram storage gives the right results when
+    the range of quality scores is extended and when the counts are widened.
+    """
+    def test_median_is_right_when_quality_range_is_extended_in_both_directions(self):
+        hist = coverview_.statistics.pyQualityHistogram()
+
+        for value in [40, 41, 2, 93, 255, 30, 0]:
+            hist.add_data(value)
+
+        assert hist.compute_median() == 40
+        assert abs(hist.compute_fraction_below_threshold(31) - 3 / 7) < 1e-6
+
+    def test_median_is_right_for_counts_which_overflow_narrow_types(self):
+        hists = coverview_.statistics.pyQualityHistogramArray(2)
+
+        for i in range(40000):
+            hists.add_data(0, 30)
+            hists.add_data(1, 10)
+
+        for i in range(40001):
+            hists.add_data(1, 50)
+
+        assert hists.compute_median(0) == 30
+        assert hists.compute_median(1) == 50
+        assert hists.compute_median_of_pair(0, 1) == 30
+        assert abs(hists.compute_fraction_below_threshold_of_pair(0, 1, 20) - 40000 / 120001) < 1e-6
+
+    def test_runs_are_right_for_counts_which_overflow_narrow_types(self):
+        hists = coverview_.statistics.pyQualityHistogramArray(3)
+
+        for i in range(300):
+            hists.add_data_to_run(0, 2, 60)
+            hists.add_data_to_run(1, -1, 0)
+
+        hists.sum_runs(0, 3)
+
+        assert hists.compute_median(0) == 60
+        assert hists.compute_median(1) == 30
+        assert hists.compute_median(2) == 0
+
+    def test_runs_with_multiplicity_widen_counts_more_than_once(self):
+        hists = coverview_.statistics.pyQualityHistogramArray(3)
+        hists.add_data_to_run(0, 2, 60, 40000)
+        hists.add_data_to_run(1, -1, 0, 40001)
+        hists.sum_runs(0, 3)
+
+        assert hists.compute_median(0) == 60
+        assert hists.compute_median(1) == 0
+        assert hists.compute_median(2) == 0
+        assert abs(hists.compute_fraction_below_threshold(1, 30) - 40001 / 80001) < 1e-6
+
+
+class TestSparseQualityHistogram(unittest.TestCase):
+    """
+    Here we are testing that histograms holding only a few distinct quality scores, and
+    histograms which switch from sparse to dense bins as more scores are seen, match
+    the median and fractions of the raw data.
+    """
+    def check_histogram_matches_data(self, data):
+        hist = coverview_.statistics.pyQualityHistogram()
+
+        for value in data:
+            hist.add_data(value)
+
+        assert hist.compute_median() == coverview_.statistics.median(data)
+
+        for threshold in [0, 5, 10, 20, 30, 40, 100]:
+            fraction = len([x for x in data if x < threshold]) / len(data)
+            assert abs(hist.compute_fraction_below_threshold(threshold) - fraction) < 1e-6
+
+    def test_binned_base_qualities(self):
+        self.check_histogram_matches_data([37, 2, 12, 23, 37, 37, 23, 12, 37, 2])
+
+    def test_typical_mapping_qualities(self):
+        self.check_histogram_matches_data([60] * 7 + [0] * 4)
+
+    def test_histogram_switches_to_dense_bins_when_many_scores_are_seen(self):
+        self.check_histogram_matches_data([37, 2, 12, 23] * 5 + range(0, 42, 2) + [93])
+
+
+class TestArrayStatistics(unittest.TestCase):
+    """
+    The median, minimum and maximum of the per-base arrays are computed without
+    converting the arrays to lists. Here we check that they match the list versions.
+    """
+    def test_empty_array_has_median_min_and_max_of_nan(self):
+        x = array.array('l')
+        assert math.isnan(coverview_.statistics.median_of_array(x))
+        assert math.isnan(coverview_.statistics.min_or_nan_of_array(x))
+        assert math.isnan(coverview_.statistics.max_or_nan_of_array(x))
+
+    def test_median_of_array_matches_median_of_list(self):
+        for x in [[5], [10, 20], [30, 10, 20], [3, 1, 4, 1, 5, 9, 2, 6], range(100, 0, -1)]:
+            median = coverview_.statistics.median_of_array(array.array('l', x))
+            assert median == coverview_.statistics.median(x)
+            assert isinstance(median, type(coverview_.statistics.median(x)))
+
+    def test_min_and_max_of_longs(self):
+        x = array.array('l', [7, 3, 9, 3, 12, 0, 5])
+        assert coverview_.statistics.min_or_nan_of_array(x) == 0
+        assert coverview_.statistics.max_or_nan_of_array(x) == 12
+
+    def test_min_and_max_of_floats_treat_nan_as_min_and_max_do(self):
+        for x in [[0.5, float('NaN'), 0.25], [float('NaN'), 0.5, 0.25], [0.25, 0.5]]:
+            values = array.array('f', x)
+
+            for array_function, list_function in [
+                (coverview_.statistics.min_or_nan_of_array, min),
+                (coverview_.statistics.max_or_nan_of_array, max)
+            ]:
+                result = array_function(values)
+                expected = list_function(values)
+                assert result == expected or (math.isnan(result) and math.isnan(expected))
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -46,7 +46,19 @@ _profile_value_type_map = {
     "MEDBQ": float_or_nan,
     "FLBQ": float_or_nan,
     "MEDMQ": float_or_nan,
-    "FLMQ": float_or_nan
+    "FLMQ": float_or_nan,
+    "COV+": int,
+    "QCOV+": int,
+    "MEDBQ+": float_or_nan,
+    "FLBQ+": float_or_nan,
+    "MEDMQ+": float_or_nan,
+    "FLMQ+": float_or_nan,
+    "COV-": int,
+    "QCOV-": int,
+    "MEDBQ-": float_or_nan,
+    "FLBQ-": float_or_nan,
+    "MEDMQ-": float_or_nan,
+    "FLMQ-": float_or_nan
 }
 
 
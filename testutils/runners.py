@@ -1,10 +1,12 @@
 import bamgen.bamgen
+import collections
 import coverview_.main
 import coverview_.reads
 import coverview_.transcript
 import json
 import os
 import pysam
+import testutils.output_checkers
 import uuid
 
 
@@ -73,6 +75,27 @@ def make_bam_file(file_name, read_sets):
     )
 
 
+def make_cram_file(bam_file_name, cram_file_name, reference_file_name):
+    """
+    Convert a BAM file made by make_bam_file to an indexed CRAM file. The mock reference
+    used for the BAM file is written out as a FASTA file, because CRAM needs it.
+    """
+    ref_file = bamgen.bamgen.MockReferenceFile()
+
+    with pysam.AlignmentFile(bam_file_name, 'rb') as bam_file:
+        references = zip(bam_file.references, bam_file.lengths)
+
+    with open(reference_file_name, 'w') as fasta_file:
+        for chrom, length in references:
+            fasta_file.write(">{}\n{}\n".format(chrom, ref_file.fetch(chrom, 0, length)))
+
+    pysam.faidx(reference_file_name)
+    pysam.samtools.view(
+        "-C", "-T", reference_file_name, "-o", cram_file_name, bam_file_name, catch_stdout=False
+    )
+    pysam.index(cram_file_name)
+
+
 def make_bed_file(file_name, regions):
     """
     Output a BED file containing a list of genomic intervals
@@ -99,6 +122,22 @@ def make_config_file(file_name, config_dict):
         json.dump(config_dict, config_file)
 
 
+def make_ini_config_file(file_name, config_sections):
+    """
+    Output a configuration file in the INI format read by CoverView. 'config_sections' maps
+    section names to dictionaries of the options in that section.
+    """
+    with open(file_name, 'w') as config_file:
+        for section, options in sorted(config_sections.items()):
+            config_file.write("[{}]\n".format(section))
+
+            for key, value in sorted(options.items()):
+                if isinstance(value, bool):
+                    value = str(value).lower()
+
+                config_file.write("{} = {}\n".format(key, value))
+
+
 def load_bam_into_read_array(file_name):
     """
     Utility function for creating a read array from the contents of a sorted BAM file
@@ -121,14 +160,20 @@ class CoverViewTestRunner(object):
         self.index_file_name = self.bam_file_name + ".bai"
         self.bed_file_name = self.bam_file_name.replace(".bam", ".bed")
         self.config_file_name = self.bam_file_name.replace(".bam", ".json")
+        self.ini_config_file_name = self.bam_file_name.replace(".bam", ".ini")
         self.transcript_file_name = self.bam_file_name.replace(".bam", "_transcript_db.txt")
         self.compressed_transcript_file_name = self.bam_file_name.replace(".bam", "_transcript_db.txt.gz")
         self.transcript_file_index_name = self.bam_file_name.replace(".bam", "_transcript_db.txt.gz.tbi")
+        self.cram_file_name = None
+        self.reference_file_name = None
+        self.stream_input = False
         self.gui_output_file_name = None
         self.read_sets = []
         self.regions = []
         self.transcripts = []
         self.config_data = {}
+        self.ini_config_sections = {}
+        self.extra_command_line_arguments = []
 
     def __enter__(self):
         return self
@@ -149,18 +194,38 @@ class CoverViewTestRunner(object):
     def add_config_data(self, config_data):
         self.config_data.update(config_data)
 
+    def add_ini_config_data(self, section, options):
+        self.ini_config_sections.setdefault(section, {}).update(options)
+
     def add_transcript(self, transcript):
         self.transcripts.append(transcript)
 
     def add_gui_output_file(self, file_name):
         self.gui_output_file_name = file_name
 
+    def add_command_line_arguments(self, arguments):
+        self.extra_command_line_arguments.extend(arguments)
+
+    def use_cram_input(self):
+        self.cram_file_name = self.bam_file_name.replace(".bam", ".cram")
+        self.reference_file_name = self.bam_file_name.replace(".bam", "_reference.fa")
+
+    def use_stdin_input(self):
+        self.stream_input = True
+
     def generate_input_files(self):
         bamgen.bamgen.make_bam_file(
             self.bam_file_name,
             self.read_sets
         )
 
+        if self.cram_file_name is not None:
+            make_cram_file(
+                self.bam_file_name,
+                self.cram_file_name,
+                self.reference_file_name
+            )
+
         if len(self.regions) > 0:
             make_bed_file(
                 self.bed_file_name,
@@ -184,31 +249,110 @@ class CoverViewTestRunner(object):
             self.config_data
         )
 
+        if len(self.ini_config_sections) > 0:
+            make_ini_config_file(
+                self.ini_config_file_name,
+                self.ini_config_sections
+            )
+        else:
+            self.ini_config_file_name = None
+
     def clean_up_input_files(self):
         remove_if_exists(self.bam_file_name)
         remove_if_exists(self.bed_file_name)
         remove_if_exists(self.compressed_transcript_file_name)
         remove_if_exists(self.config_file_name)
+        remove_if_exists(self.ini_config_file_name)
         remove_if_exists(self.index_file_name)
         remove_if_exists(self.transcript_file_index_name)
         remove_if_exists(self.transcript_file_name)
 
+        if self.cram_file_name is not None:
+            remove_if_exists(self.cram_file_name)
+            remove_if_exists(self.cram_file_name + ".crai")
+            remove_if_exists(self.reference_file_name)
+            remove_if_exists(self.reference_file_name + ".fai")
+
     def clean_up_output_files(self):
         remove_if_exists("output_regions.txt")
         remove_if_exists("output_profiles.txt")
         remove_if_exists("output_summary.txt")
         remove_if_exists("output_poor.txt")
+        remove_if_exists("output_meta.json")
         remove_if_exists(self.gui_output_file_name)
 
     def run_coverview_and_get_exit_code(self):
         self.generate_input_files()
 
+        if self.cram_file_name is not None:
+            input_file_name = self.cram_file_name
+            self.extra_command_line_arguments.extend(["--reference", self.reference_file_name])
+        elif self.stream_input:
+            input_file_name = "-"
+        else:
+            input_file_name = self.bam_file_name
+
         command_line_args = make_command_line_arguments(
-            bam_file_name=self.bam_file_name,
+            bam_file_name=input_file_name,
             bed_file_name=self.bed_file_name,
-            config_file_name=self.config_file_name,
+            config_file_name=self.ini_config_file_name or self.config_file_name,
             transcript_file_name=self.compressed_transcript_file_name,
             gui_output_file_name=self.gui_output_file_name
         )
 
-        return coverview_.main.main(command_line_args)
+        command_line_args.extend(self.extra_command_line_arguments)
+
+        if not self.stream_input:
+            return coverview_.main.main(command_line_args)
+
+        # htslib reads stdin through file descriptor 0, so the BAM file is put there. The
+        # index is removed to check that it is not needed.
+        remove_if_exists(self.index_file_name)
+        saved_stdin = os.dup(0)
+
+        try:
+            with open(self.bam_file_name, 'rb') as bam_file:
+                os.dup2(bam_file.fileno(), 0)
+
+            return coverview_.main.main(command_line_args)
+        finally:
+            os.dup2(saved_stdin, 0)
+            os.close(saved_stdin)
+
+
+CoverViewOutputs = collections.namedtuple("CoverViewOutputs", ["profiles", "regions", "summary"])
+
+
+def run_coverview_and_load_outputs(read_sets, regions, command_line_arguments=(), config_sections=None,
+                                   use_cram=False, use_stdin=False):
+    """
+    Utility function to run CoverView on reads made from 'read_sets', with the target
+    'regions', and return its profiles, regions and summary outputs. 'config_sections'
+    are written to an INI configuration file, as for CoverViewTestRunner.add_ini_config_data.
+    The input is given as CRAM or through stdin instead of as an indexed BAM file if requested.
+    """
+    with CoverViewTestRunner() as runner:
+        for read_set in read_sets:
+            runner.add_reads(read_set)
+
+        for region in regions:
+            runner.add_region(region)
+
+        for section, options in (config_sections or {}).items():
+            runner.add_ini_config_data(section, options)
+
+        if use_cram:
+            runner.use_cram_input()
+
+        if use_stdin:
+            runner.use_stdin_input()
+
+        runner.add_command_line_arguments(command_line_arguments)
+        status_code = runner.run_coverview_and_get_exit_code()
+        assert status_code == 0
+
+        return CoverViewOutputs(
+            testutils.output_checkers.load_coverview_profile_output("output_profiles.txt"),
+            testutils.output_checkers.load_coverview_regions_output("output_regions.txt"),
+            testutils.output_checkers.load_coverview_summary_output("output_summary.txt")
+        )
@@ -128,27 +128,71 @@ def uniquify_region_names(regions):
     return sorted(regions_with_unique_names)
 
 
-def cluster_genomic_intervals(intervals, size_limit=100000):
+def cluster_genomic_intervals(intervals, size_limit=100000, read_count_estimator=None, max_reads=None):
     """
     Reads a BED file and yields lists of regions that are close
     together.
+
+    By default, a cluster spans at most 'size_limit' bases. If a 'read_count_estimator'
+    is given, clusters are instead limited to an estimated 'max_reads' reads, so the
+    clusters are short where the coverage is deep and long where it is shallow. The
+    estimator must have an estimate_reads_in_region(chrom, begin, end) method.
     """
     if len(intervals) == 0:
         raise StandardError("Passed empty list of intervals to cluster function")
 
     all_intervals = sorted(intervals)
     current_cluster = []
+    cluster_end = 0
+    cluster_reads = 0
 
     for interval in all_intervals:
-        if len(current_cluster) == 0:
-            current_cluster.append(interval)
-        elif current_cluster[-1].chromosome != interval.chromosome:
-            yield current_cluster
-            current_cluster = [interval]
-        elif interval.end_pos - current_cluster[0].start_pos > size_limit:
-            yield current_cluster
+        if len(current_cluster) > 0 and current_cluster[-1].chromosome == interval.chromosome:
+            if read_count_estimator is not None:
+                extra_reads = read_count_estimator.estimate_reads_in_region(
+                    interval.chromosome, cluster_end, interval.end_pos
+                )
+                start_new_cluster = cluster_reads + extra_reads > max_reads
+            else:
+                extra_reads = 0
+                start_new_cluster = interval.end_pos - current_cluster[0].start_pos > size_limit
+        else:
+            start_new_cluster = True
+
+        if start_new_cluster:
+            if len(current_cluster) > 0:
+                yield current_cluster
+
             current_cluster = [interval]
+            cluster_end = interval.end_pos
+
+            if read_count_estimator is not None:
+                cluster_reads = read_count_estimator.estimate_reads_in_region(
+                    interval.chromosome, interval.start_pos, interval.end_pos
+                )
         else:
             current_cluster.append(interval)
+            cluster_end = max(cluster_end, interval.end_pos)
+            cluster_reads += extra_reads
 
     yield current_cluster
+
+
+def group_genomic_intervals_by_chromosome(intervals):
+    """
+    Yields sorted lists of all the intervals on each chromosome.
+    """
+    if len(intervals) == 0:
+        raise StandardError("Passed empty list of intervals to grouping function")
+
+    all_intervals = sorted(intervals)
+    current_group = [all_intervals[0]]
+
+    for interval in all_intervals[1:]:
+        if interval.chromosome != current_group[-1].chromosome:
+            yield current_group
+            current_group = [interval]
+        else:
+            current_group.append(interval)
+
+    yield current_group